@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""Load scripts run by hand against a staging database (not imported by the bot)."""
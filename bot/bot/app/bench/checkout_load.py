@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""End-to-end checkout throughput benchmark against the fake providers.
+
+Every order goes through the production code path:
+
+    create_subscription_order -> provider invoice/payment (fake API)
+    -> fake pays it and posts the webhook -> webhook server -> queue workers
+    -> _process_paid_order -> mark_order_paid -> notification (Redis Stream)
+    -> Marzban outbox dispatcher -> fake Marzban
+
+The bot settings are pointed at the fakes in-process. Each bench user gets
+one device, so every payment also produces a Marzban update. The report
+shows orders/sec, DB statements per order (the whole pipeline, outbox
+included) and latency percentiles for creation, confirmation
+(pay -> "payment confirmed") and the total.
+
+Run against a staging database and Redis (DATABASE_URL / REDIS_URL from .env):
+
+    python -m bot.app.bench.checkout_load --orders 1000 --concurrency 10 --provider cryptopay \\
+        --latency-ms 80 --webhook-delay-ms 200 --duplicates 1
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from uuid import uuid4
+
+from sqlalchemy import delete, func, select
+
+from ..cache import close_redis, get_redis, get_stream_redis
+from ..config import settings
+from ..db import SessionLocal, engine, init_db
+from ..db.profiling import install_query_hooks, start_tracking, stop_tracking
+from ..marzban.client import MarzbanClient
+from ..models import Device, MarzbanOutbox, User, WebhookEvent
+from ..services.notifications import STREAM_KEY as NOTIFICATIONS_STREAM
+from ..services.orders import create_subscription_order
+from ..services.outbox import dispatch_marzban_outbox, wait_for_outbox_work
+from ..services.payments import get_cryptopay_client, get_yookassa_client
+from ..services.payments.rates import get_rates_cache, rub_to_asset_amount
+from ..utils.http import close_http_clients, start_http_clients
+from ..webhooks import start_webhook_server, start_webhook_workers, stop_webhook_server, stop_webhook_workers
+from .fake_providers import FakeProviders, add_behaviour_args, behaviour_from_args
+
+# tg_ids far outside the real id range so the users are easy to clean up
+_TG_ID_BASE = 9_100_000_000_000
+_USERNAME_PREFIX = "bench_checkout_"
+_PLAN = ("pro", 1)
+
+
+def _point_settings_at_fakes(fake_port: int, http_port: int) -> None:
+    fake = f"http://127.0.0.1:{fake_port}"
+    settings.cryptopay_token = "bench-token"
+    settings.cryptopay_api_base = f"{fake}/cryptopay"
+    settings.cryptopay_webhook_secret = "bench-secret"
+    settings.cryptopay_webhook_path_secret = "bench"
+    settings.yookassa_shop_id = "bench-shop"
+    settings.yookassa_secret_key = "bench-key"
+    settings.yookassa_api_base = f"{fake}/yookassa/v3"
+    settings.yookassa_webhook_path_secret = "bench"
+    settings.yookassa_return_url = "https://example.com/return"
+    settings.webhook_host = "127.0.0.1"
+    settings.webhook_port = http_port
+    # Link pre-warm after payment would hit the real Marzban/Happ and skew the numbers
+    settings.device_links_prewarm_enabled = False
+
+
+async def _create_users(count: int) -> list[tuple[int, int]]:
+    """(user id, tg_id) of fresh bench users, one active device each."""
+    async with SessionLocal() as session:
+        users = [User(tg_id=_TG_ID_BASE + i, first_name=f"bench{i}", referral_code=None) for i in range(count)]
+        session.add_all(users)
+        await session.flush()
+        session.add_all(
+            Device(user_id=u.id, slot=1, status="active", marzban_username=f"{_USERNAME_PREFIX}{u.id}")
+            for u in users
+        )
+        await session.commit()
+        return [(u.id, u.tg_id) for u in users]
+
+
+async def _cleanup(event_ids: list[str]) -> None:
+    async with SessionLocal() as session:
+        await session.execute(delete(MarzbanOutbox).where(MarzbanOutbox.marzban_username.like(f"{_USERNAME_PREFIX}%")))
+        if event_ids:
+            await session.execute(delete(WebhookEvent).where(WebhookEvent.event_id.in_(event_ids)))
+        await session.execute(delete(User).where(User.tg_id >= _TG_ID_BASE))
+        await session.commit()
+
+
+async def _open_provider_payment(order, provider: str) -> str:
+    """Same calls the buy handlers make; returns the provider payment id."""
+    if provider == "cryptopay":
+        asset = settings.cryptopay_asset
+        amount = await rub_to_asset_amount(order.amount_rub, asset)
+        invoice = await get_cryptopay_client().create_invoice(
+            amount=amount,
+            asset=asset,
+            description=f"Заказ #{order.id}",
+            payload=json.dumps({"order_id": order.id}),
+        )
+        order.amount, order.currency = amount, asset
+        order.raw_provider_payload = invoice.raw
+        payment_id, pay_url = str(invoice.invoice_id), invoice.pay_url
+    else:
+        payment = await get_yookassa_client().create_payment(
+            amount_rub=order.amount_rub,
+            description=f"Заказ #{order.id}",
+            return_url=settings.yookassa_return_url,
+            metadata={"order_id": order.id},
+            idempotence_key=f"{order.id}-{uuid4()}",
+        )
+        payment_id, pay_url = payment.payment_id, payment.confirmation_url
+    order.provider = provider
+    order.payment_method = provider
+    order.provider_payment_id = payment_id
+    order.pay_url = pay_url
+    return payment_id
+
+
+class _Confirmations:
+    """Resolves a future per order id when its "payment confirmed" notification arrives.
+
+    Tails the notifications stream with a plain XREAD (no consumer group), so
+    a running bot still gets every message.
+    """
+
+    def __init__(self) -> None:
+        self.waiters: dict[int, asyncio.Future] = {}
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        newest = await get_redis().xrevrange(NOTIFICATIONS_STREAM, count=1)
+        self._last_id = newest[0][0] if newest else "0-0"
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        reader = get_stream_redis()
+        while True:
+            resp = await reader.xread({NOTIFICATIONS_STREAM: self._last_id}, count=500, block=1_000)
+            for _stream, messages in resp or []:
+                for msg_id, fields in messages:
+                    self._last_id = msg_id
+                    data = json.loads(fields.get("data") or "{}")
+                    waiter = self.waiters.get(int(data.get("order_id") or 0))
+                    if waiter is not None and not waiter.done():
+                        waiter.set_result(time.perf_counter())
+
+    def expect(self, order_id: int) -> asyncio.Future:
+        return self.waiters.setdefault(order_id, asyncio.get_running_loop().create_future())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+
+async def _outbox_loop(marz: MarzbanClient) -> None:
+    while True:
+        async with SessionLocal() as session:
+            stats = await dispatch_marzban_outbox(session, marz)
+        if not stats:
+            await wait_for_outbox_work(0.5)
+
+
+def _percentiles(values: list[float]) -> str:
+    if not values:
+        return "n/a"
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return (
+        f"p50={pick(0.50):.0f}ms p90={pick(0.90):.0f}ms p99={pick(0.99):.0f}ms "
+        f"max={ordered[-1] * 1000:.0f}ms"
+    )
+
+
+async def run(args: argparse.Namespace) -> bool:
+    _point_settings_at_fakes(args.fake_port, args.http_port)
+    install_query_hooks(engine)
+    await init_db()
+    await _cleanup([])
+    users = await _create_users(args.orders)
+
+    fake = FakeProviders(
+        behaviour_from_args(args),
+        webhook_base=f"http://127.0.0.1:{args.http_port}",
+        cryptopay_webhook_secret=settings.cryptopay_webhook_secret,
+        cryptopay_path_secret=settings.cryptopay_webhook_path_secret,
+        yookassa_path_secret=settings.yookassa_webhook_path_secret,
+    )
+    await fake.start(port=args.fake_port)
+    start_http_clients()
+    marz = MarzbanClient(
+        base_url=f"http://127.0.0.1:{args.fake_port}/marzban",
+        username="bench",
+        password="bench",
+        api_prefix="/api",
+    )
+
+    # Tasks created from here on inherit the tracking context, so the webhook
+    # workers and the outbox dispatcher are counted too.
+    stats, token = start_tracking()
+    confirmations = _Confirmations()
+    await confirmations.start()
+    workers = await start_webhook_workers()
+    runner = await start_webhook_server()
+    outbox_task = asyncio.create_task(_outbox_loop(marz))
+
+    gate = asyncio.Semaphore(args.concurrency)
+    create_lat: list[float] = []
+    confirm_lat: list[float] = []
+    total_lat: list[float] = []
+    outcome: Counter = Counter()
+    event_ids: list[str] = []
+
+    async def one(user_id: int) -> None:
+        async with gate:
+            t0 = time.perf_counter()
+            try:
+                async with SessionLocal() as session:
+                    order = await create_subscription_order(
+                        session, user_id, *_PLAN, payment_method=args.provider, provider=args.provider
+                    )
+                    payment_id = await _open_provider_payment(order, args.provider)
+                    await session.commit()
+            except Exception as exc:
+                outcome[f"create_failed:{type(exc).__name__}"] += 1
+                return
+            event_ids.append(payment_id)
+            waiter = confirmations.expect(order.id)
+            t1 = time.perf_counter()
+            create_lat.append(t1 - t0)
+            fake.pay(args.provider, payment_id)
+        # The gate bounds checkout requests, not the wait for the provider.
+        try:
+            t2 = await asyncio.wait_for(waiter, timeout=args.timeout)
+        except asyncio.TimeoutError:
+            outcome["confirm_timeout"] += 1
+            return
+        confirm_lat.append(t2 - t1)
+        total_lat.append(t2 - t0)
+        outcome["paid"] += 1
+
+    ok = False
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(user_id) for user_id, _ in users))
+        elapsed = time.perf_counter() - started
+
+        # Let the dispatcher drain the Marzban updates of the paid orders.
+        deadline = time.perf_counter() + args.timeout
+        while time.perf_counter() < deadline:
+            async with SessionLocal() as session:
+                pending = (
+                    await session.execute(
+                        select(func.count(MarzbanOutbox.id)).where(
+                            MarzbanOutbox.marzban_username.like(f"{_USERNAME_PREFIX}%"),
+                            MarzbanOutbox.status == "pending",
+                        )
+                    )
+                ).scalar_one()
+            if not pending:
+                break
+            await asyncio.sleep(0.2)
+        drained = time.perf_counter() - started
+        stop_tracking(token)
+
+        paid = outcome["paid"]
+        marzban_users = sum(1 for name in fake.marzban_users if name.startswith(_USERNAME_PREFIX))
+        print(f"provider={args.provider} orders={args.orders} concurrency={args.concurrency}")
+        print(f"outcome: {dict(outcome)}")
+        print(f"throughput: {paid / elapsed:.1f} paid orders/s ({elapsed:.2f}s), Marzban drained after {drained:.2f}s")
+        print(
+            f"db: {stats.queries} statements, {stats.queries / max(paid, 1):.1f} per paid order, "
+            f"{stats.db_time_ms / max(paid, 1):.1f}ms DB time per order"
+        )
+        for stmt, n in stats.repeated(max(2, paid))[:5]:
+            print(f"  x{n}: {' '.join(stmt.split())[:140]}")
+        print(f"create:  {_percentiles(create_lat)}")
+        print(f"confirm: {_percentiles(confirm_lat)}")
+        print(f"total:   {_percentiles(total_lat)}")
+        print(f"marzban: {marzban_users} users updated, fake stats: {dict(fake.stats)}")
+        ok = paid == args.orders and marzban_users == paid
+    finally:
+        outbox_task.cancel()
+        await stop_webhook_server(runner)
+        await stop_webhook_workers(workers)
+        await confirmations.stop()
+        await marz.close()
+        await fake.stop()
+        await get_rates_cache().stop()
+        await close_http_clients()
+        await _cleanup(event_ids)
+        await close_redis()
+
+    print("OK" if ok else "FAILED")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10, help="checkouts in flight; keep within the DB pool size + overflow")
+    parser.add_argument("--provider", choices=("cryptopay", "yookassa"), default="cryptopay")
+    parser.add_argument("--timeout", type=float, default=60.0, help="max seconds to wait for a confirmation")
+    parser.add_argument("--fake-port", type=int, default=18090)
+    parser.add_argument("--http-port", type=int, default=18080, help="port of the bench webhook server")
+    add_behaviour_args(parser)
+    ok = asyncio.run(run(parser.parse_args()))
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""Local stand-ins for CryptoPay, YooKassa and Marzban.
+
+One aiohttp app serves the parts of the APIs the bot uses:
+
+- /cryptopay/{createInvoice,getInvoices,getExchangeRates}
+- /yookassa/v3/payments (create, get, list with cursor)
+- /marzban/api/admin/token, /marzban/api/user[/{username}]
+
+`FakeProviders.pay()` marks an invoice/payment as paid and delivers the
+provider webhook to WEBHOOK_BASE (CryptoPay deliveries are signed like the
+real ones), optionally late and more than once. Latency, jitter and a share
+of 500 answers are configurable to see how checkout behaves under a slow or
+flaky provider.
+
+Standalone (point CRYPTOPAY_API_BASE / YOOKASSA_API_BASE / MARZBAN_BASE_URL
+at it; POST /_fake/pay/{provider}/{id} pays an order by hand):
+
+    python -m bot.app.bench.fake_providers --port 8090 --webhook-base http://127.0.0.1:8080 --latency-ms 80
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import random
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any
+
+import aiohttp
+from aiohttp import web
+from loguru import logger
+
+# asset -> (RUB, USD) rates reported by getExchangeRates
+_RATES = {"USDT": ("92.5", "1"), "TON": ("480.0", "5.2"), "BTC": ("5900000", "64000")}
+_USD_RUB = "92.4"
+
+
+@dataclass(slots=True)
+class FakeBehaviour:
+    latency_ms: float = 0.0  # added to every API call
+    jitter_ms: float = 0.0  # uniform +- on top of latency
+    fail_rate: float = 0.0  # share of API calls answered with 500
+    webhook_delay_ms: float = 0.0  # between pay() and the first delivery
+    duplicates: int = 0  # extra deliveries of every webhook
+    auto_pay_ms: float | None = None  # pay every new invoice/payment by itself after this delay
+
+
+def _iso_now() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class FakeProviders:
+    def __init__(
+        self,
+        behaviour: FakeBehaviour | None = None,
+        *,
+        webhook_base: str | None = None,
+        cryptopay_webhook_secret: str | None = None,
+        cryptopay_path_secret: str | None = None,
+        yookassa_path_secret: str | None = None,
+    ) -> None:
+        self.behaviour = behaviour or FakeBehaviour()
+        self.webhook_base = (webhook_base or "").rstrip("/")
+        self.cryptopay_webhook_secret = cryptopay_webhook_secret
+        self.cryptopay_path_secret = cryptopay_path_secret or "fake"
+        self.yookassa_path_secret = yookassa_path_secret or "fake"
+        self.invoices: dict[int, dict[str, Any]] = {}
+        self.payments: dict[str, dict[str, Any]] = {}
+        self.marzban_users: dict[str, dict[str, Any]] = {}
+        self.stats: Counter = Counter()
+        self._idempotence: dict[str, str] = {}
+        # Far from real invoice ids, so webhook dedup keys never collide with real events
+        self._next_invoice_id = 900_000_000 + random.randrange(10**8)
+        self._update_id = 0
+        self._session: aiohttp.ClientSession | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._runner: web.AppRunner | None = None
+
+    # ---- lifecycle ----
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._behaviour_middleware])
+        app.router.add_post("/cryptopay/createInvoice", self._cp_create_invoice)
+        app.router.add_post("/cryptopay/getInvoices", self._cp_get_invoices)
+        app.router.add_post("/cryptopay/getExchangeRates", self._cp_get_rates)
+        app.router.add_post("/yookassa/v3/payments", self._yk_create_payment)
+        app.router.add_get("/yookassa/v3/payments", self._yk_list_payments)
+        app.router.add_get("/yookassa/v3/payments/{payment_id}", self._yk_get_payment)
+        app.router.add_post("/marzban/api/admin/token", self._mz_token)
+        app.router.add_post("/marzban/api/user", self._mz_create_user)
+        app.router.add_get("/marzban/api/user/{username}", self._mz_get_user)
+        app.router.add_put("/marzban/api/user/{username}", self._mz_modify_user)
+        app.router.add_post("/_fake/pay/{provider}/{payment_id}", self._manual_pay)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8090) -> None:
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info("Fake providers listening on {}:{}", host, port)
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._runner:
+            await self._runner.cleanup()
+        if self._session:
+            await self._session.close()
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @web.middleware
+    async def _behaviour_middleware(self, request: web.Request, handler):
+        if request.path.startswith("/_fake/"):
+            return await handler(request)
+        b = self.behaviour
+        delay = b.latency_ms + (random.uniform(-b.jitter_ms, b.jitter_ms) if b.jitter_ms else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        resource = request.match_info.route.resource
+        self.stats[f"api:{request.method} {resource.canonical if resource else request.path}"] += 1
+        if b.fail_rate and random.random() < b.fail_rate:
+            self.stats["api:injected_500"] += 1
+            return web.json_response({"ok": False, "error": "injected"}, status=500)
+        return await handler(request)
+
+    # ---- CryptoPay ----
+
+    async def _cp_create_invoice(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        invoice_id = self._next_invoice_id
+        self._next_invoice_id += 1
+        invoice = {
+            "invoice_id": invoice_id,
+            "hash": uuid.uuid4().hex[:12],
+            "status": "active",
+            "asset": data.get("asset"),
+            "amount": str(data.get("amount")),
+            "description": data.get("description"),
+            "payload": data.get("payload"),
+            "pay_url": f"https://t.me/CryptoBot?start=fake{invoice_id}",
+            "created_at": _iso_now(),
+        }
+        self.invoices[invoice_id] = invoice
+        self._maybe_auto_pay("cryptopay", str(invoice_id))
+        return web.json_response({"ok": True, "result": invoice})
+
+    async def _cp_get_invoices(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        ids = data.get("invoice_ids") or []
+        if isinstance(ids, str):
+            ids = [i for i in ids.split(",") if i]
+        items = [self.invoices[int(i)] for i in ids if int(i) in self.invoices]
+        return web.json_response({"ok": True, "result": {"items": items}})
+
+    async def _cp_get_rates(self, request: web.Request) -> web.Response:
+        rates = [{"is_valid": True, "source": "USD", "target": "RUB", "rate": _USD_RUB}]
+        for asset, (rub, usd) in _RATES.items():
+            rates.append({"is_valid": True, "source": asset, "target": "RUB", "rate": rub})
+            rates.append({"is_valid": True, "source": asset, "target": "USD", "rate": usd})
+        return web.json_response({"ok": True, "result": rates})
+
+    # ---- YooKassa ----
+
+    async def _yk_create_payment(self, request: web.Request) -> web.Response:
+        key = request.headers.get("Idempotence-Key")
+        if key and key in self._idempotence:
+            return web.json_response(self.payments[self._idempotence[key]])
+        data = await request.json()
+        payment_id = str(uuid.uuid4())
+        payment = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "amount": data.get("amount"),
+            "description": data.get("description"),
+            "metadata": data.get("metadata") or {},
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.ru/checkout/fake/{payment_id}"},
+            "created_at": _iso_now(),
+            "test": True,
+        }
+        self.payments[payment_id] = payment
+        if key:
+            self._idempotence[key] = payment_id
+        self._maybe_auto_pay("yookassa", payment_id)
+        return web.json_response(payment)
+
+    async def _yk_get_payment(self, request: web.Request) -> web.Response:
+        payment = self.payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        return web.json_response(payment)
+
+    async def _yk_list_payments(self, request: web.Request) -> web.Response:
+        status = request.query.get("status")
+        created_gte = request.query.get("created_at.gte", "")
+        limit = max(1, min(100, int(request.query.get("limit", 10))))
+        offset = int(request.query.get("cursor") or 0)
+        items = [
+            p for p in self.payments.values()
+            if (not status or p["status"] == status) and p["created_at"] >= created_gte
+        ]
+        page = items[offset:offset + limit]
+        body: dict[str, Any] = {"type": "list", "items": page}
+        if offset + limit < len(items):
+            body["next_cursor"] = str(offset + limit)
+        return web.json_response(body)
+
+    # ---- Marzban ----
+
+    async def _mz_token(self, request: web.Request) -> web.Response:
+        return web.json_response({"access_token": "fake-token", "token_type": "bearer"})
+
+    async def _mz_create_user(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        user = {"status": "active", "used_traffic": 0, "links": [], "subscription_url": "", **data}
+        self.marzban_users[data["username"]] = user
+        return web.json_response(user)
+
+    async def _mz_get_user(self, request: web.Request) -> web.Response:
+        user = self.marzban_users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response(user)
+
+    async def _mz_modify_user(self, request: web.Request) -> web.Response:
+        username = request.match_info["username"]
+        data = await request.json()
+        user = self.marzban_users.setdefault(username, {"username": username, "status": "active"})
+        user.update(data)
+        return web.json_response(user)
+
+    # ---- payments and webhooks ----
+
+    async def _manual_pay(self, request: web.Request) -> web.Response:
+        ok = self.pay(request.match_info["provider"], request.match_info["payment_id"])
+        return web.json_response({"ok": ok}, status=200 if ok else 404)
+
+    def _maybe_auto_pay(self, provider: str, payment_id: str) -> None:
+        if self.behaviour.auto_pay_ms is None:
+            return
+
+        async def _later() -> None:
+            await asyncio.sleep(self.behaviour.auto_pay_ms / 1000)
+            self.pay(provider, payment_id)
+
+        self._spawn(_later())
+
+    def pay(self, provider: str, payment_id: str) -> bool:
+        """Mark as paid and schedule the webhook deliveries; False for unknown ids."""
+        if provider == "cryptopay":
+            invoice = self.invoices.get(int(payment_id))
+            if invoice is None:
+                return False
+            invoice.update(status="paid", paid_at=_iso_now(), paid_asset=invoice["asset"], paid_amount=invoice["amount"])
+            self._update_id += 1
+            body = {"update_id": self._update_id, "update_type": "invoice_paid", "request_date": _iso_now(), "payload": invoice}
+            url = f"{self.webhook_base}/webhook/cryptopay/{self.cryptopay_path_secret}"
+        elif provider == "yookassa":
+            payment = self.payments.get(payment_id)
+            if payment is None:
+                return False
+            payment.update(status="succeeded", paid=True, captured_at=_iso_now())
+            body = {"type": "notification", "event": "payment.succeeded", "object": payment}
+            url = f"{self.webhook_base}/webhook/yookassa/{self.yookassa_path_secret}"
+        else:
+            return False
+        self.stats[f"paid:{provider}"] += 1
+        if self.webhook_base:
+            self._spawn(self._deliver(provider, url, json.dumps(body).encode()))
+        return True
+
+    async def _deliver(self, provider: str, url: str, raw: bytes) -> None:
+        headers = {"Content-Type": "application/json"}
+        if provider == "cryptopay" and self.cryptopay_webhook_secret:
+            headers["Crypto-Pay-API-Signature"] = hmac.new(
+                self.cryptopay_webhook_secret.encode(), raw, hashlib.sha256
+            ).hexdigest()
+        if self.behaviour.webhook_delay_ms:
+            await asyncio.sleep(self.behaviour.webhook_delay_ms / 1000)
+        for attempt in range(1 + max(0, self.behaviour.duplicates)):
+            try:
+                async with self._session.post(url, data=raw, headers=headers) as resp:
+                    self.stats[f"webhook:{provider}:{resp.status}"] += 1
+            except Exception as exc:
+                self.stats[f"webhook:{provider}:error"] += 1
+                logger.warning("Fake {} webhook delivery failed: {}", provider, exc)
+            if attempt < self.behaviour.duplicates:
+                await asyncio.sleep(random.uniform(0, 0.05))
+
+
+def add_behaviour_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="provider API latency")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of API calls answered with 500")
+    parser.add_argument("--webhook-delay-ms", type=float, default=0.0)
+    parser.add_argument("--duplicates", type=int, default=0, help="extra deliveries of every webhook")
+
+
+def behaviour_from_args(args: argparse.Namespace) -> FakeBehaviour:
+    return FakeBehaviour(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        fail_rate=args.fail_rate,
+        webhook_delay_ms=args.webhook_delay_ms,
+        duplicates=args.duplicates,
+        auto_pay_ms=getattr(args, "auto_pay_ms", None),
+    )
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    fake = FakeProviders(
+        behaviour_from_args(args),
+        webhook_base=args.webhook_base,
+        cryptopay_webhook_secret=args.cryptopay_webhook_secret,
+        cryptopay_path_secret=args.cryptopay_path_secret,
+        yookassa_path_secret=args.yookassa_path_secret,
+    )
+    await fake.start(args.host, args.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fake.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--webhook-base", default=None, help="bot HTTP base URL, e.g. http://127.0.0.1:8080")
+    parser.add_argument("--cryptopay-webhook-secret", default=None)
+    parser.add_argument("--cryptopay-path-secret", default=None)
+    parser.add_argument("--yookassa-path-secret", default=None)
+    parser.add_argument("--auto-pay-ms", type=float, default=None, help="pay every new invoice after this delay")
+    add_behaviour_args(parser)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
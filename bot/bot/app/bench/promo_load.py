@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Concurrent promo redemption load test.
+
+Creates a throwaway promo with `--max-uses` slots and `--users` users, fires
+all redemptions at once and checks that:
+
+- exactly min(users, max_uses) redemptions succeeded;
+- promos.used_count equals the number of redemption rows;
+- a second wave from the same users redeems nothing.
+
+Run against a staging database (uses DATABASE_URL / REDIS_URL from .env):
+
+    python -m bot.app.bench.promo_load --users 500 --max-uses 100
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import secrets
+import time
+
+from sqlalchemy import delete, func, select
+
+from ..cache import close_redis
+from ..db import SessionLocal, init_db
+from ..models import Promo, PromoRedemption, User
+from ..services.promos import create_promo, delete_promo, redeem_promo_to_balance
+
+# tg_ids far outside the real id range so the users are easy to clean up
+_TG_ID_BASE = 9_000_000_000_000
+
+
+async def _create_users(count: int) -> list[int]:
+    async with SessionLocal() as session:
+        users = [
+            User(tg_id=_TG_ID_BASE + i, first_name=f"bench{i}", referral_code=None)
+            for i in range(count)
+        ]
+        session.add_all(users)
+        await session.commit()
+        return [u.id for u in users]
+
+
+async def _drop_users() -> None:
+    async with SessionLocal() as session:
+        await session.execute(delete(User).where(User.tg_id >= _TG_ID_BASE))
+        await session.commit()
+
+
+async def _redeem(promo_id: int, user_id: int, gate: asyncio.Semaphore) -> bool:
+    async with gate, SessionLocal() as session:
+        promo = await session.get(Promo, promo_id)
+        user = await session.get(User, user_id)
+        return await redeem_promo_to_balance(session, promo=promo, user=user) is not None
+
+
+async def _wave(promo_id: int, user_ids: list[int], concurrency: int) -> tuple[int, float]:
+    gate = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(_redeem(promo_id, uid, gate) for uid in user_ids))
+    return sum(results), time.perf_counter() - started
+
+
+async def run(users: int, max_uses: int, concurrency: int) -> bool:
+    await init_db()
+    await _drop_users()
+    user_ids = await _create_users(users)
+
+    code = f"BENCH-{secrets.token_hex(4).upper()}"
+    async with SessionLocal() as session:
+        promo = await create_promo(session, code=code, discount_rub=1, max_uses=max_uses)
+    promo_id = promo.id
+
+    ok = True
+    try:
+        won, elapsed = await _wave(promo_id, user_ids, concurrency)
+        expected = min(users, max_uses) if max_uses else users
+        print(f"wave 1: {won}/{users} redeemed in {elapsed:.2f}s ({users / elapsed:.0f} req/s), expected {expected}")
+        ok &= won == expected
+
+        again, _ = await _wave(promo_id, user_ids, concurrency)
+        print(f"wave 2 (same users): {again} redeemed, expected 0")
+        ok &= again == 0
+
+        async with SessionLocal() as session:
+            used_count = (await session.execute(select(Promo.used_count).where(Promo.id == promo_id))).scalar_one()
+            rows = (
+                await session.execute(
+                    select(func.count(PromoRedemption.id)).where(PromoRedemption.promo_id == promo_id)
+                )
+            ).scalar_one()
+        print(f"used_count={used_count} redemptions={rows}")
+        ok &= used_count == rows == expected
+    finally:
+        async with SessionLocal() as session:
+            await delete_promo(session, promo_id)
+        await _drop_users()
+        await close_redis()
+
+    print("OK" if ok else "FAILED")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--max-uses", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=15, help="parallel sessions; keep within the DB pool size + overflow")
+    args = parser.parse_args()
+    ok = asyncio.run(run(args.users, args.max_uses, args.concurrency))
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
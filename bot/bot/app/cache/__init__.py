@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+from .client import close_redis, get_redis, get_stream_redis
+from .invalidation import InvalidationListener, on_invalidate
+from .shared import SharedCache
+
+__all__ = ["InvalidationListener", "SharedCache", "close_redis", "get_redis", "get_stream_redis", "on_invalidate"]
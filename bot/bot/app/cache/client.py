@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+from loguru import logger
+from redis.asyncio import Redis
+
+from ..config import settings
+
+_redis: Redis | None = None
+_stream_redis: Redis | None = None
+
+
+def get_redis() -> Redis | None:
+    """Shared Redis client for application caches.
+
+    Returns None when REDIS_URL is not configured; callers treat that as a
+    permanent cache miss.
+    """
+    global _redis
+    if _redis is None and settings.redis_url:
+        _redis = Redis.from_url(
+            settings.redis_url,
+            decode_responses=True,
+            socket_timeout=settings.redis_socket_timeout,
+            socket_connect_timeout=settings.redis_socket_timeout,
+            health_check_interval=30,
+        )
+    return _redis
+
+
+def get_stream_redis() -> Redis | None:
+    """Client for blocking reads (XREADGROUP ... BLOCK, BLPOP).
+
+    The shared client's REDIS_SOCKET_TIMEOUT is shorter than a BLOCK, so an
+    idle read there would time out instead of waiting; this one has no read
+    timeout (connects still time out).
+    """
+    global _stream_redis
+    if _stream_redis is None and settings.redis_url:
+        _stream_redis = Redis.from_url(
+            settings.redis_url,
+            decode_responses=True,
+            socket_timeout=None,
+            socket_connect_timeout=settings.redis_socket_timeout,
+            health_check_interval=30,
+        )
+    return _stream_redis
+
+
+async def close_redis() -> None:
+    global _redis, _stream_redis
+    for client in (_redis, _stream_redis):
+        if client is None:
+            continue
+        try:
+            await client.aclose()
+        except Exception as exc:
+            logger.warning("Redis close failed: {}", exc)
+    _redis = _stream_redis = None
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Cross-process invalidation of in-process cache levels.
+
+The bot process and every HTTP worker keep their own local copies (the
+SharedCache local level, the /connect bundle map). Deleting a key in Redis
+does not reach them, so `publish_invalidation()` also announces the keys on
+the Redis channel `cache:invalidate` and the `InvalidationListener` of every
+process drops its local copies through the handlers registered with
+`on_invalidate()`.
+
+Pub/sub is fire-and-forget: a message sent while a listener is reconnecting
+is lost, so caches using this keep a short local TTL as the upper bound of
+staleness.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import uuid
+from typing import Callable
+
+from loguru import logger
+
+from ..metrics import Counter
+from .client import get_redis
+
+CHANNEL = "cache:invalidate"
+
+invalidations = Counter("cache_invalidations_total", "Cross-process cache invalidations by stage")
+
+_ORIGIN = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+_handlers: dict[str, list[Callable[[list[str]], None]]] = {}
+
+
+def on_invalidate(name: str, handler: Callable[[list[str]], None]) -> None:
+    """Run `handler(keys)` in this process when another process invalidates `name`."""
+    _handlers.setdefault(name, []).append(handler)
+
+
+def _apply(name: str, keys: list[str]) -> None:
+    for handler in _handlers.get(name, ()):
+        try:
+            handler(keys)
+        except Exception as exc:
+            logger.warning("Cache {} invalidation handler failed: {}", name, exc)
+
+
+async def publish_invalidation(name: str, keys: list[str]) -> None:
+    """Drop `keys` of cache `name` here (synchronously) and in every other process."""
+    if not keys:
+        return
+    _apply(name, keys)
+    redis = get_redis()
+    if redis is None:
+        return
+    payload = json.dumps({"name": name, "keys": keys, "origin": _ORIGIN})
+    try:
+        await redis.publish(CHANNEL, payload)
+    except Exception as exc:
+        invalidations.inc(stage="publish_failed")
+        logger.warning("Cache {} invalidation publish failed: {}", name, exc)
+        return
+    invalidations.inc(stage="published")
+
+
+class InvalidationListener:
+    def __init__(self) -> None:
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if get_redis() is None:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="cache-invalidation")
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(CHANNEL)
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message and message.get("type") == "message":
+                        self._receive(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Cache invalidation listener failed, resubscribing: {}", exc)
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def _receive(self, raw: str) -> None:
+        try:
+            data = json.loads(raw)
+            name, keys = str(data["name"]), [str(key) for key in data["keys"]]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Malformed cache invalidation: {}", raw)
+            return
+        if data.get("origin") == _ORIGIN:
+            return
+        _apply(name, keys)
+        invalidations.inc(stage="applied")
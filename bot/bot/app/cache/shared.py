@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Two-level cache: bounded in-process LRU+TTL in front of Redis.
+
+`SharedCache.get_or_load(key, loader)` looks in the local LRU, then in Redis
+(shared by all processes and replicas), and only then calls `loader`:
+
+- the local level holds at most `max_entries` keys; the least recently used
+  are evicted on insert, expired ones on read, so memory stays bounded;
+- concurrent misses for one key in a process share a single loader call;
+- a loader returning None (upstream failure) is not stored in Redis; it is
+  remembered locally for `negative_ttl_seconds` so a failing upstream is not
+  hammered; values rejected by the `cacheable` predicate are returned but not
+  stored at all (partial results);
+- with `local_ttl_seconds` the local level keeps entries shorter than
+  Redis; with `broadcast` a `delete()` also drops the keys from the local
+  level of every other process (see cache/invalidation.py);
+- lookups are counted in `cache_requests_total{cache, result}`, where the
+  result is local, redis, shared, miss or negative.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Generic, TypeVar
+
+from loguru import logger
+
+from ..metrics import Counter, Gauge
+from .client import get_redis
+from .invalidation import on_invalidate, publish_invalidation
+
+V = TypeVar("V")
+
+cache_requests = Counter("cache_requests_total", "Shared cache lookups by level")
+cache_entries = Gauge("cache_entries", "Entries in the in-process level of shared caches")
+
+_NEGATIVE = object()
+
+
+class SharedCache(Generic[V]):
+    def __init__(
+        self,
+        name: str,
+        *,
+        ttl_seconds: float,
+        max_entries: int,
+        negative_ttl_seconds: float = 30.0,
+        local_ttl_seconds: float | None = None,
+        broadcast: bool = False,
+        encode: Callable[[V], str] = json.dumps,
+        decode: Callable[[str], V] = json.loads,
+    ) -> None:
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.local_ttl_seconds = local_ttl_seconds
+        self.broadcast = broadcast
+        self.max_entries = max(1, max_entries)
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self._encode = encode
+        self._decode = decode
+        self._local: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+        if broadcast:
+            on_invalidate(name, self._local_drop)
+
+    def _redis_key(self, key: str) -> str:
+        # Keys are often long URLs; a digest keeps Redis keys short and uniform.
+        return f"cache:{self.name}:{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+    # ---- local level ----
+
+    def _local_get(self, key: str) -> Any:
+        item = self._local.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if time.monotonic() > expires_at:
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return value
+
+    def _local_set(self, key: str, value: Any, ttl: float) -> None:
+        if self.local_ttl_seconds is not None:
+            ttl = min(ttl, self.local_ttl_seconds)
+        self._local[key] = (time.monotonic() + ttl, value)
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_entries:
+            self._local.popitem(last=False)
+        cache_entries.set(len(self._local), cache=self.name)
+
+    # ---- public API ----
+
+    async def get(self, key: str) -> V | None:
+        value = self._local_get(key)
+        if value is not None:
+            return None if value is _NEGATIVE else value
+        return await self._redis_get(key)
+
+    async def set(self, key: str, value: V, ttl_seconds: float | None = None) -> None:
+        ttl = ttl_seconds or self.ttl_seconds
+        self._local_set(key, value, ttl)
+        redis = get_redis()
+        if redis is None:
+            return
+        try:
+            await redis.set(self._redis_key(key), self._encode(value), ex=max(1, int(ttl)))
+        except Exception as exc:
+            logger.warning("Cache {} write failed: {}", self.name, exc)
+
+    def _local_drop(self, keys: list[str]) -> None:
+        for key in keys:
+            self._local.pop(key, None)
+
+    async def delete(self, *keys: str) -> None:
+        if self.broadcast:
+            await publish_invalidation(self.name, list(keys))
+        else:
+            self._local_drop(list(keys))
+        redis = get_redis()
+        if redis is None or not keys:
+            return
+        try:
+            await redis.delete(*(self._redis_key(key) for key in keys))
+        except Exception as exc:
+            logger.warning("Cache {} delete failed: {}", self.name, exc)
+
+    async def get_or_load(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[V | None]],
+        *,
+        cacheable: Callable[[V], bool] | None = None,
+    ) -> V | None:
+        value = self._local_get(key)
+        if value is not None:
+            cache_requests.inc(cache=self.name, result="negative" if value is _NEGATIVE else "local")
+            return None if value is _NEGATIVE else value
+        task = self._inflight.get(key)
+        if task is not None:
+            cache_requests.inc(cache=self.name, result="shared")
+            return await asyncio.shield(task)
+        task = asyncio.create_task(self._fill(key, loader, cacheable))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _t: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _redis_get(self, key: str) -> V | None:
+        redis = get_redis()
+        if redis is None:
+            return None
+        try:
+            raw = await redis.get(self._redis_key(key))
+        except Exception as exc:
+            logger.warning("Cache {} read failed: {}", self.name, exc)
+            return None
+        if raw is None:
+            return None
+        try:
+            value = self._decode(raw)
+        except (ValueError, TypeError):
+            return None
+        self._local_set(key, value, self.ttl_seconds)
+        return value
+
+    async def _fill(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[V | None]],
+        cacheable: Callable[[V], bool] | None,
+    ) -> V | None:
+        value = await self._redis_get(key)
+        if value is not None:
+            cache_requests.inc(cache=self.name, result="redis")
+            return value
+        cache_requests.inc(cache=self.name, result="miss")
+        value = await loader()
+        if value is None:
+            if self.negative_ttl_seconds > 0:
+                self._local_set(key, _NEGATIVE, self.negative_ttl_seconds)
+            return None
+        if cacheable is None or cacheable(value):
+            await self.set(key, value)
+        return value
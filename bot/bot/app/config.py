@@ -26,7 +26,14 @@ class Settings(BaseSettings):
 
     # DB
     database_url: str = Field(..., alias='DATABASE_URL')
+    # Per process: Postgres connections ≈ (1 bot + WEB_PROCESSES) × (pool size + overflow)
+    db_pool_size: int = Field(5, alias='DB_POOL_SIZE')
+    db_max_overflow: int = Field(10, alias='DB_MAX_OVERFLOW')
     redis_url: str | None = Field('redis://redis:6379/0', alias='REDIS_URL')
+    redis_socket_timeout: float = Field(1.0, alias='REDIS_SOCKET_TIMEOUT')
+
+    # Cached User/Subscription projection for menu screens (see services/snapshots.py)
+    user_snapshot_ttl_seconds: int = Field(600, alias='USER_SNAPSHOT_TTL_SECONDS')
 
     # Marzban
     marzban_base_url: str = Field(..., alias='MARZBAN_BASE_URL')
@@ -70,6 +77,73 @@ class Settings(BaseSettings):
 
     webhook_host: str = Field('0.0.0.0', alias='WEBHOOK_HOST')
     webhook_port: int = Field(8080, alias='WEBHOOK_PORT')
+    # false: the bot only polls Telegram, HTTP is served by `python -m bot.app.web`
+    webhook_embedded: bool = Field(True, alias='WEBHOOK_EMBEDDED')
+    # Worker processes of the standalone HTTP service (0 = one per CPU core); each has its
+    # own DB pool and webhook consumers, so keep it small
+    web_processes: int = Field(2, alias='WEB_PROCESSES')
+
+    # Telegram updates: polling (one process) or webhook (sharded queue, any number of replicas)
+    telegram_mode: str = Field('polling', alias='TELEGRAM_MODE')
+    # Full URL Telegram posts to; default PUBLIC_BASE_URL + TELEGRAM_WEBHOOK_PATH
+    telegram_webhook_url: str | None = Field(None, alias='TELEGRAM_WEBHOOK_URL')
+    telegram_webhook_path: str = Field('/telegram/webhook', alias='TELEGRAM_WEBHOOK_PATH')
+    # Default: derived from BOT_TOKEN
+    telegram_webhook_secret: str | None = Field(None, alias='TELEGRAM_WEBHOOK_SECRET')
+    telegram_webhook_max_connections: int = Field(40, alias='TELEGRAM_WEBHOOK_MAX_CONNECTIONS')
+    # Per-user ordering: one shard is handled by one replica, sequentially
+    telegram_update_shards: int = Field(32, alias='TELEGRAM_UPDATE_SHARDS')
+    # Concurrent handlers per replica
+    telegram_update_workers: int = Field(16, alias='TELEGRAM_UPDATE_WORKERS')
+
+    # /connect page: per-device link bundle cache TTL (also the page's Cache-Control max-age)
+    connect_cache_seconds: int = Field(60, alias='CONNECT_CACHE_SECONDS')
+    # Device connection links (VLESS, subscription URL, happ://), shared by the bot and /connect;
+    # invalidated and rebuilt in the background on device/payment events
+    device_links_cache_seconds: int = Field(600, alias='DEVICE_LINKS_CACHE_SECONDS')
+    device_links_cache_max_entries: int = Field(10000, alias='DEVICE_LINKS_CACHE_MAX_ENTRIES')
+    device_links_prewarm_enabled: bool = Field(True, alias='DEVICE_LINKS_PREWARM_ENABLED')
+
+    # /sub/{token}: caching proxy in front of Marzban subscription URLs (needs PUBLIC_BASE_URL)
+    sub_proxy_enabled: bool = Field(False, alias='SUB_PROXY_ENABLED')
+    sub_proxy_cache_seconds: int = Field(300, alias='SUB_PROXY_CACHE_SECONDS')
+    sub_proxy_stale_seconds: int = Field(86400, alias='SUB_PROXY_STALE_SECONDS')
+    sub_proxy_rate_limit: int = Field(30, alias='SUB_PROXY_RATE_LIMIT')
+    sub_proxy_rate_window_seconds: int = Field(60, alias='SUB_PROXY_RATE_WINDOW_SECONDS')
+
+    # Payment webhook queue (see services/webhook_queue.py)
+    webhook_workers: int = Field(8, alias='WEBHOOK_WORKERS')
+    webhook_max_attempts: int = Field(8, alias='WEBHOOK_MAX_ATTEMPTS')
+    webhook_retry_base_seconds: int = Field(5, alias='WEBHOOK_RETRY_BASE_SECONDS')
+    webhook_retry_max_seconds: int = Field(900, alias='WEBHOOK_RETRY_MAX_SECONDS')
+    webhook_dedup_ttl_seconds: int = Field(86400, alias='WEBHOOK_DEDUP_TTL_SECONDS')
+
+    # Marzban outbox dispatcher (see services/outbox.py)
+    marzban_outbox_poll_seconds: float = Field(5.0, alias='MARZBAN_OUTBOX_POLL_SECONDS')
+    marzban_outbox_max_attempts: int = Field(10, alias='MARZBAN_OUTBOX_MAX_ATTEMPTS')
+
+    # Pending-order reconciler (see services/reconciler.py)
+    reconcile_enabled: bool = Field(True, alias='RECONCILE_ENABLED')
+    reconcile_interval_seconds: int = Field(300, alias='RECONCILE_INTERVAL_SECONDS')
+    # leave fresh orders to webhooks / the user's "check" button
+    reconcile_min_age_seconds: int = Field(120, alias='RECONCILE_MIN_AGE_SECONDS')
+    reconcile_max_orders: int = Field(1000, alias='RECONCILE_MAX_ORDERS')
+    pending_order_expire_hours: int = Field(48, alias='PENDING_ORDER_EXPIRE_HOURS')
+
+    # Shared outbound HTTP pools (see utils/http.py)
+    http_max_connections: int = Field(100, alias='HTTP_MAX_CONNECTIONS')
+    http_max_keepalive_connections: int = Field(20, alias='HTTP_MAX_KEEPALIVE_CONNECTIONS')
+    http_keepalive_expiry_seconds: float = Field(60.0, alias='HTTP_KEEPALIVE_EXPIRY_SECONDS')
+    http_timeout_seconds: float = Field(15.0, alias='HTTP_TIMEOUT_SECONDS')
+    http_connect_timeout_seconds: float = Field(5.0, alias='HTTP_CONNECT_TIMEOUT_SECONDS')
+    # requires the optional 'h2' package; ignored with a warning if it is missing
+    http2_enabled: bool = Field(False, alias='HTTP_HTTP2_ENABLED')
+
+    # /metrics endpoint; empty token = no auth (keep the port private then)
+    metrics_enabled: bool = Field(True, alias='METRICS_ENABLED')
+    metrics_token: str | None = Field(None, alias='METRICS_TOKEN')
+    # Metrics-only listener: the bot with WEBHOOK_EMBEDDED=false, web worker N on METRICS_PORT + N
+    metrics_port: int = Field(9100, alias='METRICS_PORT')
 
     # External payment links (optional)
     yookassa_pay_url: str | None = Field(None, alias='YOOKASSA_PAY_URL')
@@ -80,13 +154,22 @@ class Settings(BaseSettings):
     yookassa_secret_key: str | None = Field(None, alias='YOOKASSA_SECRET_KEY')
     yookassa_return_url: str | None = Field(None, alias='YOOKASSA_RETURN_URL')
     yookassa_webhook_path_secret: str | None = Field(None, alias='YOOKASSA_WEBHOOK_PATH_SECRET')
+    # Overridden only to point the bot at the local stand-ins (bench/fake_providers.py)
+    yookassa_api_base: str = Field('https://api.yookassa.ru/v3', alias='YOOKASSA_API_BASE')
 
     # CryptoPay
     cryptopay_token: str | None = Field(None, alias='CRYPTOPAY_TOKEN')
+    cryptopay_api_base: str = Field('https://pay.crypt.bot/api', alias='CRYPTOPAY_API_BASE')
     cryptopay_asset: str = Field('TON', alias='CRYPTOPAY_ASSET')
     cryptopay_webhook_path_secret: str | None = Field(None, alias='CRYPTOPAY_WEBHOOK_PATH_SECRET')
     cryptopay_webhook_secret: str | None = Field(None, alias='CRYPTOPAY_WEBHOOK_SECRET')
     cryptopay_invoice_expires_in: int | None = Field(None, alias='CRYPTOPAY_INVOICE_EXPIRES_IN')
+    # "Check payment" button: provider status cache per order and per-user cooldown
+    payment_check_cache_seconds: int = Field(10, alias='PAYMENT_CHECK_CACHE_SECONDS')
+    payment_check_cooldown_seconds: int = Field(5, alias='PAYMENT_CHECK_COOLDOWN_SECONDS')
+    # Exchange rates are refreshed in the background; checkout serves stale rates up to max age
+    cryptopay_rates_refresh_seconds: int = Field(60, alias='CRYPTOPAY_RATES_REFRESH_SECONDS')
+    cryptopay_rates_max_age_seconds: int = Field(900, alias='CRYPTOPAY_RATES_MAX_AGE_SECONDS')
 
     # YooKassa API (optional)
     yookassa_shop_id: str | None = Field(None, alias='YOOKASSA_SHOP_ID')
@@ -104,6 +187,8 @@ class Settings(BaseSettings):
     # Referral system
     referral_window_days: int = Field(30, alias='REFERRAL_WINDOW_DAYS')
     referral_cap_days: int = Field(15, alias='REFERRAL_CAP_DAYS')
+    # Full recompute of referral_counters to repair drift; 0 disables
+    referral_counters_recompute_hours: int = Field(24, alias='REFERRAL_COUNTERS_RECOMPUTE_HOURS')
 
     # Trial
     trial_hours: int = Field(48, alias='TRIAL_HOURS')
@@ -142,11 +227,35 @@ class Settings(BaseSettings):
     happ_proxy_api_base: str | None = Field(None, alias="HAPP_PROXY_API_BASE")
     happ_proxy_provider_code: str | None = Field(None, alias="HAPP_PROXY_PROVIDER_CODE")
     happ_proxy_auth_key: str | None = Field(None, alias="HAPP_PROXY_AUTH_KEY")
+    # Encrypted happ:// links (crypto.happ.su): shared cache TTL and in-process size bound
+    happ_crypto_cache_seconds: int = Field(900, alias="HAPP_CRYPTO_CACHE_SECONDS")
+    happ_crypto_cache_max_entries: int = Field(5000, alias="HAPP_CRYPTO_CACHE_MAX_ENTRIES")
+    # Pre-allocated install codes per install_limit tier (see services/happ_install_pool.py)
+    happ_install_pool_enabled: bool = Field(True, alias="HAPP_INSTALL_POOL_ENABLED")
+    happ_install_pool_size: int = Field(50, alias="HAPP_INSTALL_POOL_SIZE")
+    happ_install_pool_low_watermark: int = Field(20, alias="HAPP_INSTALL_POOL_LOW_WATERMARK")
+    happ_install_pool_refill_concurrency: int = Field(4, alias="HAPP_INSTALL_POOL_REFILL_CONCURRENCY")
+    happ_install_pool_check_seconds: float = Field(60.0, alias="HAPP_INSTALL_POOL_CHECK_SECONDS")
+
+    # Admin broadcasts (see services/broadcasts.py); Telegram allows ~30 msg/s per bot
+    broadcast_rate_per_second: float = Field(25.0, alias="BROADCAST_RATE_PER_SECOND")
+    broadcast_concurrency: int = Field(10, alias="BROADCAST_CONCURRENCY")
+    broadcast_page_size: int = Field(200, alias="BROADCAST_PAGE_SIZE")
+    # Expiry reminders (see services/reminders.py), sent through the broadcast rate limit
+    reminders_enabled: bool = Field(True, alias="REMINDERS_ENABLED")
+    reminders_interval_seconds: int = Field(900, alias="REMINDERS_INTERVAL_SECONDS")
+    reminders_batch_size: int = Field(200, alias="REMINDERS_BATCH_SIZE")
 
     # Traffic collection
     traffic_collect_enabled: bool = Field(False, alias="TRAFFIC_COLLECT_ENABLED")
     traffic_collect_interval_seconds: int = Field(3600, alias="TRAFFIC_COLLECT_INTERVAL_SECONDS")
 
+    # DB profiling (per-update query budget / N+1 detector); off in production, enable for profiling runs
+    db_profiling_enabled: bool = Field(False, alias="DB_PROFILING_ENABLED")
+    db_query_budget: int = Field(15, alias="DB_QUERY_BUDGET")
+    db_time_budget_ms: int = Field(250, alias="DB_TIME_BUDGET_MS")
+    db_n_plus_one_threshold: int = Field(3, alias="DB_N_PLUS_ONE_THRESHOLD")
+
 @lru_cache(maxsize=1)
 def get_settings() -> Settings:
     return Settings()
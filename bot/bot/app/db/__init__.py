@@ -12,14 +12,20 @@ from ..config import settings
 from ..models import Base
 
 from .migrations import run_migrations
+from .profiling import install_query_hooks
 
 
 engine: AsyncEngine = create_async_engine(
     settings.database_url,
     echo=False,
     pool_pre_ping=True,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
 )
 
+if settings.db_profiling_enabled:
+    install_query_hooks(engine)
+
 SessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
 
@@ -116,6 +116,37 @@ async def run_migrations(engine: AsyncEngine) -> None:
         "CREATE INDEX IF NOT EXISTS ix_promo_redemptions_promo_id ON promo_redemptions (promo_id);",
         "CREATE INDEX IF NOT EXISTS ix_promo_redemptions_user_id ON promo_redemptions (user_id);",
         "CREATE INDEX IF NOT EXISTS ix_promo_redemptions_order_id ON promo_redemptions (order_id);",
+        # one redemption per (promo, user): keep the earliest row of legacy duplicates
+        "DELETE FROM promo_redemptions a USING promo_redemptions b "
+        "WHERE a.promo_id = b.promo_id AND a.user_id = b.user_id AND a.id > b.id;",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_promo_redemptions_promo_user ON promo_redemptions (promo_id, user_id);",
+        # dispatcher scans only due pending rows
+        "CREATE INDEX IF NOT EXISTS ix_marzban_outbox_due ON marzban_outbox (next_attempt_at) WHERE status = 'pending';",
+        # in-order check: older pending rows of the same username
+        "CREATE INDEX IF NOT EXISTS ix_marzban_outbox_pending_user ON marzban_outbox (marzban_username, id) "
+        "WHERE status = 'pending';",
+        # expiring-soon lookups (admin list, broadcast segments, expiry reminders)
+        "CREATE INDEX IF NOT EXISTS ix_subscriptions_expires_at ON subscriptions (expires_at);",
+        # claims and pool levels look only at free install codes
+        "CREATE INDEX IF NOT EXISTS ix_happ_install_codes_free ON happ_install_codes (install_limit, id) "
+        "WHERE claimed_at IS NULL;",
+        # webhook_events.status used to default to the literal 'received' with the quotes included
+        "ALTER TABLE webhook_events ALTER COLUMN status SET DEFAULT 'received';",
+        "UPDATE webhook_events SET status = 'received' WHERE status = '''received''';",
+    ]
+
+    # Text -> JSONB for order/referral metadata. Values that are not valid JSON
+    # are kept under {"_raw": ...} instead of failing the whole ALTER.
+    jsonb_columns: list[tuple[str, str]] = [
+        ("orders", "meta_json"),
+        ("orders", "raw_provider_payload"),
+        ("referral_events", "meta_json"),
+    ]
+    jsonb_indexes: list[str] = [
+        "CREATE INDEX IF NOT EXISTS ix_orders_meta_promo_id ON orders ((meta_json->>'promo_id')) "
+        "WHERE meta_json->>'promo_id' IS NOT NULL;",
+        # no containment queries on orders.meta_json; the GIN index only slowed down writes
+        "DROP INDEX IF EXISTS ix_orders_meta_gin;",
     ]
 
     async with engine.begin() as conn:
@@ -127,6 +158,41 @@ async def run_migrations(engine: AsyncEngine) -> None:
                 # but if someone changed names manually we prefer not to crash.
                 logger.warning(f"Migration statement failed: {s} -> {type(e).__name__}: {e}")
 
+        try:
+            await conn.execute(text(
+                """
+CREATE OR REPLACE FUNCTION pg_temp.try_jsonb(value text) RETURNS jsonb AS $$
+BEGIN
+  IF value IS NULL OR btrim(value) = '' THEN
+    RETURN NULL;
+  END IF;
+  RETURN value::jsonb;
+EXCEPTION WHEN others THEN
+  RETURN jsonb_build_object('_raw', value);
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+"""
+            ))
+            for table, column in jsonb_columns:
+                await conn.execute(text(
+                    f"""
+DO $$
+BEGIN
+  IF EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = '{table}' AND column_name = '{column}' AND data_type = 'text'
+  ) THEN
+    ALTER TABLE {table}
+      ALTER COLUMN {column} TYPE JSONB USING pg_temp.try_jsonb({column});
+  END IF;
+END $$;
+"""
+                ))
+            for s in jsonb_indexes:
+                await conn.execute(text(s))
+        except Exception as e:
+            logger.warning(f"JSONB migration failed: {type(e).__name__}: {e}")
+
         # Foreign key for inviter_id (idempotent DO block)
         try:
             await conn.execute(text(
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+@dataclass
+class QueryStats:
+    """Per-update DB counters filled by the engine hooks below."""
+
+    queries: int = 0
+    rows: int = 0
+    db_time_ms: float = 0.0
+    statements: Counter = field(default_factory=Counter)
+
+    def repeated(self, threshold: int) -> list[tuple[str, int]]:
+        """Statements executed at least `threshold` times (N+1 candidates)."""
+        return [(stmt, n) for stmt, n in self.statements.most_common() if n >= threshold]
+
+
+_current: ContextVar[QueryStats | None] = ContextVar("db_query_stats", default=None)
+
+
+def start_tracking() -> tuple[QueryStats, object]:
+    stats = QueryStats()
+    token = _current.set(stats)
+    return stats, token
+
+
+def stop_tracking(token: object) -> None:
+    _current.reset(token)
+
+
+def current_stats() -> QueryStats | None:
+    return _current.get()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if _current.get() is None:
+        return
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    stats = _current.get()
+    if stats is None:
+        return
+    started = conn.info.get("query_start")
+    if started:
+        stats.db_time_ms += (time.perf_counter() - started.pop()) * 1000
+    stats.queries += 1
+    # asyncpg adapter fills rowcount from the command status ("SELECT 5"), -1 when unknown.
+    rowcount = getattr(cursor, "rowcount", -1) or 0
+    if rowcount > 0:
+        stats.rows += rowcount
+    stats.statements[statement] += 1
+
+
+def install_query_hooks(engine: AsyncEngine) -> None:
+    """Attach counting hooks to the engine. Safe to call once at import time."""
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
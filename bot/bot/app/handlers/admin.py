@@ -3,7 +3,6 @@ from __future__ import annotations
 import time
 from datetime import timedelta
 
-import httpx
 from aiogram import F, Router
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
@@ -15,6 +14,10 @@ from ..config import settings
 from ..db import session_scope
 from ..keyboards.admin import (
     admin_back_kb,
+    admin_broadcast_confirm_kb,
+    admin_broadcast_kb,
+    admin_broadcast_segments_kb,
+    admin_broadcasts_kb,
     admin_kb,
     admin_order_detail_kb,
     admin_payments_kb,
@@ -28,30 +31,33 @@ from ..keyboards.admin import (
     admin_user_confirm_kb,
 )
 from ..marzban.client import MarzbanClient, MarzbanError
-from ..models import Order, Subscription, User
+from ..models import Broadcast, Order, Subscription, User
 from ..services.admin import (
     find_user,
     get_dashboard_stats,
     get_plan_distribution,
     get_user_devices,
     get_user_orders,
-    list_expiring_subscriptions,
+    list_expiring_buckets,
     list_pending_orders_older_than,
     list_recent_orders,
 )
+from ..services.broadcasts import SEGMENTS, count_audience, create_broadcast, list_broadcasts, set_broadcast_status
 from ..services.catalog import get_plan_option, list_paid_plans, list_plan_options_by_code, plan_title
 from ..services.devices import enforce_device_limit, sync_devices_expire
 from ..services.orders import get_order, mark_order_paid
 from ..services.payments import (
-    CryptoPayClient,
-    YooKassaClient,
+    get_cryptopay_client,
+    get_yookassa_client,
     is_cryptopay_paid,
     is_yookassa_paid,
 )
 from ..services.promos import create_promo, delete_promo, get_promo_by_code, list_promos, toggle_promo, validate_promo_code
 
+from ..services.snapshots import store_user_snapshot
 from ..services.subscriptions import get_or_create_subscription, is_active, now_utc
 from ..services.traffic import top_users_by_traffic, total_traffic
+from ..utils.http import get_http_client
 from ..utils.telegram import edit_message_text, safe_answer_callback
 from ..utils.text import fmt_dt, h, months_title
 
@@ -63,6 +69,7 @@ class AdminStates(StatesGroup):
     promo_code = State()
     promo_discount = State()
     promo_max_uses = State()
+    broadcast_text = State()
 
 
 def _ensure_admin(tg_id: int) -> bool:
@@ -288,6 +295,154 @@ async def cb_admin_promo_delete(call: CallbackQuery) -> None:
 
 
 
+def _broadcast_segment_title(segment: str, arg: str | None) -> str:
+    if segment == "expiring":
+        return f"подписка истекает в ближайшие {arg} дн."
+    if segment == "plan":
+        return f"активный тариф {plan_title(arg or '')}"
+    if segment == "inactive":
+        return "без активной подписки"
+    return "все пользователи"
+
+
+def _render_broadcast(job: Broadcast) -> str:
+    done = job.sent + job.blocked + job.failed
+    status = {
+        "running": "идёт",
+        "paused": "на паузе",
+        "done": "завершена",
+        "cancelled": "остановлена",
+    }.get(job.status, job.status)
+    return (
+        f"📣 <b>Рассылка #{job.id}</b> — {status}\n\n"
+        f"Получатели: {_broadcast_segment_title(job.segment, job.segment_arg)}\n"
+        f"Прогресс: {done} / {job.total}\n"
+        f"Доставлено: {job.sent}, заблокировали бота: {job.blocked}, ошибки: {job.failed}\n"
+        f"Создана: {fmt_dt(job.created_at)}"
+        + (f"\nЗавершена: {fmt_dt(job.finished_at)}" if job.finished_at else "")
+    )
+
+
+@router.callback_query(F.data == "admin:bc")
+async def cb_admin_broadcasts(call: CallbackQuery, state: FSMContext) -> None:
+    await safe_answer_callback(call)
+    if not _ensure_admin(call.from_user.id):
+        await _admin_access_denied(call)
+        return
+    await state.clear()
+    async with session_scope() as session:
+        jobs = await list_broadcasts(session)
+    text = "📣 <b>Рассылки</b>\n\n"
+    if jobs:
+        text += "\n".join(
+            f"#{job.id} — {job.status} — {job.sent + job.blocked + job.failed}/{job.total}" for job in jobs
+        )
+    else:
+        text += "Рассылок пока не было."
+    await edit_message_text(call, text, reply_markup=admin_broadcasts_kb(jobs))
+
+
+@router.callback_query(F.data == "admin:bc:new")
+async def cb_admin_broadcast_new(call: CallbackQuery) -> None:
+    await safe_answer_callback(call)
+    if not _ensure_admin(call.from_user.id):
+        await _admin_access_denied(call)
+        return
+    await edit_message_text(
+        call,
+        "📣 <b>Новая рассылка</b>\n\nКому отправить?",
+        reply_markup=admin_broadcast_segments_kb(list_paid_plans()),
+    )
+
+
+@router.callback_query(F.data.startswith("admin:bc:seg:"))
+async def cb_admin_broadcast_segment(call: CallbackQuery, state: FSMContext) -> None:
+    await safe_answer_callback(call)
+    if not _ensure_admin(call.from_user.id):
+        await _admin_access_denied(call)
+        return
+    parts = call.data.split(":")
+    segment = parts[3] if len(parts) > 3 else ""
+    arg = parts[4] if len(parts) > 4 else None
+    if segment not in SEGMENTS:
+        await safe_answer_callback(call, "Неверные данные кнопки. Обновите меню.", show_alert=True)
+        return
+    await state.set_state(AdminStates.broadcast_text)
+    await state.update_data(bc_segment=segment, bc_arg=arg)
+    await edit_message_text(
+        call,
+        f"Получатели: {_broadcast_segment_title(segment, arg)}\n\n"
+        "Отправьте текст рассылки одним сообщением (форматирование сохранится):",
+        reply_markup=admin_back_kb("admin:bc"),
+    )
+
+
+@router.message(AdminStates.broadcast_text)
+async def msg_admin_broadcast_text(message: Message, state: FSMContext) -> None:
+    if not _ensure_admin(message.from_user.id):
+        await _admin_access_denied(message)
+        return
+    if not message.text:
+        await message.answer("Нужен текст. Отправьте текст рассылки:", reply_markup=admin_back_kb("admin:bc"))
+        return
+    data = await state.get_data()
+    segment, arg = data.get("bc_segment") or "all", data.get("bc_arg")
+    async with session_scope() as session:
+        total = await count_audience(session, segment, arg)
+    await state.update_data(bc_text=message.html_text)
+    # The text exactly as recipients will see it, then the summary
+    await message.answer(message.html_text, disable_web_page_preview=True)
+    await message.answer(
+        f"👆 Так увидят сообщение получатели.\n\n"
+        f"Получатели: {_broadcast_segment_title(segment, arg)} — <b>{total}</b>\n"
+        f"Скорость: до {settings.broadcast_rate_per_second:g} сообщений/с",
+        reply_markup=admin_broadcast_confirm_kb(),
+    )
+
+
+@router.callback_query(F.data == "admin:bc:start")
+async def cb_admin_broadcast_start(call: CallbackQuery, state: FSMContext) -> None:
+    await safe_answer_callback(call)
+    if not _ensure_admin(call.from_user.id):
+        await _admin_access_denied(call)
+        return
+    data = await state.get_data()
+    text = data.get("bc_text")
+    if not text:
+        await safe_answer_callback(call, "Черновик рассылки не найден. Начните заново.", show_alert=True)
+        return
+    async with session_scope() as session:
+        job = await create_broadcast(
+            session,
+            created_by=call.from_user.id,
+            segment=data.get("bc_segment") or "all",
+            segment_arg=data.get("bc_arg"),
+            text=text,
+        )
+    await state.clear()
+    logger.info("Admin {} started broadcast #{} ({} recipients)", call.from_user.id, job.id, job.total)
+    await edit_message_text(call, _render_broadcast(job), reply_markup=admin_broadcast_kb(job))
+
+
+@router.callback_query(F.data.regexp(r"^admin:bc:(job|pause|resume|cancel):\d+$"))
+async def cb_admin_broadcast_job(call: CallbackQuery) -> None:
+    await safe_answer_callback(call)
+    if not _ensure_admin(call.from_user.id):
+        await _admin_access_denied(call)
+        return
+    _, _, action, job_id_s = call.data.split(":")
+    status = {"pause": "paused", "resume": "running", "cancel": "cancelled"}.get(action)
+    async with session_scope() as session:
+        if status:
+            job = await set_broadcast_status(session, int(job_id_s), status)
+        else:
+            job = await session.get(Broadcast, int(job_id_s))
+    if job is None:
+        await safe_answer_callback(call, "Рассылка не найдена", show_alert=True)
+        return
+    await edit_message_text(call, _render_broadcast(job), reply_markup=admin_broadcast_kb(job))
+
+
 @router.callback_query(F.data == "admin:user")
 async def cb_admin_user(call: CallbackQuery, state: FSMContext) -> None:
     await safe_answer_callback(call)
@@ -372,6 +527,7 @@ async def cb_admin_user_extend(call: CallbackQuery) -> None:
         session.add(sub)
         await session.commit()
         await session.refresh(sub)
+        await store_user_snapshot(user, sub)
 
         marz = _marzban_client()
         try:
@@ -479,6 +635,7 @@ async def cb_admin_plan_apply(call: CallbackQuery) -> None:
             session.add(sub)
             await session.commit()
             await session.refresh(sub)
+            await store_user_snapshot(user, sub)
         else:
             new_expires = await _apply_plan_from_expiry(session, user, opt)
             sub.expires_at = new_expires
@@ -518,6 +675,7 @@ async def _apply_plan_from_expiry(session, user: User, opt) -> datetime:
     session.add(sub)
     await session.commit()
     await session.refresh(sub)
+    await store_user_snapshot(user, sub)
     return sub.expires_at
 
 
@@ -722,7 +880,7 @@ async def cb_admin_order_check(call: CallbackQuery) -> None:
             if not (settings.yookassa_shop_id and settings.yookassa_secret_key):
                 await safe_answer_callback(call, "YooKassa не настроена", show_alert=True)
                 return
-            client = YooKassaClient(settings.yookassa_shop_id, settings.yookassa_secret_key)
+            client = get_yookassa_client()
             try:
                 payment = await client.get_payment(order.provider_payment_id)
             except Exception:
@@ -736,7 +894,7 @@ async def cb_admin_order_check(call: CallbackQuery) -> None:
             if not settings.cryptopay_token:
                 await safe_answer_callback(call, "CryptoPay не настроен", show_alert=True)
                 return
-            client = CryptoPayClient(settings.cryptopay_token)
+            client = get_cryptopay_client()
             try:
                 invoice = await client.get_invoice(int(order.provider_payment_id))
             except Exception:
@@ -750,15 +908,7 @@ async def cb_admin_order_check(call: CallbackQuery) -> None:
             await safe_answer_callback(call, "Провайдер не поддерживает проверку", show_alert=True)
             return
 
-        marz = _marzban_client()
-        try:
-            await mark_order_paid(session=session, marz=marz, order=order)
-        except MarzbanError as exc:
-            logger.warning("Admin check: Marzban error for order %s: %s", order_id, exc)
-            await safe_answer_callback(call, "Оплата подтверждена, но Marzban недоступен.", show_alert=True)
-            return
-        finally:
-            await marz.close()
+        await mark_order_paid(session=session, order=order)
 
     await safe_answer_callback(call, "✅ Оплата подтверждена")
 
@@ -793,9 +943,7 @@ async def cb_admin_subs(call: CallbackQuery) -> None:
         return
     try:
         async with session_scope() as session:
-            exp_1 = await list_expiring_subscriptions(session, within_days=1)
-            exp_3 = await list_expiring_subscriptions(session, within_days=3)
-            exp_7 = await list_expiring_subscriptions(session, within_days=7)
+            buckets = await list_expiring_buckets(session, bounds_days=(1, 3, 7))
     except Exception:
         logger.exception("Admin subscriptions failed")
         await edit_message_text(call, "⚠️ Не удалось загрузить подписки.", reply_markup=admin_back_kb())
@@ -813,15 +961,17 @@ async def cb_admin_subs(call: CallbackQuery) -> None:
             )
         return lines
 
+    exp_1, exp_3, exp_7 = buckets[1], buckets[3], buckets[7]
     text = (
-        "📦 <b>Подписки (истекают)</b>\n\n"
+        "📦 <b>Подписки (истекают)</b>\n"
+        "<i>Напоминания за 3 дня и за 1 день уходят автоматически.</i>\n\n"
         + "\n".join(_render_block("≤ 1 день", exp_1))
         + "\n\n"
-        + "\n".join(_render_block("≤ 3 дня", exp_3))
+        + "\n".join(_render_block("1–3 дня", exp_3))
         + "\n\n"
-        + "\n".join(_render_block("≤ 7 дней", exp_7))
+        + "\n".join(_render_block("3–7 дней", exp_7))
     )
-    user_ids = list({user.id for _, user in exp_1 + exp_3 + exp_7})[:10]
+    user_ids = [user.id for _, user in exp_1 + exp_3 + exp_7][:10]
     reply_markup = admin_subs_kb(user_ids) if user_ids else admin_back_kb()
     await edit_message_text(call, text, reply_markup=reply_markup)
     await safe_answer_callback(call)
@@ -884,6 +1034,7 @@ async def cb_admin_subs_extend(call: CallbackQuery) -> None:
         session.add(sub)
         await session.commit()
         await session.refresh(sub)
+        await store_user_snapshot(user, sub)
         marz = _marzban_client()
         try:
             await sync_devices_expire(
@@ -975,8 +1126,8 @@ async def cb_admin_quality(call: CallbackQuery) -> None:
         if not (settings.happ_proxy_api_base and settings.happ_proxy_provider_code and settings.happ_proxy_auth_key):
             happ_status = "FAIL (не настроено)"
         else:
-            async with httpx.AsyncClient(base_url=settings.happ_proxy_api_base, timeout=5) as client:
-                resp = await client.get("/api/ping")
+            client = get_http_client("happ_proxy", settings.happ_proxy_api_base)
+            resp = await client.get("/api/ping", timeout=5)
             if resp.status_code == 200:
                 happ_status = "OK"
             else:
@@ -1086,7 +1237,7 @@ async def cb_admin_pending_check(call: CallbackQuery) -> None:
             if not (settings.yookassa_shop_id and settings.yookassa_secret_key):
                 await safe_answer_callback(call,"YooKassa не настроена", show_alert=True)
                 return
-            client = YooKassaClient(settings.yookassa_shop_id, settings.yookassa_secret_key)
+            client = get_yookassa_client()
             payment = await client.get_payment(order.provider_payment_id)
             if not is_yookassa_paid(payment.status):
                 await safe_answer_callback(call,"Оплата еще не подтверждена", show_alert=True)
@@ -1095,21 +1246,13 @@ async def cb_admin_pending_check(call: CallbackQuery) -> None:
             if not settings.cryptopay_token:
                 await safe_answer_callback(call,"CryptoPay не настроен", show_alert=True)
                 return
-            client = CryptoPayClient(settings.cryptopay_token)
+            client = get_cryptopay_client()
             invoice = await client.get_invoice(int(order.provider_payment_id))
             if not invoice or not is_cryptopay_paid(invoice.status):
                 await safe_answer_callback(call,"Оплата еще не подтверждена", show_alert=True)
                 return
 
-        marz = _marzban_client()
-        try:
-            await mark_order_paid(session=session, marz=marz, order=order)
-        except MarzbanError as exc:
-            logger.warning("Admin pending check: Marzban error for order %s: %s", order_id, exc)
-            await safe_answer_callback(call,"Оплата подтверждена, но Marzban недоступен.", show_alert=True)
-            return
-        finally:
-            await marz.close()
+        await mark_order_paid(session=session, order=order)
 
     await safe_answer_callback(call,"✅ Оплата подтверждена")
 
@@ -1,30 +1,30 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import json
 import os
 import math
-from decimal import Decimal, ROUND_UP
 from uuid import uuid4
 
 from aiogram import Bot, F, Router
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import CallbackQuery, Message, User
+from aiogram.types import CallbackQuery, Message
 
 from aiogram.types import LabeledPrice, PreCheckoutQuery
 from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..marzban.client import MarzbanClient
-from ..models import Order
-from ..services.orders import mark_order_paid
+from ..models import Order, Subscription, User
+from ..services.orders import accept_provider_payment, mark_order_paid
 from ..services.catalog import get_plan_option, plan_details_text, plan_options, plan_title
 from ..services.payments import (
-    CryptoPayClient,
-    YooKassaClient,
-    is_cryptopay_paid,
-    is_yookassa_paid,
+    get_cryptopay_client,
+    get_yookassa_client,
 )
-from ..services.payments.common import update_order_meta
+from ..services.payments.checks import check_provider_status, forget_provider_status, start_cooldown
+from ..services.payments.common import patch_order_meta
+from ..services.payments.rates import rub_to_asset_amount
 
 from ..config import settings
 from ..db import session_scope
@@ -33,8 +33,9 @@ from ..keyboards.orders import order_canceled_kb, order_payment_kb
 from ..keyboards.plans import plan_options_kb, plans_kb
 from ..services import create_subscription_order, get_order, get_or_create_subscription
 from ..services.devices import count_active_devices
+from ..services.snapshots import UserSnapshot
 from ..services.promos import promo_available_for_user, redeem_promo_to_balance, validate_promo_code
-from ..services.subscriptions import activate_trial, is_active
+from ..services.subscriptions import activate_trial
 from ..services.users import ensure_user
 from ..utils.text import fmt_dt, h, months_title
 from ..utils.telegram import edit_message_text, safe_answer_callback, send_html, send_html_with_photo
@@ -46,7 +47,13 @@ class BuyStates(StatesGroup):
 
 
 @router.message(BuyStates.promo_input)
-async def msg_promo_input(message: Message, state: FSMContext) -> None:
+async def msg_promo_input(
+    message: Message,
+    state: FSMContext,
+    session: AsyncSession,
+    db_user: User,
+    db_sub: Subscription,
+) -> None:
     raw_code = (message.text or "").strip()
     if not raw_code:
         await send_html(message, "Введите промокод:")
@@ -55,15 +62,17 @@ async def msg_promo_input(message: Message, state: FSMContext) -> None:
     if error:
         await send_html(message, h(error))
         return
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=message.from_user)
-        promo, error = await promo_available_for_user(session, code=code, user_id=user.id)
-        if not promo:
-            await send_html(message, "Промокод не найден или больше недоступен.")
-            await state.clear()
-            return
-        balance = await redeem_promo_to_balance(session, promo=promo, user=user)
-        sub = await get_or_create_subscription(session, user.id)
+    promo, error = await promo_available_for_user(session, code=code, user_id=db_user.id)
+    if not promo:
+        await send_html(message, "Промокод не найден или больше недоступен.")
+        await state.clear()
+        return
+    balance = await redeem_promo_to_balance(session, promo=promo, user=db_user)
+    if balance is None:
+        await send_html(message, "Промокод не найден или больше недоступен.")
+        await state.clear()
+        return
+    sub = db_sub
 
     await send_html(
         message,
@@ -77,18 +86,6 @@ async def msg_promo_input(message: Message, state: FSMContext) -> None:
 
 
 
-def _marzban_client() -> MarzbanClient:
-    return MarzbanClient(
-        base_url=str(settings.marzban_base_url),
-        username=settings.marzban_username,
-        password=settings.marzban_password,
-        verify_ssl=settings.marzban_verify_ssl,
-        api_prefix=settings.marzban_api_prefix,
-        default_inbounds={settings.marzban_proxy_type: [settings.marzban_inbound_tag]},
-        default_proxies={settings.marzban_proxy_type: {"flow": settings.reality_flow}},
-    )
-
-
 def _yookassa_enabled() -> bool:
     return bool(
         getattr(settings, "yookassa_shop_id", None)
@@ -130,34 +127,6 @@ def _stars_price(plan_code: str, months: int, price_rub: int) -> int:
     return max(1, int(math.ceil(price_rub * settings.stars_per_rub)))
 
 
-def _find_rate(rates: list[dict[str, str]], source: str, target: str) -> Decimal | None:
-    for rate in rates:
-        if rate.get("source") == source and rate.get("target") == target:
-            try:
-                return Decimal(str(rate.get("rate")))
-            except Exception:
-                return None
-    return None
-
-
-async def _cryptopay_amount_rub(
-    client: CryptoPayClient, *, amount_rub: int, asset: str
-) -> str:
-    rates = await client.get_exchange_rates()
-    rate = _find_rate(rates, asset, "RUB")
-    if rate is None:
-        rate_usd = _find_rate(rates, asset, "USD")
-        usd_rub = _find_rate(rates, "USD", "RUB")
-        if rate_usd is not None and usd_rub is not None:
-            rate = rate_usd * usd_rub
-    if rate is None or rate <= 0:
-        raise ValueError("crypto_rate_unavailable")
-    amount_asset = (Decimal(amount_rub) / rate).quantize(Decimal("0.000001"), rounding=ROUND_UP)
-    if amount_asset <= 0:
-        raise ValueError("crypto_amount_invalid")
-    return format(amount_asset.normalize(), "f")
-
-
 def _plan_choice_text(code: str, months: int, *, final_price: int | None = None, discount: int = 0) -> str:
     opt = get_plan_option(code, months)
     if code == "trial":
@@ -189,30 +158,25 @@ def _plans_menu_text() -> str:
 
 
 async def _notify_admins(bot: Bot, text: str, reply_markup=None) -> None:
+    # Different chats: no per-chat limit between them, and a handful stays far below the global one
+    await asyncio.gather(
+        *(bot.send_message(admin_id, text, reply_markup=reply_markup) for admin_id in settings.admin_id_list),
+        return_exceptions=True,
+    )
 
-    for admin_id in settings.admin_id_list:
-        try:
-            await bot.send_message(admin_id, text, reply_markup=reply_markup)
-        except Exception:
-            pass
-
-async def _get_order_for_user(session, order_id: int, user: User) -> Order | None:
+async def _get_order_for_user(session, order_id: int, user_id: int) -> Order | None:
     order = await get_order(session, order_id)
     if not order:
         return None
-    db_user = await ensure_user(session=session, tg_user=user)
-    if order.user_id != db_user.id:
+    if order.user_id != user_id:
         return None
     return order
 
 
 
-@router.message(Command("buy"))
-async def cmd_buy(message: Message) -> None:
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=message.from_user)
-        sub = await get_or_create_subscription(session, user.id)
-        include_trial = not sub.trial_used
+@router.message(Command("buy"), flags={"user_snapshot": True})
+async def cmd_buy(message: Message, snap: UserSnapshot) -> None:
+    include_trial = not snap.trial_used
     await send_html_with_photo(
         message,
         _plans_menu_text(),
@@ -220,26 +184,22 @@ async def cmd_buy(message: Message) -> None:
         photo_path=settings.start_photo_path,
     )
 
-@router.callback_query(F.data == "buy")
-async def cb_buy(call: CallbackQuery) -> None:
+@router.callback_query(F.data == "buy", flags={"user_snapshot": True})
+async def cb_buy(call: CallbackQuery, session: AsyncSession, snap: UserSnapshot) -> None:
     await safe_answer_callback(call)
     """
     Если подписка активна -> показываем хаб управления.
     Если не активна -> показываем тарифы.
     """
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        sub = await get_or_create_subscription(session, user.id)
-        devices_active = await count_active_devices(session, user.id)
-
-    if is_active(sub):
-        traffic_limit = _traffic_limit_gb(sub.plan_code)
+    if snap.has_active_subscription:
+        devices_active = await count_active_devices(session, snap.user_id)
+        traffic_limit = _traffic_limit_gb(snap.plan_code)
         await edit_message_text(
             call,
             "⚙️ <b>Управление подпиской</b>\n\n"
-            f"<b>ID:</b> <code>{user.tg_id}</code>\n"
-            f"<b>Баланс:</b> {user.balance_rub} ₽\n"
-            f"<b>Подписка до:</b> {fmt_dt(sub.expires_at)}\n"
+            f"<b>ID:</b> <code>{snap.tg_id}</code>\n"
+            f"<b>Баланс:</b> {snap.balance_rub} ₽\n"
+            f"<b>Подписка до:</b> {fmt_dt(snap.expires_at)}\n"
             f"<b>Трафик:</b> 0/{traffic_limit} GB\n"
             f"<b>Активных устройств:</b> {devices_active}\n\n"
             "Выберите действие 👇",
@@ -250,16 +210,13 @@ async def cb_buy(call: CallbackQuery) -> None:
     await edit_message_text(
         call,
         _plans_menu_text(),
-        reply_markup=subscription_plans_kb(include_trial=not sub.trial_used),
+        reply_markup=subscription_plans_kb(include_trial=not snap.trial_used),
     )
 
-@router.callback_query(F.data == "buy:plans")
-async def cb_buy_plans(call: CallbackQuery) -> None:
+@router.callback_query(F.data == "buy:plans", flags={"user_snapshot": True})
+async def cb_buy_plans(call: CallbackQuery, snap: UserSnapshot) -> None:
     await safe_answer_callback(call)
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        sub = await get_or_create_subscription(session, user.id)
-    await edit_message_text(call, _plans_menu_text(), reply_markup=subscription_plans_kb(include_trial=not sub.trial_used))
+    await edit_message_text(call, _plans_menu_text(), reply_markup=subscription_plans_kb(include_trial=not snap.trial_used))
 
 
 @router.callback_query(F.data == "buy:promo")
@@ -269,8 +226,8 @@ async def cb_buy_promo(call: CallbackQuery, state: FSMContext) -> None:
     await edit_message_text(call, "Введите промокод:", reply_markup=promo_input_kb())
 
 
-@router.callback_query(F.data.startswith("plan_group:"))
-async def cb_plan_group(call: CallbackQuery, state: FSMContext) -> None:
+@router.callback_query(F.data.startswith("plan_group:"), flags={"user_snapshot": True})
+async def cb_plan_group(call: CallbackQuery, state: FSMContext, snap: UserSnapshot) -> None:
     await safe_answer_callback(call)
     parts = call.data.split(":")
     if len(parts) != 2:
@@ -278,10 +235,7 @@ async def cb_plan_group(call: CallbackQuery, state: FSMContext) -> None:
     _, code = parts
     options = [opt for opt in plan_options(include_trial=False) if opt.code == code]
     if not options:
-        async with session_scope() as session:
-            user = await ensure_user(session=session, tg_user=call.from_user)
-            sub = await get_or_create_subscription(session, user.id)
-        await edit_message_text(call, "Тариф не найден.", reply_markup=subscription_plans_kb(include_trial=not sub.trial_used))
+        await edit_message_text(call, "Тариф не найден.", reply_markup=subscription_plans_kb(include_trial=not snap.trial_used))
         return
     data = await state.get_data()
     discount_rub = int(data.get("promo_discount_rub") or 0)
@@ -300,7 +254,13 @@ async def cb_plan_group(call: CallbackQuery, state: FSMContext) -> None:
 
 
 @router.callback_query(F.data.startswith("plan:"))
-async def cb_plan(call: CallbackQuery, bot: Bot, state: FSMContext) -> None:
+async def cb_plan(
+    call: CallbackQuery,
+    bot: Bot,
+    state: FSMContext,
+    session: AsyncSession,
+    db_user: User,
+) -> None:
     await safe_answer_callback(call)
     parts = call.data.split(":")
     action = None
@@ -313,58 +273,45 @@ async def cb_plan(call: CallbackQuery, bot: Bot, state: FSMContext) -> None:
     free_activation = False
     new_exp = None
 
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        if user.is_banned:
-            await edit_message_text(
-                call,
-                "⛔️ Доступ к боту ограничен.",
-                reply_markup=subscription_plans_kb(),
-            )
+    user = db_user
+    if code == "trial":
+        ok, reason = await activate_trial(session, user)
+        if not ok:
+            await edit_message_text(call, h(reason), reply_markup=plans_kb(include_trial=False))
             return
 
-        if code == "trial":
-            ok, reason = await activate_trial(session, user)
-            if not ok:
-                await edit_message_text(call, h(reason), reply_markup=plans_kb(include_trial=False))
-                return
-
-            await edit_message_text(call, _plan_choice_text(code, months), reply_markup=trial_activated_kb())
-            return
+        await edit_message_text(call, _plan_choice_text(code, months), reply_markup=trial_activated_kb())
+        return
 
-        opt = get_plan_option(code, months)
-        data = await state.get_data()
-        promo_discount_rub = int(data.get("promo_discount_rub") or 0)
-        promo_id = data.get("promo_id")
-        promo_code = data.get("promo_code")
-        final_price = max(0, opt.price_rub - promo_discount_rub) if promo_discount_rub else opt.price_rub
-        meta = {}
-        if promo_id:
-            meta = {
-                "promo_id": promo_id,
-                "promo_code": promo_code,
-                "promo_discount_rub": promo_discount_rub,
-                "price_rub_original": opt.price_rub,
-            }
-        order = await create_subscription_order(
-            session,
-            user.id,
-            code,
-            months,
-            amount_rub=final_price,
-            payment_method="manual",
-            provider="manual",
-            action=action,
-            meta=meta or None,
-        )
-        sub = await get_or_create_subscription(session, user.id)
-        if order.amount_rub <= 0:
-            marz = _marzban_client()
-            try:
-                new_exp, _ = await mark_order_paid(session=session, marz=marz, order=order)
-                free_activation = True
-            finally:
-                await marz.close()
+    opt = get_plan_option(code, months)
+    data = await state.get_data()
+    promo_discount_rub = int(data.get("promo_discount_rub") or 0)
+    promo_id = data.get("promo_id")
+    promo_code = data.get("promo_code")
+    final_price = max(0, opt.price_rub - promo_discount_rub) if promo_discount_rub else opt.price_rub
+    meta = {}
+    if promo_id:
+        meta = {
+            "promo_id": promo_id,
+            "promo_code": promo_code,
+            "promo_discount_rub": promo_discount_rub,
+            "price_rub_original": opt.price_rub,
+        }
+    order = await create_subscription_order(
+        session,
+        user.id,
+        code,
+        months,
+        amount_rub=final_price,
+        payment_method="manual",
+        provider="manual",
+        action=action,
+        meta=meta or None,
+    )
+    sub = await get_or_create_subscription(session, user.id)
+    if order.amount_rub <= 0:
+        new_exp, _ = await mark_order_paid(session=session, order=order)
+        free_activation = True
 
     await state.clear()
     text = _plan_choice_text(code, months, final_price=final_price, discount=promo_discount_rub)
@@ -418,7 +365,7 @@ async def cb_plan(call: CallbackQuery, bot: Bot, state: FSMContext) -> None:
 
 
 @router.callback_query(F.data.startswith("pay:yookassa:"))
-async def cb_pay_yookassa(call: CallbackQuery) -> None:
+async def cb_pay_yookassa(call: CallbackQuery, db_user: User) -> None:
     await safe_answer_callback(call)
     if not _yookassa_enabled():
         await edit_message_text(call, "YooKassa не настроена.", reply_markup=order_canceled_kb())
@@ -426,7 +373,7 @@ async def cb_pay_yookassa(call: CallbackQuery) -> None:
 
     order_id = int(call.data.split(":", 2)[2])
     async with session_scope() as session:
-        order = await _get_order_for_user(session, order_id, call.from_user)
+        order = await _get_order_for_user(session, order_id, db_user.id)
         if not order:
             await edit_message_text(call, "Заказ не найден.", reply_markup=order_canceled_kb())
             return
@@ -437,10 +384,8 @@ async def cb_pay_yookassa(call: CallbackQuery) -> None:
         if order.provider == "yookassa" and order.pay_url:
             pay_url = order.pay_url
         else:
-            shop_id = getattr(settings, "yookassa_shop_id", None)
-            secret_key = getattr(settings, "yookassa_secret_key", None)
             return_url = getattr(settings, "yookassa_return_url", None)
-            client = YooKassaClient(shop_id, secret_key)
+            client = get_yookassa_client()
             try:
                 payment = await client.create_payment(
                     amount_rub=order.amount_rub,
@@ -465,9 +410,10 @@ async def cb_pay_yookassa(call: CallbackQuery) -> None:
             order.pay_url = pay_url
             order.amount = f"{order.amount_rub:.2f}"
             order.currency = "RUB"
-            order.raw_provider_payload = json.dumps(payment.raw, ensure_ascii=False)
+            order.raw_provider_payload = payment.raw
             order.payment_method = "yookassa"
-            update_order_meta(
+            await patch_order_meta(
+                session,
                 order,
                 {
                     "yookassa_payment_id": payment.payment_id,
@@ -489,7 +435,7 @@ async def cb_pay_yookassa(call: CallbackQuery) -> None:
 
 
 @router.callback_query(F.data.startswith("pay:cryptopay:"))
-async def cb_pay_cryptopay(call: CallbackQuery) -> None:
+async def cb_pay_cryptopay(call: CallbackQuery, db_user: User) -> None:
     await safe_answer_callback(call)
     if not _cryptopay_enabled():
         await edit_message_text(call,"Crypto Pay не настроен.", show_alert=True)
@@ -497,7 +443,7 @@ async def cb_pay_cryptopay(call: CallbackQuery) -> None:
 
     order_id = int(call.data.split(":", 2)[2])
     async with session_scope() as session:
-        order = await _get_order_for_user(session, order_id, call.from_user)
+        order = await _get_order_for_user(session, order_id, db_user.id)
         if not order:
             await edit_message_text(call,"Заказ не найден", show_alert=True)
             return
@@ -508,17 +454,15 @@ async def cb_pay_cryptopay(call: CallbackQuery) -> None:
         if order.provider == "cryptopay" and order.pay_url:
             pay_url = order.pay_url
         else:
-            cryptopay_token = getattr(settings, "cryptopay_token", None)
-            client = CryptoPayClient(cryptopay_token)
+            client = get_cryptopay_client()
             payload = json.dumps(
                 {"order_id": order.id, "tg_id": call.from_user.id, "plan_code": order.plan_code, "months": order.months},
                 ensure_ascii=False,
             )
             try:
-                amount = await _cryptopay_amount_rub(
-                    client,
-                    amount_rub=order.amount_rub,
-                    asset=getattr(settings, "cryptopay_asset", "USDT"),
+                amount = await rub_to_asset_amount(
+                    order.amount_rub,
+                    getattr(settings, "cryptopay_asset", "USDT"),
                 )
             except Exception:
                 logger.exception("Failed to resolve CryptoPay rate for order %s", order.id)
@@ -543,9 +487,10 @@ async def cb_pay_cryptopay(call: CallbackQuery) -> None:
             order.pay_url = pay_url
             order.amount = amount
             order.currency = settings.cryptopay_asset
-            order.raw_provider_payload = json.dumps(invoice.raw, ensure_ascii=False)
+            order.raw_provider_payload = invoice.raw
             order.payment_method = "cryptopay"
-            update_order_meta(
+            await patch_order_meta(
+                session,
                 order,
                 {
                     "cryptopay_invoice_id": invoice.invoice_id,
@@ -568,70 +513,56 @@ async def cb_pay_cryptopay(call: CallbackQuery) -> None:
 
 
 @router.callback_query(F.data.startswith("check:"))
-async def cb_check_payment(call: CallbackQuery) -> None:
-    await safe_answer_callback(call)
+async def cb_check_payment(call: CallbackQuery, db_user: User) -> None:
     order_id = int(call.data.split(":", 1)[1])
     async with session_scope() as session:
-        order = await _get_order_for_user(session, order_id, call.from_user)
+        order = await _get_order_for_user(session, order_id, db_user.id)
         if not order:
+            await safe_answer_callback(call)
             await edit_message_text(call, "Заказ не найден.", reply_markup=order_canceled_kb())
             return
+        if order.status == "paid":
+            # Usually the webhook got here first.
+            sub = await get_or_create_subscription(session, db_user.id)
+            await safe_answer_callback(call)
+            await edit_message_text(
+                call,
+                f"✅ Оплата подтверждена!\nПодписка активирована до: {fmt_dt(sub.expires_at)}\nЗаказ #{order_id}",
+            )
+            return
         if order.status != "pending":
+            await safe_answer_callback(call)
             await edit_message_text(call, "Заказ уже обработан.")
             return
-
-        provider = order.provider
-        if provider == "cryptopay":
-            if not _cryptopay_enabled():
-                await edit_message_text(call, "Crypto Pay не настроен.")
-                return
-            invoice_id = order.provider_payment_id
-            if not invoice_id:
-                await edit_message_text(call, "Счет не найден.")
-                return
-            cryptopay_token = getattr(settings, "cryptopay_token", None)
-            client = CryptoPayClient(cryptopay_token)
-            invoice = await client.get_invoice(int(invoice_id))
-            try:
-                invoice = await client.get_invoice(int(invoice_id))
-            except Exception:
-                logger.exception("Failed to fetch CryptoPay invoice %s", invoice_id)
-                await edit_message_text(call,"Не удалось проверить оплату. Попробуйте позже.", show_alert=True)
-                return
-            if not invoice or not is_cryptopay_paid(invoice.status):
-                await edit_message_text(call,"Оплата еще не подтверждена.", show_alert=True)
-                return
-            order.raw_provider_payload = json.dumps(invoice.raw, ensure_ascii=False)
-        elif provider == "yookassa":
-            if not _yookassa_enabled():
-                await edit_message_text(call,"YooKassa не настроена.", show_alert=True)
-                return
-            payment_id = order.provider_payment_id
-            if not payment_id:
-                await edit_message_text(call,"Платеж не найден.", show_alert=True)
-                return
-            shop_id = getattr(settings, "yookassa_shop_id", None)
-            secret_key = getattr(settings, "yookassa_secret_key", None)
-            client = YooKassaClient(shop_id, secret_key)
-            try:
-                payment = await client.get_payment(str(payment_id))
-            except Exception:
-                logger.exception("Failed to fetch YooKassa payment %s", payment_id)
-                await edit_message_text(call,"Не удалось проверить оплату. Попробуйте позже.", show_alert=True)
-                return
-            if not is_yookassa_paid(payment.status):
-                await edit_message_text(call,"Оплата еще не подтверждена.", show_alert=True)
-                return
-            order.raw_provider_payload = json.dumps(payment.raw, ensure_ascii=False)
-        else:
-            await edit_message_text(call,"Автоплатеж для заказа не настроен.", show_alert=True)
+        if order.provider not in {"cryptopay", "yookassa"}:
+            await safe_answer_callback(call, "Автоплатеж для заказа не настроен.", show_alert=True)
             return
 
-        marz = _marzban_client()
-        try:
-            new_exp, _ = await mark_order_paid(session=session, marz=marz, order=order)
-        finally:
-            await marz.close()
+    # The provider call runs without a DB connection held, so a burst of taps does not drain the pool
+    wait_seconds = await start_cooldown(db_user.id)
+    try:
+        status = await check_provider_status(order, allow_fetch=not wait_seconds)
+    except Exception:
+        logger.exception("Failed to check {} payment for order {}", order.provider, order_id)
+        await safe_answer_callback(call, "Не удалось проверить оплату. Попробуйте позже.", show_alert=True)
+        return
+    if status is None:
+        await safe_answer_callback(call, f"Проверка уже выполнялась, повторите через {wait_seconds} сек.")
+        return
+    if not status.paid:
+        await safe_answer_callback(call, "Оплата еще не подтверждена.", show_alert=True)
+        return
+
+    await safe_answer_callback(call)
+    async with session_scope() as session:
+        order = await _get_order_for_user(session, order_id, db_user.id)
+        if not order or not await accept_provider_payment(
+            session, order, provider=order.provider, provider_id=order.provider_payment_id, raw_payload=status.raw
+        ):
+            await edit_message_text(call, "Заказ уже обработан.")
+            return
+        new_exp, _ = await mark_order_paid(session=session, order=order)
+        await forget_provider_status(order.id)
 
     await edit_message_text(
         call,
@@ -795,16 +726,6 @@ async def stars_successful_payment(message: Message, bot: Bot) -> None:
         await message.answer("Оплата получена, но пользователь не совпадает. Напишите в поддержку.")
         return
 
-    marz = MarzbanClient(
-        base_url=str(settings.marzban_base_url),
-        username=settings.marzban_username,
-        password=settings.marzban_password,
-        verify_ssl=settings.marzban_verify_ssl,
-        api_prefix=settings.marzban_api_prefix,
-        default_inbounds={settings.marzban_proxy_type: [settings.marzban_inbound_tag]},
-        default_proxies={settings.marzban_proxy_type: {"flow": settings.reality_flow}},
-    )
-
     async with session_scope() as session:
         order = await get_order(session, order_id)
         if not order:
@@ -826,15 +747,12 @@ async def stars_successful_payment(message: Message, bot: Bot) -> None:
         order.provider_payment_id = sp.telegram_payment_charge_id
         order.currency = sp.currency or "XTR"
         order.amount = str(sp.total_amount)
-        order.raw_provider_payload = json.dumps(sp.model_dump(), ensure_ascii=False)
-        update_order_meta(order, {"telegram_payment_charge_id": sp.telegram_payment_charge_id})
+        order.raw_provider_payload = sp.model_dump(mode="json")
+        await patch_order_meta(session, order, {"telegram_payment_charge_id": sp.telegram_payment_charge_id})
         session.add(order)
         await session.commit()
 
-        try:
-            new_exp, notes = await mark_order_paid(session=session, marz=marz, order=order)
-        finally:
-            await marz.close()
+        new_exp, notes = await mark_order_paid(session=session, order=order)
             
     await message.answer(
         f"✅ Оплата Stars прошла успешно!\n"
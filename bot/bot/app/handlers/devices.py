@@ -13,6 +13,7 @@ from aiogram.types import (
 
 from ..config import settings
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 from ..db import session_scope
 from ..keyboards.devices import (
@@ -26,7 +27,7 @@ from ..keyboards.nav import nav_kb
 from loguru import logger
 
 from ..marzban.client import MarzbanClient, MarzbanError
-from ..models import Device
+from ..models import Device, Subscription, User
 from ..services.devices import (
     DEVICE_TYPES,
     count_active_devices,
@@ -37,13 +38,13 @@ from ..services.devices import (
     list_devices,
     rename_device,
 )
+from ..services.snapshots import UserSnapshot
 from ..services.subscriptions import get_or_create_subscription, is_active
 from ..services.users import ensure_user
-from ..services.happ_proxy import HappProxyConfig, _with_install_id, add_install_code
-from ..services.happ_connect import build_happ_links
+from ..services.device_links import get_device_links
 from ..utils.connect_messages import build_auto_connect_message
 from ..utils.text import h
-from ..utils.urls import build_public_url, is_http_url, mask_url, sanitize_inline_url
+from ..utils.urls import build_public_url, is_http_url, sanitize_inline_url
 from ..utils.connect import create_connect_token
 from ..utils.telegram import edit_message_text, safe_answer_callback, send_html_with_photo
 
@@ -170,101 +171,15 @@ def _connect_actions_kb(
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-def _happ_proxy_cfg() -> HappProxyConfig | None:
-    if not (settings.happ_proxy_api_base and settings.happ_proxy_provider_code and settings.happ_proxy_auth_key):
-        return None
-    return HappProxyConfig(
-        api_base=settings.happ_proxy_api_base,
-        provider_code=settings.happ_proxy_provider_code,
-        auth_key=settings.happ_proxy_auth_key,
-    )
-
-
-async def _resolve_device_urls(device) -> tuple[str | None, str | None]:
-    if not device.marzban_username:
-        return None, None
-    marz = _marzban_client()
-    try:
-        link, subscription_url = await get_device_connection_links(marz, device.marzban_username)
-    finally:
-        await marz.close()
-    return link, subscription_url
-
-
-async def _ensure_install_code(session, device, *, install_limit: int) -> str | None:
-    cfg = _happ_proxy_cfg()
-    if not cfg:
-        return None
-    if device.happ_install_code:
-        return device.happ_install_code
-    install_code = await add_install_code(
-        cfg,
-        install_limit=install_limit,
-        note=f"user={device.user_id} dev={device.id}",
-    )
-    device.happ_install_code = install_code
-    session.add(device)
-    await session.commit()
-    return install_code
-
-
 async def _build_connect_links(
     session,
     device,
     *,
     install_limit: int,
 ) -> tuple[str | None, str | None, str | None]:
-    link, subscription_url = await _resolve_device_urls(device)
-    base_url = subscription_url if is_http_url(subscription_url) else None
-    if not base_url:
-        return None, None, link
-    try:
-        install_code = await _ensure_install_code(session, device, install_limit=install_limit)
-    except Exception:
-        install_code = None
-    limited_url = _with_install_id(base_url, install_code) if install_code else base_url
-    try:
-        _, crypt_url = await build_happ_links(limited_url)
-    except Exception:
-        crypt_url = None
-    logger.debug(
-        "Connect links resolved device_id={} plain_url={} crypt_url={}",
-        device.id,
-        mask_url(limited_url),
-        mask_url(crypt_url),
-    )
-    return limited_url, crypt_url, link
-
-
-async def _build_happ_connect_links(
-    session,
-    device,
-    *,
-    install_limit: int,
-    marz: MarzbanClient,
-) -> tuple[str | None, str | None, str | None]:
-    link, subscription_url = await get_device_connection_links(marz, device.marzban_username)
-    base_url = subscription_url if is_http_url(subscription_url) else None
-    if not base_url:
-        return None, None, link
-    try:
-        install_code = await _ensure_install_code(session, device, install_limit=install_limit)
-    except Exception:
-        install_code = None
-    limited_url = _with_install_id(base_url, install_code) if install_code else base_url
-    try:
-        plain_url, crypt_url = await build_happ_links(limited_url)
-        logger.debug(
-            "Happ connect links resolved device_id={} plain_url={} crypt_url={}",
-            device.id,
-            mask_url(plain_url),
-            mask_url(crypt_url),
-        )
-        return plain_url, crypt_url, link
-    except Exception:
-        return limited_url, None, link
-
-
+    """(subscription_url, crypt_url, vless_link) from the shared, pre-warmed cache."""
+    links = await get_device_links(session, device, install_limit=install_limit)
+    return links.subscription_url, links.crypt_url, links.link
 
 
 async def _show_connect_screen(call_or_message, *, device_id: int) -> None:
@@ -355,22 +270,20 @@ def _type_title(device_type: str) -> str:
     return DEVICE_TYPES.get(device_type, device_type)
 
 
-async def _show_devices(call_or_message, *, user_id: int) -> None:
+async def _show_devices(call_or_message, *, session: AsyncSession, user_id: int, devices_limit: int) -> None:
     if isinstance(call_or_message, CallbackQuery):
         await safe_answer_callback(call_or_message)
-    async with session_scope() as session:
-        sub = await get_or_create_subscription(session, user_id)
-        devices = await list_devices(session, user_id)
+    devices = await list_devices(session, user_id)
 
     active_devices = [d for d in devices if d.status != "deleted"]
-    can_add = len(active_devices) < sub.devices_limit
+    can_add = len(active_devices) < devices_limit
     lines = [
         f"• <b>{h(display_label(d))}</b> — {h(_type_title(d.device_type))}"
         for d in active_devices
     ]
     text = (
         "📱 <b>Ваши устройства</b>\n\n"
-        f"Лимит по тарифу: <b>{sub.devices_limit}</b>\n\n"
+        f"Лимит по тарифу: <b>{devices_limit}</b>\n\n"
         "<b>Список устройств:</b>\n"
         + ("\n".join(lines) if lines else "—")
         + "\n\n"
@@ -390,19 +303,15 @@ async def _show_devices(call_or_message, *, user_id: int) -> None:
         )
 
 
-@router.message(Command("devices"))
-async def cmd_devices(message: Message) -> None:
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=message.from_user)
-    await _show_devices(message, user_id=user.id)
+@router.message(Command("devices"), flags={"user_snapshot": True})
+async def cmd_devices(message: Message, session: AsyncSession, snap: UserSnapshot) -> None:
+    await _show_devices(message, session=session, user_id=snap.user_id, devices_limit=snap.devices_limit)
 
 
-@router.callback_query(F.data == "devices")
-async def cb_devices(call: CallbackQuery) -> None:
+@router.callback_query(F.data == "devices", flags={"user_snapshot": True})
+async def cb_devices(call: CallbackQuery, session: AsyncSession, snap: UserSnapshot) -> None:
     await safe_answer_callback(call)
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-    await _show_devices(call, user_id=user.id)
+    await _show_devices(call, session=session, user_id=snap.user_id, devices_limit=snap.devices_limit)
 
 
 @router.callback_query(F.data.startswith("dev:view:"))
@@ -429,12 +338,16 @@ async def cb_device_view(call: CallbackQuery) -> None:
 
 
 @router.callback_query(F.data == "dev:add")
-async def cb_add_device(call: CallbackQuery, state: FSMContext) -> None:
+async def cb_add_device(
+    call: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+    db_user: User,
+    db_sub: Subscription,
+) -> None:
     await safe_answer_callback(call)
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        sub = await get_or_create_subscription(session, user.id)
-        devices = await list_devices(session, user.id)
+    user, sub = db_user, db_sub
+    devices = await list_devices(session, user.id)
 
     if not is_active(sub):
         await edit_message_text(
@@ -451,7 +364,7 @@ async def cb_add_device(call: CallbackQuery, state: FSMContext) -> None:
             "Лимит устройств исчерпан. Удалите или заморозьте старое устройство, чтобы добавить новое.",
             show_alert=True,
         )
-        await cb_devices(call)
+        await cb_devices(call, session, UserSnapshot.from_models(db_user, db_sub))
         return
 
     hint = ""
@@ -530,12 +443,10 @@ async def cb_choose_type(call: CallbackQuery, state: FSMContext) -> None:
                 )
                 await call.answer()
                 return
-            plain_url, crypt_url, vless_link = await _build_happ_connect_links(
+            plain_url, crypt_url, vless_link = await _build_connect_links(
                 session,
                 device,
                 install_limit=sub.devices_limit,
-                marz=marz,
-
             )
         finally:
             await marz.close()
@@ -2,31 +2,24 @@
 
 from aiogram import F
 from aiogram.filters import Command, CommandStart
-from aiogram.types import CallbackQuery, FSInputFile, Message
+from aiogram.types import CallbackQuery, Message
 from aiogram import Router
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..config import settings
-from ..db import session_scope
 from ..keyboards.main import main_menu
 from ..keyboards.onboarding import onboarding_continue_kb, onboarding_finish_kb, onboarding_start_kb
-from ..services.subscriptions import is_active
-from ..services import get_or_create_subscription
-from ..services.users import ensure_user
-from ..utils.text import h
+from ..models import Subscription, User
+from ..services.snapshots import UserSnapshot, invalidate_user_snapshot
+from ..utils.assets import answer_photo_asset
+from ..utils.text import parse_start_ref
 from ..utils.telegram import edit_message_text, safe_answer_callback, send_html, send_html_with_photo
 
 router = Router()
 
 
 def _parse_ref(message: Message) -> str | None:
-    if not message.text:
-        return None
-    if " " not in message.text:
-        return None
-    _, arg = message.text.split(" ", 1)
-    if arg.startswith("ref_"):
-        return arg.replace("ref_", "", 1)
-    return None
+    return parse_start_ref(message.text)
 
 def _main_menu_text(user) -> str:
     return (
@@ -36,21 +29,12 @@ def _main_menu_text(user) -> str:
         "Выберите действие ниже 👇"
     )
 
-@router.message(CommandStart())
-async def cmd_start(message: Message) -> None:
+@router.message(CommandStart(), flags={"user_snapshot": True})
+async def cmd_start(message: Message, snap: UserSnapshot) -> None:
+    # The referral code from the deep link is applied by UserContextMiddleware on user creation.
     ref = _parse_ref(message)
-
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=message.from_user, ref_code=ref)
-        if user.is_banned:
-            await message.answer(
-                "⛔️ Доступ к боту ограничен.\n"
-                "Если это ошибка — напишите в поддержку: " + h(settings.support_username)
-            )
-            return
-
-        sub = await get_or_create_subscription(session, user.id)
-        has_sub = is_active(sub)
+    user = snap
+    has_sub = snap.has_active_subscription
     if ref is None and not user.onboarding_done:
         text = (
             "Добро пожаловать в <b>Qdenzo Network</b> 👋\n\n"
@@ -62,9 +46,9 @@ async def cmd_start(message: Message) -> None:
         photo_path = settings.start_photo_path
         if photo_path:
             try:
-                photo = FSInputFile(str(photo_path))
-                await message.answer_photo(
-                    photo=photo,
+                await answer_photo_asset(
+                    message,
+                    photo_path,
                     caption=text,
                     reply_markup=onboarding_start_kb(),
                     parse_mode="HTML",
@@ -77,9 +61,9 @@ async def cmd_start(message: Message) -> None:
     photo_path = settings.start_photo_path
     if photo_path:
         try:
-            photo = FSInputFile(str(photo_path))
-            await message.answer_photo(
-                photo=photo,
+            await answer_photo_asset(
+                message,
+                photo_path,
                 caption=_main_menu_text(user),
                 reply_markup=main_menu(user.is_admin, has_subscription=has_sub),
                 parse_mode="HTML",
@@ -95,16 +79,12 @@ async def cmd_start(message: Message) -> None:
     )
 
 
-@router.message(Command("menu"))
-async def cmd_menu(message: Message) -> None:
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=message.from_user)
-        sub = await get_or_create_subscription(session, user.id)
-
+@router.message(Command("menu"), flags={"user_snapshot": True})
+async def cmd_menu(message: Message, snap: UserSnapshot) -> None:
     await send_html_with_photo(
         message,
-        _main_menu_text(user),
-        reply_markup=main_menu(user.is_admin, has_subscription=is_active(sub)),
+        _main_menu_text(snap),
+        reply_markup=main_menu(snap.is_admin, has_subscription=snap.has_active_subscription),
         photo_path=settings.start_photo_path,
     )
 
@@ -123,12 +103,9 @@ async def cb_onboarding_step2(call: CallbackQuery) -> None:
 
 
 @router.callback_query(F.data == "onb:3")
-async def cb_onboarding_step3(call: CallbackQuery) -> None:
+async def cb_onboarding_step3(call: CallbackQuery, session: AsyncSession, db_user: User, db_sub: Subscription) -> None:
     await safe_answer_callback(call)
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        sub = await get_or_create_subscription(session, user.id)
-        include_trial = not sub.trial_used
+    include_trial = not db_sub.trial_used
     text = (
         "Вы можете попробовать сервис бесплатно\n"
         "или перейти сразу в главное меню.\n\n"
@@ -136,8 +113,8 @@ async def cb_onboarding_step3(call: CallbackQuery) -> None:
         "стабильность и скорость подключения."
     )
     await edit_message_text(call, text, reply_markup=onboarding_finish_kb(include_trial=include_trial))
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        user.onboarding_done = True
-        session.add(user)
-        await session.commit()
\ No newline at end of file
+    if not db_user.onboarding_done:
+        db_user.onboarding_done = True
+        session.add(db_user)
+        await session.commit()
+        await invalidate_user_snapshot(db_user.tg_id)
\ No newline at end of file
@@ -10,16 +10,14 @@ from aiogram.filters import Command
 from aiogram.types import CallbackQuery, Message
 
 from sqlalchemy import desc, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..db import session_scope
 from ..keyboards.nav import nav_kb
 from ..keyboards.plans import plan_groups_kb, plan_options_kb
 from ..keyboards.subscription import subscription_kb
-from ..models import Order
-from ..services import get_or_create_subscription
+from ..models import Order, Subscription, User
 from ..services.catalog import list_plan_options_by_code, plan_details_text, plan_options, plan_title
 from ..services.devices import count_active_devices
-from ..services.users import ensure_user
 from ..utils.telegram import edit_message_text, safe_answer_callback, send_html_with_photo
 from ..utils.text import fmt_dt, h
 
@@ -42,11 +40,9 @@ def _remaining(expires_at: datetime | None) -> str:
 
 
 @router.message(Command('sub'))
-async def cmd_sub(message: Message) -> None:
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=message.from_user)
-        sub = await get_or_create_subscription(session, user.id)
-        used = await count_active_devices(session, user.id)
+async def cmd_sub(message: Message, session: AsyncSession, db_user: User, db_sub: Subscription) -> None:
+    sub = db_sub
+    used = await count_active_devices(session, db_user.id)
 
     text = (
         "📦 <b>Ваша подписка</b>\n\n"
@@ -67,12 +63,10 @@ async def cmd_sub(message: Message) -> None:
 
 
 @router.callback_query(F.data == 'sub')
-async def cb_sub(call: CallbackQuery) -> None:
+async def cb_sub(call: CallbackQuery, session: AsyncSession, db_user: User, db_sub: Subscription) -> None:
     await safe_answer_callback(call)
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        sub = await get_or_create_subscription(session, user.id)
-        used = await count_active_devices(session, user.id)
+    sub = db_sub
+    used = await count_active_devices(session, db_user.id)
 
     text = (
         "📦 <b>Ваша подписка</b>\n\n"
@@ -89,11 +83,9 @@ async def cb_sub(call: CallbackQuery) -> None:
     
 
 @router.callback_query(F.data == 'sub:renew')
-async def cb_sub_renew(call: CallbackQuery) -> None:
+async def cb_sub_renew(call: CallbackQuery, db_sub: Subscription) -> None:
     await safe_answer_callback(call)
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        sub = await get_or_create_subscription(session, user.id)
+    sub = db_sub
 
     options = [opt for opt in list_plan_options_by_code(sub.plan_code) if opt.months > 0]
     text = (
@@ -111,11 +103,9 @@ async def cb_sub_renew(call: CallbackQuery) -> None:
 
 
 @router.callback_query(F.data == 'sub:change')
-async def cb_sub_change(call: CallbackQuery) -> None:
+async def cb_sub_change(call: CallbackQuery, db_sub: Subscription) -> None:
     await safe_answer_callback(call)
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        sub = await get_or_create_subscription(session, user.id)
+    sub = db_sub
 
     text = (
         f"🛠 <b>Сменить тариф</b>\n\n"
@@ -138,15 +128,13 @@ async def cb_sub_change(call: CallbackQuery) -> None:
 
 
 @router.callback_query(F.data.startswith("plan_group:change:"))
-async def cb_sub_change_group(call: CallbackQuery) -> None:
+async def cb_sub_change_group(call: CallbackQuery, db_sub: Subscription) -> None:
     await safe_answer_callback(call)
     parts = call.data.split(":")
     if len(parts) != 3:
         return
     _, _, code = parts
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        sub = await get_or_create_subscription(session, user.id)
+    sub = db_sub
 
     if code == sub.plan_code:
         await safe_answer_callback(call, "Этот тариф уже активен", show_alert=True)
@@ -171,14 +159,12 @@ async def cb_sub_change_group(call: CallbackQuery) -> None:
     await safe_answer_callback(call)
 
 @router.callback_query(F.data == 'sub:history')
-async def cb_sub_history(call: CallbackQuery) -> None:
+async def cb_sub_history(call: CallbackQuery, session: AsyncSession, db_user: User) -> None:
     await safe_answer_callback(call)
-    async with session_scope() as session:
-        user = await ensure_user(session=session, tg_user=call.from_user)
-        q = await session.execute(
-            select(Order).where(Order.user_id == user.id).order_by(desc(Order.created_at)).limit(10)
-        )
-        orders = list(q.scalars().all())
+    q = await session.execute(
+        select(Order).where(Order.user_id == db_user.id).order_by(desc(Order.created_at)).limit(10)
+    )
+    orders = list(q.scalars().all())
 
     if not orders:
         text = "История оплат пока пуста."
@@ -5,15 +5,14 @@ from __future__ import annotations
 from aiogram import F, Router
 from aiogram.filters import Command
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..config import settings
 from ..utils.telegram import edit_message_text, safe_answer_callback, send_html_with_photo
-from ..db import session_scope
 from ..keyboards.nav import nav_kb
 from ..keyboards.support import support_kb
 from ..services.devices import count_active_devices
-from ..services.subscriptions import get_or_create_subscription, is_active
-from ..services.users import get_user_by_tg_id
+from ..services.snapshots import UserSnapshot
 
 router = Router()
 
@@ -62,22 +61,16 @@ async def cb_support_chat(call: CallbackQuery) -> None:
 
 
 
-@router.callback_query(F.data == 'support:diag')
-async def cb_support_diag(call: CallbackQuery) -> None:
+@router.callback_query(F.data == 'support:diag', flags={'user_snapshot': True})
+async def cb_support_diag(call: CallbackQuery, session: AsyncSession, snap: UserSnapshot) -> None:
     await safe_answer_callback(call)
-    async with session_scope() as session:
-        user = await get_user_by_tg_id(session, call.from_user.id)
-        if not user:
-            await safe_answer_callback(call, 'Сначала /start', show_alert=True)
-            return
-        sub = await get_or_create_subscription(session, user.id)
-        devices_active = await count_active_devices(session, user.id)
-
-    sub_status = '✅ активна' if is_active(sub) else '⛔️ не активна'
+    devices_active = await count_active_devices(session, snap.user_id)
+
+    sub_status = '✅ активна' if snap.has_active_subscription else '⛔️ не активна'
     text = (
         "<b>🩺 Диагностика</b>\n\n"
         f"Подписка: {sub_status}\n"
-        f"Лимит устройств: <b>{sub.devices_limit}</b>\n"
+        f"Лимит устройств: <b>{snap.devices_limit}</b>\n"
         f"Активных устройств: <b>{devices_active}</b>\n\n"
         "Если подписка не активна — перейдите в <b>Купить</b>.\n"
         "Если конфиг не работает — проверьте статус устройства и повторно импортируйте ссылку."
@@ -4,7 +4,7 @@ from __future__ import annotations
 
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
-from ..models import Order
+from ..models import Broadcast, Order
 from ..services.catalog import PlanOption, plan_title
 from ..utils.text import months_title
 
@@ -16,6 +16,7 @@ def admin_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text='💳 Платежи', callback_data='admin:payments')],
         [InlineKeyboardButton(text='📦 Подписки', callback_data='admin:subs')],
         [InlineKeyboardButton(text='🎟 Промокоды', callback_data='admin:promos')],
+        [InlineKeyboardButton(text='📣 Рассылки', callback_data='admin:bc')],
         [InlineKeyboardButton(text='📈 Трафик', callback_data='admin:traffic')],
         [InlineKeyboardButton(text='🧪 Качество', callback_data='admin:quality')],
         [InlineKeyboardButton(text='⚙️ Настройки', callback_data='admin:settings')],
@@ -182,4 +183,52 @@ def admin_subs_kb(user_ids: list[int]) -> InlineKeyboardMarkup:
             InlineKeyboardButton(text='+30д', callback_data=f'admin:subs_extend:{user_id}:30'),
         ])
     rows.append([InlineKeyboardButton(text='⬅️ Назад', callback_data='admin:menu')])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
\ No newline at end of file
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def admin_broadcasts_kb(jobs: list[Broadcast]) -> InlineKeyboardMarkup:
+    rows: list[list[InlineKeyboardButton]] = []
+    for job in jobs:
+        rows.append([InlineKeyboardButton(text=f'#{job.id} {job.status}', callback_data=f'admin:bc:job:{job.id}')])
+    rows.append([InlineKeyboardButton(text='➕ Новая рассылка', callback_data='admin:bc:new')])
+    rows.append([InlineKeyboardButton(text='⬅️ Назад', callback_data='admin:menu')])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def admin_broadcast_segments_kb(plan_codes: list[str]) -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton(text='👥 Все', callback_data='admin:bc:seg:all')],
+        [
+            InlineKeyboardButton(text='⏳ Истекают ≤ 3 дн.', callback_data='admin:bc:seg:expiring:3'),
+            InlineKeyboardButton(text='≤ 7 дн.', callback_data='admin:bc:seg:expiring:7'),
+        ],
+        [InlineKeyboardButton(text='💤 Без активной подписки', callback_data='admin:bc:seg:inactive')],
+    ]
+    rows.append([
+        InlineKeyboardButton(text=f'Тариф {plan_title(code)}', callback_data=f'admin:bc:seg:plan:{code}')
+        for code in plan_codes
+    ])
+    rows.append([InlineKeyboardButton(text='⬅️ Назад', callback_data='admin:bc')])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def admin_broadcast_confirm_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text='🚀 Запустить', callback_data='admin:bc:start'),
+            InlineKeyboardButton(text='❌ Отмена', callback_data='admin:bc'),
+        ],
+    ])
+
+
+def admin_broadcast_kb(job: Broadcast) -> InlineKeyboardMarkup:
+    rows: list[list[InlineKeyboardButton]] = []
+    if job.status == 'running':
+        rows.append([InlineKeyboardButton(text='⏸ Пауза', callback_data=f'admin:bc:pause:{job.id}')])
+    elif job.status == 'paused':
+        rows.append([InlineKeyboardButton(text='▶️ Продолжить', callback_data=f'admin:bc:resume:{job.id}')])
+    if job.status in ('running', 'paused'):
+        rows.append([InlineKeyboardButton(text='🛑 Остановить', callback_data=f'admin:bc:cancel:{job.id}')])
+    rows.append([InlineKeyboardButton(text='🔄 Обновить', callback_data=f'admin:bc:job:{job.id}')])
+    rows.append([InlineKeyboardButton(text='⬅️ Назад', callback_data='admin:bc')])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
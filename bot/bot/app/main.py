@@ -3,6 +3,7 @@
 from __future__ import annotations
 
 import asyncio
+import signal
 
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
@@ -10,9 +11,14 @@ from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.client.default import DefaultBotProperties
 from loguru import logger
 
+from .cache import InvalidationListener, close_redis
 from .config import settings
 from .db import init_db, session_scope
 from .marzban.client import MarzbanClient
+from .middlewares import DbBudgetMiddleware, UserContextMiddleware
+from .services.payments.rates import get_rates_cache
+from .utils.http import close_http_clients, start_http_clients
+from .utils.urls import build_public_url, mask_url
 
 # Handlers
 from .handlers.start import router as start_router
@@ -27,7 +33,22 @@ from .handlers.faq import router as faq_router
 from .handlers.admin import router as admin_router
 from .handlers.navigation import router as nav_router
 from .handlers.fallback import router as fallback_router
-from .webhooks import start_webhook_server, stop_webhook_server
+from .webhooks import (
+    start_metrics_server,
+    start_webhook_server,
+    start_webhook_workers,
+    stop_webhook_server,
+    stop_webhook_workers,
+)
+from .services.broadcasts import get_send_bucket, run_broadcasts, wait_for_broadcast_work
+from .services.device_links import close_device_links
+from .services.happ_install_pool import pool_enabled, refill_install_pool, wait_for_pool_work
+from .services.notifications import NotificationListener
+from .services.tg_updates import UpdateShardPool, webhook_secret
+from .services.outbox import dispatch_marzban_outbox, wait_for_outbox_work
+from .services.reconciler import reconcile_pending_orders
+from .services.reminders import send_expiry_reminders
+from .services.referral_counters import backfill_referral_counters_if_empty, recompute_referral_counters
 from .services.traffic import collect_traffic_snapshots
 
 
@@ -35,6 +56,16 @@ def _build_dp() -> Dispatcher:
     storage = RedisStorage.from_url(settings.redis_url)
     dp = Dispatcher(storage=storage)
 
+    if settings.db_profiling_enabled:
+        db_budget = DbBudgetMiddleware()
+        dp.message.middleware(db_budget)
+        dp.callback_query.middleware(db_budget)
+        dp.pre_checkout_query.middleware(db_budget)
+
+    user_context = UserContextMiddleware()
+    dp.message.middleware(user_context)
+    dp.callback_query.middleware(user_context)
+
     # Order matters: more specific first
     dp.include_router(start_router)
     dp.include_router(buy_router)
@@ -54,25 +85,106 @@ def _build_dp() -> Dispatcher:
 async def main() -> None:
     logger.info('Starting {brand} bot...', brand=settings.brand_name)
     await init_db()
+    try:
+        async with session_scope() as session:
+            await backfill_referral_counters_if_empty(session)
+    except Exception as exc:
+        logger.warning("Referral counters backfill failed: {}", exc)
 
     bot = Bot(
         token=settings.bot_token,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
     dp = _build_dp()
-    webhook_runner = await start_webhook_server()
+    start_http_clients()
+    if settings.cryptopay_token:
+        get_rates_cache().start()
+    webhook_workers = webhook_runner = metrics_runner = None
+    if settings.webhook_embedded:
+        webhook_workers = await start_webhook_workers()
+        webhook_runner = await start_webhook_server()
+    else:
+        # Outbox, broadcasts, reminders, update queue... are counted in this process
+        metrics_runner = await start_metrics_server(settings.metrics_port)
+    notification_listener = NotificationListener(bot)
+    notification_listener.start()
+    invalidation_listener = InvalidationListener()
+    invalidation_listener.start()
     traffic_task = None
     if settings.traffic_collect_enabled:
         traffic_task = asyncio.create_task(_traffic_collector_loop())
+    outbox_task = asyncio.create_task(_outbox_dispatcher_loop())
+    broadcast_task = asyncio.create_task(_broadcast_loop(bot))
+    reminders_task = None
+    if settings.reminders_enabled:
+        reminders_task = asyncio.create_task(_reminders_loop(bot))
+    install_pool_task = None
+    if pool_enabled():
+        install_pool_task = asyncio.create_task(_install_pool_loop())
+    reconcile_task = None
+    if settings.reconcile_enabled and (settings.cryptopay_token or settings.yookassa_shop_id):
+        reconcile_task = asyncio.create_task(_reconcile_loop())
+    referral_task = None
+    if settings.referral_counters_recompute_hours > 0:
+        referral_task = asyncio.create_task(_referral_counters_loop())
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if settings.telegram_mode == "webhook":
+            await _serve_webhook_updates(bot, dp)
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
         if traffic_task:
             traffic_task.cancel()
+        if reconcile_task:
+            reconcile_task.cancel()
+        if referral_task:
+            referral_task.cancel()
+        outbox_task.cancel()
+        broadcast_task.cancel()
+        if reminders_task:
+            reminders_task.cancel()
+        if install_pool_task:
+            install_pool_task.cancel()
+        await notification_listener.stop()
+        await invalidation_listener.stop()
         await stop_webhook_server(webhook_runner)
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await stop_webhook_workers(webhook_workers)
+        await close_device_links()
+        await get_rates_cache().stop()
+        await close_http_clients()
+        await close_redis()
         await bot.session.close()
 
 
+async def _serve_webhook_updates(bot: Bot, dp: Dispatcher) -> None:
+    """Webhook mode: Telegram posts to the HTTP server, this replica handles its share of the shards."""
+    url = settings.telegram_webhook_url or build_public_url(settings.telegram_webhook_path)
+    if not url:
+        raise RuntimeError("TELEGRAM_MODE=webhook needs PUBLIC_BASE_URL or TELEGRAM_WEBHOOK_URL")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    pool = UpdateShardPool(bot, dp)
+    await pool.start()
+    # Every replica sets the same webhook; the call is idempotent
+    await bot.set_webhook(
+        url,
+        secret_token=webhook_secret(),
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=settings.telegram_webhook_max_connections,
+    )
+    logger.info("Telegram webhook mode: {}", mask_url(url))
+    try:
+        await stop.wait()
+    finally:
+        await pool.stop()
+
+
 async def _traffic_collector_loop() -> None:
     interval = max(300, settings.traffic_collect_interval_seconds)
     while True:
@@ -95,5 +207,91 @@ async def _traffic_collector_loop() -> None:
             logger.warning("Traffic collector failed: %s", exc)
         await asyncio.sleep(interval)
 
+
+async def _outbox_dispatcher_loop() -> None:
+    marz = MarzbanClient(
+        base_url=str(settings.marzban_base_url),
+        username=settings.marzban_username,
+        password=settings.marzban_password,
+        verify_ssl=settings.marzban_verify_ssl,
+        api_prefix=settings.marzban_api_prefix,
+        default_inbounds={settings.marzban_proxy_type: [settings.marzban_inbound_tag]},
+        default_proxies={settings.marzban_proxy_type: {"flow": settings.reality_flow}},
+    )
+    try:
+        while True:
+            try:
+                async with session_scope() as session:
+                    stats = await dispatch_marzban_outbox(session, marz)
+                if stats.get("done", 0) + stats.get("retry", 0) + stats.get("dead", 0):
+                    logger.info("Marzban outbox pass: {}", dict(stats))
+                    continue
+            except Exception as exc:
+                logger.warning("Marzban outbox dispatcher failed: {}", exc)
+            await wait_for_outbox_work(settings.marzban_outbox_poll_seconds)
+    finally:
+        await marz.close()
+
+
+async def _install_pool_loop() -> None:
+    while True:
+        try:
+            async with session_scope() as session:
+                added = await refill_install_pool(session)
+            if added:
+                logger.info("Happ install pool refilled: {}", dict(added))
+        except Exception as exc:
+            logger.warning("Happ install pool refill failed: {}", exc)
+        await wait_for_pool_work(max(5.0, settings.happ_install_pool_check_seconds))
+
+
+async def _broadcast_loop(bot: Bot) -> None:
+    bucket = get_send_bucket()
+    while True:
+        try:
+            async with session_scope() as session:
+                if await run_broadcasts(session, bot, bucket):
+                    continue
+        except Exception as exc:
+            logger.warning("Broadcast runner failed: {}", exc)
+        await wait_for_broadcast_work(30.0)
+
+
+async def _reminders_loop(bot: Bot) -> None:
+    interval = max(60, settings.reminders_interval_seconds)
+    while True:
+        try:
+            async with session_scope() as session:
+                stats = await send_expiry_reminders(session, bot, get_send_bucket())
+            if stats:
+                logger.info("Expiry reminders: {}", stats)
+        except Exception as exc:
+            logger.warning("Expiry reminders failed: {}", exc)
+        await asyncio.sleep(interval)
+
+
+async def _reconcile_loop() -> None:
+    interval = max(60, settings.reconcile_interval_seconds)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with session_scope() as session:
+                stats = await reconcile_pending_orders(session)
+            if stats.get("paid") or stats.get("expired") or stats.get("failed"):
+                logger.info("Reconcile pass: {}", dict(stats))
+        except Exception as exc:
+            logger.warning("Pending orders reconcile failed: {}", exc)
+
+
+async def _referral_counters_loop() -> None:
+    interval = max(1, settings.referral_counters_recompute_hours) * 3600
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with session_scope() as session:
+                await recompute_referral_counters(session)
+        except Exception as exc:
+            logger.warning("Referral counters recompute failed: {}", exc)
+
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Minimal in-process metrics exported in the Prometheus text format.
+
+Only what the bot needs (counters, gauges, histograms with labels) so we do
+not pull prometheus_client into the image. Values are per process; scrape
+every instance separately.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Awaitable, Callable, Iterable
+
+from loguru import logger
+
+_LabelKey = tuple[tuple[str, str], ...]
+
+_registry: list["_Metric"] = []
+_collectors: list[Callable[[], Awaitable[None]]] = []
+
+
+def _key(labels: dict[str, object]) -> _LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(key: _LabelKey, extra: Iterable[tuple[str, str]] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + body + "}"
+
+
+def _fmt_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help = help_text
+        _registry.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        super().__init__(name, help_text)
+        self._values: dict[_LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = _key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: object) -> float:
+        return self._values.get(_key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_fmt_labels(k)} {_fmt_value(v)}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        super().__init__(name, help_text)
+        self._values: dict[_LabelKey, float] = {}
+
+    def set(self, value: float, **labels: object) -> None:
+        self._values[_key(labels)] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = _key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: object) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_fmt_labels(k)} {_fmt_value(v)}" for k, v in self._values.items()]
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: dict[_LabelKey, list[int]] = {}
+        self._sums: dict[_LabelKey, float] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = _key(labels)
+        counts = self._counts.setdefault(key, [0] * len(self.buckets))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def samples(self) -> list[str]:
+        lines: list[str] = []
+        for key, counts in self._counts.items():
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, [('le', _fmt_value(bound))])} {count}")
+            lines.append(f"{self.name}_sum{_fmt_labels(key)} {_fmt_value(self._sums[key])}")
+            lines.append(f"{self.name}_count{_fmt_labels(key)} {counts[-1]}")
+        return lines
+
+
+def register_collector(fn: Callable[[], Awaitable[None]]) -> None:
+    """Register a coroutine that refreshes gauges right before each scrape."""
+    if fn not in _collectors:
+        _collectors.append(fn)
+
+
+async def render_metrics() -> str:
+    for collect in _collectors:
+        try:
+            await collect()
+        except Exception as exc:
+            logger.warning("Metrics collector {} failed: {}", getattr(collect, "__name__", collect), exc)
+    return "\n".join(m.render() for m in _registry) + "\n"
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+from .db_budget import DbBudgetMiddleware, handler_db_stats
+from .user_context import UserContextMiddleware
+
+__all__ = ["DbBudgetMiddleware", "UserContextMiddleware", "handler_db_stats"]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from loguru import logger
+
+from ..config import settings
+from ..db.profiling import start_tracking, stop_tracking
+
+
+@dataclass
+class HandlerDbStats:
+    calls: int = 0
+    queries: int = 0
+    rows: int = 0
+    db_time_ms: float = 0.0
+    max_queries: int = 0
+    over_budget: int = 0
+
+
+# In-process aggregates per handler, e.g. for admin diagnostics.
+_HANDLER_STATS: dict[str, HandlerDbStats] = {}
+
+
+def handler_db_stats() -> dict[str, HandlerDbStats]:
+    return dict(_HANDLER_STATS)
+
+
+def _handler_name(data: Dict[str, Any]) -> str:
+    handler = data.get("handler")
+    callback = getattr(handler, "callback", None)
+    if callback is None:
+        return "unknown"
+    module = getattr(callback, "__module__", "") or ""
+    name = getattr(callback, "__qualname__", None) or getattr(callback, "__name__", "handler")
+    return f"{module.rsplit('.', 1)[-1]}.{name}" if module else name
+
+
+def _short_sql(statement: str, limit: int = 160) -> str:
+    sql = " ".join(statement.split())
+    return sql if len(sql) <= limit else sql[: limit - 3] + "..."
+
+
+class DbBudgetMiddleware(BaseMiddleware):
+    """Counts SQL queries, rows and DB time for every handled update.
+
+    Registered as an inner middleware, so the resolved handler is known
+    and overruns are attributed to it.
+    """
+
+    def __init__(
+        self,
+        *,
+        query_budget: int | None = None,
+        time_budget_ms: int | None = None,
+        n_plus_one_threshold: int | None = None,
+    ) -> None:
+        self.query_budget = query_budget if query_budget is not None else settings.db_query_budget
+        self.time_budget_ms = time_budget_ms if time_budget_ms is not None else settings.db_time_budget_ms
+        self.n_plus_one_threshold = (
+            n_plus_one_threshold if n_plus_one_threshold is not None else settings.db_n_plus_one_threshold
+        )
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        stats, token = start_tracking()
+        try:
+            return await handler(event, data)
+        finally:
+            stop_tracking(token)
+            self._report(_handler_name(data), stats)
+
+    def _report(self, name: str, stats) -> None:
+        agg = _HANDLER_STATS.setdefault(name, HandlerDbStats())
+        agg.calls += 1
+        agg.queries += stats.queries
+        agg.rows += stats.rows
+        agg.db_time_ms += stats.db_time_ms
+        agg.max_queries = max(agg.max_queries, stats.queries)
+
+        over_queries = self.query_budget > 0 and stats.queries > self.query_budget
+        over_time = self.time_budget_ms > 0 and stats.db_time_ms > self.time_budget_ms
+        if over_queries or over_time:
+            agg.over_budget += 1
+            logger.warning(
+                "DB budget exceeded in {handler}: queries={q}/{qb} rows={rows} db_time={t:.1f}/{tb}ms",
+                handler=name,
+                q=stats.queries,
+                qb=self.query_budget,
+                rows=stats.rows,
+                t=stats.db_time_ms,
+                tb=self.time_budget_ms,
+            )
+
+        if self.n_plus_one_threshold > 1:
+            for statement, count in stats.repeated(self.n_plus_one_threshold):
+                logger.warning(
+                    "Possible N+1 in {handler}: statement repeated {n} times: {sql}",
+                    handler=name,
+                    n=count,
+                    sql=_short_sql(statement),
+                )
+
+        logger.debug(
+            "DB stats {handler}: queries={q} rows={rows} db_time={t:.1f}ms",
+            handler=name,
+            q=stats.queries,
+            rows=stats.rows,
+            t=stats.db_time_ms,
+        )
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from ..config import settings
+from ..db import session_scope
+from ..services.snapshots import get_user_snapshot, store_user_snapshot
+from ..services.subscriptions import get_or_create_subscription
+from ..services.users import ensure_user
+from ..utils.telegram import safe_answer_callback
+from ..utils.text import h, parse_start_ref
+
+BANNED_TEXT = (
+    "⛔️ Доступ к боту ограничен.\n"
+    "Если это ошибка — напишите в поддержку: "
+)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """One DB session per update with the User and Subscription preloaded.
+
+    Injects `session`, `db_user` and `db_sub` into handler data and blocks
+    banned users before the handler runs. Handlers can opt out with
+    `flags={"user_context": False}`.
+
+    Handlers flagged with `user_snapshot=True` receive `snap` (a cached
+    UserSnapshot) instead; on a Redis hit no query is made at all and
+    `session` is only connected if the handler uses it.
+
+    Registered as an inner middleware: the handler (and its flags) is
+    already resolved, so updates that match nothing cost no queries.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        tg_user = data.get("event_from_user")
+        if tg_user is None or tg_user.is_bot or get_flag(data, "user_context", default=True) is False:
+            return await handler(event, data)
+
+        ref_code = parse_start_ref(event.text) if isinstance(event, Message) else None
+        wants_snapshot = bool(get_flag(data, "user_snapshot", default=False))
+
+        if wants_snapshot:
+            snap = await get_user_snapshot(tg_user.id)
+            if snap is not None and snap.matches_profile(tg_user):
+                if snap.is_banned and tg_user.id not in settings.admin_id_list:
+                    await _deny(event)
+                    return None
+                async with session_scope() as session:
+                    data["session"] = session
+                    data["snap"] = snap
+                    return await handler(event, data)
+
+        async with session_scope() as session:
+            user = await ensure_user(session=session, tg_user=tg_user, ref_code=ref_code)
+            if user.is_banned and tg_user.id not in settings.admin_id_list:
+                await _deny(event)
+                return None
+            sub = await get_or_create_subscription(session, user.id)
+            # Give the pooled connection back while the handler talks to Telegram;
+            # the session autobegins again on the next query.
+            if session.in_transaction():
+                await session.commit()
+
+            data["session"] = session
+            data["db_user"] = user
+            data["db_sub"] = sub
+            if wants_snapshot:
+                data["snap"] = await store_user_snapshot(user, sub)
+            return await handler(event, data)
+
+
+async def _deny(event: TelegramObject) -> None:
+    text = BANNED_TEXT + h(settings.support_username)
+    if isinstance(event, CallbackQuery):
+        await safe_answer_callback(event, text, show_alert=True)
+    elif isinstance(event, Message):
+        await event.answer(text)
@@ -4,7 +4,8 @@ from __future__ import annotations
 
 from datetime import datetime
 
-from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Integer, String, Text, func
+from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Integer, String, Text, UniqueConstraint, func
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -105,9 +106,9 @@ class Order(Base):
 
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     paid_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
-    raw_provider_payload: Mapped[str | None] = mapped_column(Text, nullable=True)
+    raw_provider_payload: Mapped[dict | None] = mapped_column(JSONB, nullable=True)
 
-    meta_json: Mapped[str | None] = mapped_column(Text, nullable=True)
+    meta_json: Mapped[dict | None] = mapped_column(JSONB, nullable=True)
 
     referral_bonus_applied_seconds: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
 
@@ -129,7 +130,7 @@ class ReferralEvent(Base):
 
     reversed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
     reversal_reason: Mapped[str | None] = mapped_column(Text, nullable=True)
-    meta_json: Mapped[str | None] = mapped_column(Text, nullable=True)
+    meta_json: Mapped[dict | None] = mapped_column(JSONB, nullable=True)
 
     inviter: Mapped['User | None'] = relationship('User', foreign_keys=[inviter_id])
     referral_user: Mapped['User | None'] = relationship('User', foreign_keys=[referral_user_id])
@@ -153,6 +154,18 @@ class ReferralWindow(Base):
     inviter: Mapped['User'] = relationship('User')
 
 
+class ReferralCounter(Base):
+    """Denormalized per-inviter totals so the referral screen never scans invitees/events."""
+
+    __tablename__ = 'referral_counters'
+
+    inviter_id: Mapped[int] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    invited_count: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    # Net of reversed events: equals SUM(applied_seconds) over non-reversed referral_events.
+    lifetime_applied_seconds: Mapped[int] = mapped_column(BigInteger, nullable=False, server_default='0')
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
 
 class TrafficSnapshot(Base):
     __tablename__ = 'traffic_snapshots'
@@ -182,6 +195,7 @@ class Promo(Base):
 
 class PromoRedemption(Base):
     __tablename__ = 'promo_redemptions'
+    __table_args__ = (UniqueConstraint('promo_id', 'user_id', name='ux_promo_redemptions_promo_user'),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     promo_id: Mapped[int] = mapped_column(ForeignKey('promos.id', ondelete='CASCADE'), nullable=False)
@@ -191,4 +205,95 @@ class PromoRedemption(Base):
 
     promo: Mapped['Promo'] = relationship('Promo')
     user: Mapped['User'] = relationship('User')
-    order: Mapped['Order | None'] = relationship('Order')
\ No newline at end of file
+    order: Mapped['Order | None'] = relationship('Order')
+
+class WebhookEvent(Base):
+    """One row per provider event; the unique key is the DB-level dedup guard for webhooks."""
+
+    __tablename__ = 'webhook_events'
+    __table_args__ = (UniqueConstraint('provider', 'event_id', name='ux_webhook_events_provider_event'),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    provider: Mapped[str] = mapped_column(String(32), nullable=False)
+    event_id: Mapped[str] = mapped_column(String(128), nullable=False)
+    # received -> processed; stays 'received' while retries are pending
+    status: Mapped[str] = mapped_column(String(16), nullable=False, server_default='received')
+    received_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    processed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+
+class MarzbanOutbox(Base):
+    """Pending Marzban user updates written in the same transaction as the DB change.
+
+    Applied by services/outbox.py; rows for the same username are coalesced
+    into one API call.
+    """
+
+    __tablename__ = 'marzban_outbox'
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    user_id: Mapped[int | None] = mapped_column(ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    marzban_username: Mapped[str] = mapped_column(String(128), nullable=False)
+    # fields for MarzbanClient.update_user, e.g. {"expire": 1700000000} / {"status": "disabled"}
+    payload: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    status: Mapped[str] = mapped_column(String(16), nullable=False, server_default='pending')  # pending/done/dead
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    processed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+
+class HappInstallCode(Base):
+    """Pre-allocated Happ-Proxy install codes, one pool per install_limit tier.
+
+    Filled by services/happ_install_pool.py; a device claims a free row
+    (device_id is NULL) instead of calling /api/add-install itself.
+    """
+
+    __tablename__ = 'happ_install_codes'
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    install_limit: Mapped[int] = mapped_column(Integer, nullable=False)
+    code: Mapped[str] = mapped_column(String(64), nullable=False, unique=True)
+    device_id: Mapped[int | None] = mapped_column(ForeignKey('devices.id', ondelete='SET NULL'), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    claimed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+
+class Broadcast(Base):
+    """Admin mass message; sent by services/broadcasts.py from `cursor_user_id` upwards."""
+
+    __tablename__ = 'broadcasts'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    created_by: Mapped[int] = mapped_column(BigInteger, nullable=False)  # admin tg_id
+    # all / expiring (arg = days) / plan (arg = plan code) / inactive
+    segment: Mapped[str] = mapped_column(String(16), nullable=False)
+    segment_arg: Mapped[str | None] = mapped_column(String(32), nullable=True)
+    text: Mapped[str] = mapped_column(Text, nullable=False)
+    status: Mapped[str] = mapped_column(String(16), nullable=False, server_default='running')  # running/paused/done/cancelled
+    total: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    cursor_user_id: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    sent: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    blocked: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    failed: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    lease_until: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+
+class SubscriptionReminder(Base):
+    """Expiry reminder already sent (claimed) for one expiry date; the unique key prevents duplicates."""
+
+    __tablename__ = 'subscription_reminders'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'kind', 'expires_at', name='ux_subscription_reminders_user_kind_expiry'),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    kind: Mapped[str] = mapped_column(String(16), nullable=False)  # 3d / 1d / expired
+    # A renewal moves expires_at, so the next period gets its own reminders
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    sent_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
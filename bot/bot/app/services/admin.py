@@ -139,6 +139,23 @@ async def list_expiring_subscriptions(
     return list(q.all())
 
 
+async def list_expiring_buckets(
+    session: AsyncSession,
+    *,
+    bounds_days: tuple[int, ...] = (1, 3, 7),
+) -> dict[int, list[tuple[Subscription, User]]]:
+    """One query up to the largest bound, split into non-overlapping buckets: ≤1, 1–3, 3–7 days..."""
+    now = _now_utc()
+    bounds = sorted(bounds_days)
+    buckets: dict[int, list[tuple[Subscription, User]]] = {days: [] for days in bounds}
+    for sub, user in await list_expiring_subscriptions(session, within_days=bounds[-1]):
+        for days in bounds:
+            if sub.expires_at <= now + timedelta(days=days):
+                buckets[days].append((sub, user))
+                break
+    return buckets
+
+
 def chunked(items: Iterable, size: int) -> list[list]:
     bucket: list[list] = []
     current: list = []
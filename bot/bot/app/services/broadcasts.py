@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""Admin broadcasts: persistent jobs, SQL segments, rate-limited sending.
+
+A job (`broadcasts` row) is created from the admin menu with a segment and an
+HTML text; the runner in the bot process (`run_broadcasts`) then:
+
+- leases one running job at a time (lease_until, FOR UPDATE SKIP LOCKED),
+  so with several replicas the messages still go out through one sender;
+- walks the segment's users by keyset pagination on users.id from
+  `cursor_user_id`, never loading the whole audience;
+- sends through a token bucket (BROADCAST_RATE_PER_SECOND, below Telegram's
+  ~30 msg/s); every recipient is a different chat, so the per-chat limit is
+  never hit; TelegramRetryAfter stops the whole bucket for the requested
+  time and the message is sent again;
+- stores the cursor and counters after every page and re-reads the status,
+  so pause/resume/cancel from the admin menu take effect within a page and a
+  restart continues where it stopped (at most one page is sent twice).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from datetime import timedelta
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from loguru import logger
+from sqlalchemy import and_, exists, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..metrics import Counter
+from ..models import Broadcast, Subscription, User
+from .subscriptions import now_utc
+
+SEGMENTS = ("all", "expiring", "plan", "inactive")
+
+_LEASE_SECONDS = 120
+_SEND_ATTEMPTS = 5
+
+broadcast_messages = Counter("broadcast_messages_total", "Broadcast messages by outcome")
+
+_wakeup = asyncio.Event()
+_bucket: TokenBucket | None = None
+
+
+class TokenBucket:
+    """`rate` tokens per second, at most `burst` at once; `pause()` holds everyone back."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = max(0.1, rate)
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def get_send_bucket() -> TokenBucket:
+    """The process-wide bucket: everything bulk (broadcasts, reminders) shares Telegram's global limit."""
+    global _bucket
+    if _bucket is None:
+        rate = settings.broadcast_rate_per_second
+        _bucket = TokenBucket(rate, burst=max(1, int(rate)))
+    return _bucket
+
+
+def wake_broadcast_runner() -> None:
+    _wakeup.set()
+
+
+async def wait_for_broadcast_work(timeout: float) -> None:
+    try:
+        await asyncio.wait_for(_wakeup.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    _wakeup.clear()
+
+
+# ---- segments ----
+
+
+def _segment_filter(segment: str, arg: str | None):
+    now = now_utc()
+    active_sub = and_(
+        Subscription.user_id == User.id,
+        Subscription.expires_at.is_not(None),
+        Subscription.expires_at > now,
+    )
+    if segment == "all":
+        return None
+    if segment == "expiring":
+        days = int(arg or 3)
+        return exists().where(active_sub, Subscription.expires_at <= now + timedelta(days=days))
+    if segment == "plan":
+        return exists().where(active_sub, Subscription.plan_code == (arg or ""))
+    if segment == "inactive":
+        return ~exists().where(active_sub)
+    raise ValueError(f"unknown broadcast segment {segment!r}")
+
+
+def _audience(segment: str, arg: str | None):
+    stmt = select(User.id, User.tg_id).where(User.is_banned.is_(False))
+    cond = _segment_filter(segment, arg)
+    return stmt if cond is None else stmt.where(cond)
+
+
+async def count_audience(session: AsyncSession, segment: str, arg: str | None) -> int:
+    sub = _audience(segment, arg).subquery()
+    return int((await session.execute(select(func.count()).select_from(sub))).scalar_one())
+
+
+async def _next_page(session: AsyncSession, job: Broadcast, limit: int) -> list[tuple[int, int]]:
+    q = await session.execute(
+        _audience(job.segment, job.segment_arg)
+        .where(User.id > job.cursor_user_id)
+        .order_by(User.id)
+        .limit(limit)
+    )
+    return [(int(user_id), int(tg_id)) for user_id, tg_id in q.all()]
+
+
+# ---- jobs ----
+
+
+async def create_broadcast(
+    session: AsyncSession,
+    *,
+    created_by: int,
+    segment: str,
+    segment_arg: str | None,
+    text: str,
+) -> Broadcast:
+    job = Broadcast(
+        created_by=created_by,
+        segment=segment,
+        segment_arg=segment_arg,
+        text=text,
+        status="running",
+        total=await count_audience(session, segment, segment_arg),
+    )
+    session.add(job)
+    await session.commit()
+    await session.refresh(job)
+    wake_broadcast_runner()
+    return job
+
+
+async def list_broadcasts(session: AsyncSession, limit: int = 10) -> list[Broadcast]:
+    q = await session.execute(select(Broadcast).order_by(Broadcast.id.desc()).limit(limit))
+    return list(q.scalars().all())
+
+
+async def set_broadcast_status(session: AsyncSession, job_id: int, status: str) -> Broadcast | None:
+    """Pause (running -> paused), resume (paused -> running) or cancel a job."""
+    job = await session.get(Broadcast, job_id)
+    if job is None or job.status in ("done", "cancelled"):
+        return job
+    job.status = status
+    if status == "cancelled":
+        job.finished_at = now_utc()
+    session.add(job)
+    await session.commit()
+    if status == "running":
+        wake_broadcast_runner()
+    return job
+
+
+async def _lease_job(session: AsyncSession) -> Broadcast | None:
+    now = now_utc()
+    leased = select(Broadcast.id).where(Broadcast.status == "running", Broadcast.lease_until > now)
+    free = (
+        select(Broadcast.id)
+        .where(
+            Broadcast.status == "running",
+            or_(Broadcast.lease_until.is_(None), Broadcast.lease_until <= now),
+            ~exists(leased),  # one job at a time: they share Telegram's global limit
+        )
+        .order_by(Broadcast.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    res = await session.execute(
+        update(Broadcast)
+        .where(Broadcast.id == free.scalar_subquery())
+        .values(lease_until=now + timedelta(seconds=_LEASE_SECONDS))
+        .returning(Broadcast)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )
+    job = res.scalar_one_or_none()
+    await session.commit()
+    return job
+
+
+async def send_limited(bot: Bot, bucket: TokenBucket, tg_id: int, text: str, reply_markup: Any = None) -> str:
+    """Send through the bucket; returns "sent", "blocked" (bot blocked / user gone) or "failed"."""
+    for _ in range(_SEND_ATTEMPTS):
+        await bucket.acquire()
+        try:
+            await bot.send_message(tg_id, text, reply_markup=reply_markup, disable_web_page_preview=True)
+            return "sent"
+        except TelegramRetryAfter as exc:
+            logger.warning("Broadcast flood control: retry after {}s", exc.retry_after)
+            bucket.pause(exc.retry_after + 1)
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest:
+            return "failed"
+        except Exception as exc:
+            logger.warning("Broadcast send to {} failed: {}", tg_id, exc)
+            return "failed"
+    return "failed"
+
+
+async def _run_job(session: AsyncSession, bot: Bot, job: Broadcast, bucket: TokenBucket) -> None:
+    page_size = max(1, settings.broadcast_page_size)
+    in_flight = asyncio.Semaphore(max(1, settings.broadcast_concurrency))
+
+    async def one(tg_id: int) -> str:
+        async with in_flight:
+            return await send_limited(bot, bucket, tg_id, job.text)
+
+    while True:
+        await session.refresh(job)
+        if job.status != "running":
+            job.lease_until = None
+            break
+        page = await _next_page(session, job, page_size)
+        if not page:
+            job.status = "done"
+            job.finished_at = now_utc()
+            job.lease_until = None
+            break
+        results = await asyncio.gather(*(one(tg_id) for _, tg_id in page))
+        counts = {r: results.count(r) for r in ("sent", "blocked", "failed")}
+        for result, n in counts.items():
+            if n:
+                broadcast_messages.inc(n, result=result)
+        # Atomic increments: the admin may pause/cancel concurrently, status is left alone.
+        await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == job.id)
+            .values(
+                cursor_user_id=page[-1][0],
+                sent=Broadcast.sent + counts["sent"],
+                blocked=Broadcast.blocked + counts["blocked"],
+                failed=Broadcast.failed + counts["failed"],
+                lease_until=now_utc() + timedelta(seconds=_LEASE_SECONDS),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    session.add(job)
+    await session.commit()
+    logger.info(
+        "Broadcast #{} {}: sent={} blocked={} failed={}", job.id, job.status, job.sent, job.blocked, job.failed
+    )
+
+
+async def run_broadcasts(session: AsyncSession, bot: Bot, bucket: TokenBucket) -> bool:
+    """Run the next leased job to its end or pause; False when there was nothing to do."""
+    job = await _lease_job(session)
+    if job is None:
+        return False
+    logger.info("Broadcast #{} started from user_id>{} ({} recipients)", job.id, job.cursor_user_id, job.total)
+    await _run_job(session, bot, job, bucket)
+    return True
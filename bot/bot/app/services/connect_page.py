@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""Cached rendering of the /connect/{token}[/{platform}] page.
+
+A page hit costs a token HMAC check, a dict lookup and a string join:
+
+- the per-device links (VLESS link, subscription URL, Happ link) come from
+  the shared device links cache (services/device_links.py), usually
+  pre-warmed on device events; the rendered bundle is kept in process for
+  CONNECT_CACHE_SECONDS and misses are single-flight per device;
+- the page shell is precompiled once per platform; tabs switch on the client,
+  so changing the platform costs no request at all;
+- every response carries an ETag (bundle digest + platform + shell version)
+  and Cache-Control, so repeated opens are answered with 304.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import html
+import time
+from dataclasses import dataclass
+
+from ..cache import on_invalidate
+from ..config import settings
+from ..db import session_scope
+from ..metrics import Counter
+from ..models import Device
+from .device_links import close_device_links, get_device_links, invalidate_device_links
+from .subscriptions import get_or_create_subscription
+
+connect_hits = Counter("connect_page_total", "/connect bundle lookups by source")
+
+PLATFORMS: tuple[tuple[str, str], ...] = (
+    ("android", "Android"),
+    ("ios", "iOS"),
+    ("windows", "Windows"),
+    ("macos", "macOS"),
+    ("linux", "Linux"),
+)
+
+_LOCAL_MAX = 10_000
+
+
+@dataclass(frozen=True, slots=True)
+class ConnectBundle:
+    user_id: int
+    link: str | None
+    subscription_url: str | None
+    crypt_url: str | None
+    fragment: str
+    digest: str
+
+    @classmethod
+    def build(cls, user_id: int, link: str | None, subscription_url: str | None, crypt_url: str | None) -> "ConnectBundle":
+        fragment = _bundle_html(link, subscription_url, crypt_url)
+        digest = hashlib.sha1(fragment.encode("utf-8")).hexdigest()[:16]
+        return cls(user_id, link, subscription_url, crypt_url, fragment, digest)
+
+
+# ---- page shells ----
+
+_STYLE = (
+    "body{font-family:Arial,sans-serif;padding:24px;max-width:720px;margin:0 auto}"
+    ".btn{display:inline-block;margin:6px 6px 6px 0;padding:10px 14px;background:#1f6feb;color:#fff;"
+    "text-decoration:none;border-radius:6px}"
+    ".tab.on{background:#0b3d91}"
+    ".section{margin-top:18px}"
+    "code{word-break:break-all;white-space:pre-wrap}"
+)
+
+_SCRIPT = """<script>
+(function(){
+  var tabs=document.querySelectorAll('[data-p]');
+  function show(p){
+    var el=document.getElementById('i-'+p);
+    if(!el)return false;
+    document.querySelectorAll('.instr').forEach(function(s){s.hidden=s!==el;});
+    tabs.forEach(function(t){t.classList.toggle('on',t.getAttribute('data-p')===p);});
+    var base=location.pathname.replace(/\\/+$/,'');
+    if(/\\/(android|ios|windows|macos|linux)$/.test(base))base=base.replace(/\\/[^\\/]+$/,'');
+    history.replaceState(null,'',base+'/'+p);
+    return true;
+  }
+  tabs.forEach(function(t){t.addEventListener('click',function(e){if(show(t.getAttribute('data-p')))e.preventDefault();});});
+})();
+</script>"""
+
+
+def _platform_instructions_html(code: str) -> str:
+    base = (
+        "<ol>"
+        "<li>Откройте приложение для подключения.</li>"
+        "<li>Импортируйте ссылку или вставьте конфиг вручную.</li>"
+        "<li>Выберите профиль и нажмите «Подключить».</li>"
+        "</ol>"
+    )
+    if code == "ios":
+        return (
+            "<h3>Инструкция для iOS</h3>"
+            "<p>Установите Happ или совместимый клиент и импортируйте ссылку.</p>"
+            + base
+        )
+    if code == "android":
+        return (
+            "<h3>Инструкция для Android</h3>"
+            "<p>Установите Happ или другой VLESS-клиент и импортируйте ссылку.</p>"
+            + base
+        )
+    if code == "windows":
+        return (
+            "<h3>Инструкция для Windows</h3>"
+            "<p>Установите клиент и импортируйте ссылку или конфиг.</p>"
+            + base
+        )
+    if code == "macos":
+        return (
+            "<h3>Инструкция для macOS</h3>"
+            "<p>Установите клиент и импортируйте ссылку или конфиг.</p>"
+            + base
+        )
+    if code == "linux":
+        return (
+            "<h3>Инструкция для Linux</h3>"
+            "<p>Установите клиент и добавьте конфиг.</p>"
+            + base
+        )
+    return "<h3>Инструкция</h3>" + base
+
+
+def _compile_shell(selected: str) -> tuple[str, str]:
+    """(head, tail) of the page with `selected` ("" = generic) instructions visible."""
+    # Without JS the tabs still work as links: relative to /connect/{token}/{platform}.
+    tabs = "".join(
+        f'<a class="btn tab{" on" if code == selected else ""}" data-p="{code}" '
+        f'href="{code if selected else "#" + code}">{title}</a>'
+        for code, title in PLATFORMS
+    )
+    sections = "".join(
+        f'<div class="instr" id="i-{code}"{"" if code == selected else " hidden"}>{_platform_instructions_html(code)}</div>'
+        for code in ("", *(code for code, _ in PLATFORMS))
+    )
+    head = (
+        '<!doctype html><html><head><meta charset="utf-8"/>'
+        '<meta name="viewport" content="width=device-width,initial-scale=1"/>'
+        '<meta name="referrer" content="no-referrer"/>'
+        f"<title>Qdenzo Connect</title><style>{_STYLE}</style></head><body>"
+        "<h2>Подключение устройства</h2><p>Выберите платформу:</p>"
+        f'<div>{tabs}</div><div class="section">{sections}</div>'
+    )
+    tail = f"{_SCRIPT}</body></html>"
+    return head, tail
+
+
+_SHELLS: dict[str, tuple[str, str]] = {code: _compile_shell(code) for code in ("", *(c for c, _ in PLATFORMS))}
+_SHELL_VERSION = hashlib.sha1("".join(h + t for h, t in _SHELLS.values()).encode("utf-8")).hexdigest()[:8]
+
+
+def _bundle_html(link: str | None, subscription_url: str | None, crypt_url: str | None) -> str:
+    sub_block = (
+        f'<a class="btn" href="{html.escape(subscription_url)}">Открыть подписку</a>'
+        if subscription_url
+        else "<p>Подписка пока недоступна.</p>"
+    )
+    vless_block = f"<pre><code>{html.escape(link)}</code></pre>" if link else "<p>—</p>"
+    happ_block = (
+        f'<a class="btn" href="{html.escape(crypt_url)}">Добавить в Happ</a>'
+        if crypt_url
+        else "<p>Импорт в Happ временно недоступен.</p>"
+    )
+    return (
+        f'<div class="section"><h3>Ссылка подписки</h3>{sub_block}</div>'
+        f'<div class="section"><h3>VLESS конфиг</h3>{vless_block}</div>'
+        f'<div class="section"><h3>Happ</h3>{happ_block}</div>'
+    )
+
+
+def render_connect_page(bundle: ConnectBundle, platform: str) -> tuple[bytes, str]:
+    """(body, etag) for `platform`; unknown platforms get the generic shell."""
+    if platform not in _SHELLS:
+        platform = ""
+    head, tail = _SHELLS[platform]
+    etag = f'"{bundle.digest}-{platform or "all"}-{_SHELL_VERSION}"'
+    return (head + bundle.fragment + tail).encode("utf-8"), etag
+
+
+# ---- bundle cache ----
+
+_local: dict[int, tuple[float, ConnectBundle]] = {}
+_inflight: dict[int, asyncio.Task] = {}
+
+
+def _drop_bundles(keys: list[str]) -> None:
+    # Same keys as the device links cache (device ids), invalidated together
+    for key in keys:
+        _local.pop(int(key), None)
+
+
+on_invalidate("device_links", _drop_bundles)
+
+
+async def close_connect_page() -> None:
+    _local.clear()
+    await close_device_links()
+
+
+def _local_get(device_id: int) -> ConnectBundle | None:
+    cached = _local.get(device_id)
+    if not cached:
+        return None
+    expires_at, bundle = cached
+    if time.monotonic() > expires_at:
+        _local.pop(device_id, None)
+        return None
+    return bundle
+
+
+def _local_set(device_id: int, bundle: ConnectBundle) -> None:
+    if len(_local) >= _LOCAL_MAX:
+        _local.pop(next(iter(_local)), None)
+    _local[device_id] = (time.monotonic() + settings.connect_cache_seconds, bundle)
+
+
+async def _load_bundle(device_id: int) -> tuple[ConnectBundle, bool] | None:
+    connect_hits.inc(source="links")
+    async with session_scope() as session:
+        device = await session.get(Device, device_id)
+        if device is None:
+            return None
+        sub = await get_or_create_subscription(session, device.user_id)
+        links = await get_device_links(session, device, install_limit=sub.devices_limit)
+    return ConnectBundle.build(device.user_id, links.link, links.subscription_url, links.crypt_url), links.complete
+
+
+async def _load_and_remember(device_id: int) -> ConnectBundle | None:
+    loaded = await _load_bundle(device_id)
+    if loaded is None:
+        return None
+    bundle, complete = loaded
+    if complete:
+        _local_set(device_id, bundle)
+    return bundle
+
+
+async def get_connect_bundle(device_id: int, user_id: int) -> ConnectBundle | None:
+    """Link bundle of the device, None when it does not exist or belongs to someone else."""
+    bundle = _local_get(device_id)
+    if bundle is not None:
+        connect_hits.inc(source="local")
+    else:
+        task = _inflight.get(device_id)
+        if task is None:
+            task = asyncio.create_task(_load_and_remember(device_id))
+            _inflight[device_id] = task
+            task.add_done_callback(lambda _t, did=device_id: _inflight.pop(did, None))
+        bundle = await asyncio.shield(task)
+    if bundle is None or bundle.user_id != user_id:
+        return None
+    return bundle
+
+
+async def invalidate_connect_bundle(*device_ids: int) -> None:
+    """Call after a device's links or status change.
+
+    Other processes drop their copies when the invalidation reaches them over
+    pub/sub; if it is lost, within CONNECT_CACHE_SECONDS at the latest.
+    """
+    for device_id in device_ids:
+        _local.pop(device_id, None)
+    await invalidate_device_links(*device_ids)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""Connection links of a device, cached and pre-warmed.
+
+A device's bundle holds the VLESS link, the subscription URL (with the Happ
+InstallID when Happ-Proxy is configured) and the encrypted happ:// link.
+Building it takes a Marzban `get_user`, possibly a Happ-Proxy `add-install`
+and a Happ encryption call, so it is kept in a SharedCache for
+DEVICE_LINKS_CACHE_SECONDS (CONNECT_CACHE_SECONDS in each process's local
+level) and read by the connect screens and the /connect page.
+`invalidate_device_links()` reaches every process through
+cache/invalidation.py.
+
+`prewarm_device_links()` is called on device lifecycle events (device
+created, config reissued, device re-activated, order paid). It rebuilds the
+bundle in the background, so the user's first "Connect" tap is a cache hit.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+from dataclasses import asdict, dataclass
+
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..cache import SharedCache
+from ..config import settings
+from ..db import session_scope
+from ..marzban.client import MarzbanClient
+from ..metrics import Counter
+from ..models import Device
+from ..utils.urls import is_http_url, mask_url
+from .happ_connect import build_happ_links
+from .happ_install_pool import get_install_code, happ_proxy_config
+from .happ_proxy import _with_install_id
+from .subscriptions import get_or_create_subscription
+
+prewarm_events = Counter("device_links_prewarm_total", "Device link pre-warm runs by outcome")
+
+
+@dataclass(frozen=True, slots=True)
+class DeviceLinks:
+    link: str | None = None  # vless://...
+    subscription_url: str | None = None  # with InstallID when Happ-Proxy is configured
+    crypt_url: str | None = None  # happ://crypt...
+
+    @property
+    def complete(self) -> bool:
+        """Nothing is missing because of an upstream failure."""
+        return bool(self.subscription_url or self.link) and (self.crypt_url is not None or not self.subscription_url)
+
+
+def _encode(links: DeviceLinks) -> str:
+    return json.dumps(asdict(links), ensure_ascii=False)
+
+
+def _decode(raw: str) -> DeviceLinks:
+    return DeviceLinks(**json.loads(raw))
+
+
+# Revokes happen in the bot process while /connect is served by the web workers:
+# invalidations are broadcast, and the local level never outlives the /connect
+# bundle in case a broadcast is lost.
+_cache: SharedCache[DeviceLinks] = SharedCache(
+    "device_links",
+    ttl_seconds=settings.device_links_cache_seconds,
+    max_entries=settings.device_links_cache_max_entries,
+    local_ttl_seconds=min(settings.device_links_cache_seconds, settings.connect_cache_seconds),
+    broadcast=True,
+    encode=_encode,
+    decode=_decode,
+)
+_prewarming: dict[int, asyncio.Task] = {}
+_marz: MarzbanClient | None = None
+
+
+def marzban_client() -> MarzbanClient:
+    """Shared Marzban client of the process (its admin token survives between lookups)."""
+    global _marz
+    if _marz is None:
+        _marz = MarzbanClient(
+            base_url=str(settings.marzban_base_url),
+            username=settings.marzban_username,
+            password=settings.marzban_password,
+            verify_ssl=settings.marzban_verify_ssl,
+            api_prefix=settings.marzban_api_prefix,
+            default_inbounds={settings.marzban_proxy_type: [settings.marzban_inbound_tag]},
+            default_proxies={settings.marzban_proxy_type: {"flow": settings.reality_flow}},
+        )
+    return _marz
+
+
+async def close_device_links() -> None:
+    global _marz
+    for task in list(_prewarming.values()):
+        task.cancel()
+    if _marz is not None:
+        await _marz.close()
+        _marz = None
+
+
+async def ensure_install_code(session: AsyncSession, device: Device, *, install_limit: int) -> str | None:
+    if happ_proxy_config() is None:
+        return None
+    if device.happ_install_code:
+        return device.happ_install_code
+    install_code = await get_install_code(
+        session,
+        install_limit=install_limit,
+        device_id=device.id,
+        note=f"user={device.user_id} dev={device.id}",
+    )
+    device.happ_install_code = install_code
+    session.add(device)
+    await session.commit()
+    return install_code
+
+
+async def resolve_device_links(session: AsyncSession, device: Device, *, install_limit: int) -> DeviceLinks:
+    """Build the bundle from the upstream APIs (no cache)."""
+    from .devices import get_device_connection_links
+
+    if not device.marzban_username:
+        return DeviceLinks()
+    link, subscription_url = await get_device_connection_links(marzban_client(), device.marzban_username)
+    base_url = subscription_url if is_http_url(subscription_url) else None
+    if not base_url:
+        return DeviceLinks(link=link)
+    try:
+        install_code = await ensure_install_code(session, device, install_limit=install_limit)
+    except Exception as exc:
+        logger.warning("Happ install code failed device_id={}: {}", device.id, exc)
+        install_code = None
+    limited_url = _with_install_id(base_url, install_code) if install_code else base_url
+    try:
+        _, crypt_url = await build_happ_links(limited_url)
+    except Exception:
+        crypt_url = None
+    logger.debug(
+        "Connect links resolved device_id={} plain_url={} crypt_url={}",
+        device.id,
+        mask_url(limited_url),
+        mask_url(crypt_url),
+    )
+    return DeviceLinks(link=link, subscription_url=limited_url, crypt_url=crypt_url)
+
+
+async def get_device_links(session: AsyncSession, device: Device, *, install_limit: int) -> DeviceLinks:
+    """Cached bundle; partial results (an upstream failed) are returned but not cached."""
+    links = await _cache.get_or_load(
+        str(device.id),
+        lambda: resolve_device_links(session, device, install_limit=install_limit),
+        cacheable=lambda value: value.complete,
+    )
+    return links or DeviceLinks()
+
+
+async def invalidate_device_links(*device_ids: int) -> None:
+    await _cache.delete(*(str(device_id) for device_id in device_ids))
+
+
+async def _prewarm(device_id: int) -> None:
+    try:
+        async with session_scope() as session:
+            device = await session.get(Device, device_id)
+            if device is None or device.status not in ("active", "on_hold") or not device.marzban_username:
+                prewarm_events.inc(result="skipped")
+                return
+            sub = await get_or_create_subscription(session, device.user_id)
+            links = await get_device_links(session, device, install_limit=sub.devices_limit)
+        prewarm_events.inc(result="ok" if links.complete else "partial")
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:
+        prewarm_events.inc(result="failed")
+        logger.warning("Device links pre-warm failed device_id={}: {}", device_id, exc)
+
+
+def prewarm_device_links(*device_ids: int) -> None:
+    """Build the bundles in the background (fire-and-forget, one run per device at a time).
+
+    Callers invalidate stale bundles first; a handler asking for the same
+    device meanwhile joins the pre-warm load instead of starting its own.
+    """
+    if not settings.device_links_prewarm_enabled:
+        return
+    for device_id in device_ids:
+        if device_id in _prewarming:
+            continue
+        task = asyncio.create_task(_prewarm(device_id), name=f"prewarm-links-{device_id}")
+        _prewarming[device_id] = task
+        task.add_done_callback(lambda _t, did=device_id: _prewarming.pop(did, None))
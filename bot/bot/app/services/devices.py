@@ -14,6 +14,9 @@ from loguru import logger
 from ..marzban.client import MarzbanClient, MarzbanError
 from ..utils.urls import make_absolute_url
 from ..models import Device, Subscription, User
+from .connect_page import invalidate_connect_bundle
+from .device_links import prewarm_device_links
+from .sub_proxy import invalidate_subscription_proxy, proxied_subscription_url
 from .subscriptions import is_active, now_utc
 
 
@@ -186,6 +189,9 @@ async def create_device(
     session.add(user)
     await session.commit()
 
+    if existing_device:
+        await invalidate_connect_bundle(device.id)
+    prewarm_device_links(device.id)
     return device
 
 
@@ -233,6 +239,10 @@ async def set_device_status(
             # Do not crash UX
             pass
 
+    await invalidate_connect_bundle(device.id)
+    await invalidate_subscription_proxy(device.marzban_username)
+    if status == 'active':
+        prewarm_device_links(device.id)
     await session.refresh(device)
     return device
 
@@ -286,6 +296,7 @@ async def get_device_connection_links(marz: MarzbanClient, marzban_username: str
     links = u.get('links') or []
     sub_url = u.get('subscription_url')
     sub_url = make_absolute_url(u.get('subscription_url'))
+    sub_url = await proxied_subscription_url(marzban_username, sub_url)
     link = links[0] if links else None
     return link, sub_url
 
@@ -293,4 +304,7 @@ async def reissue_device_config(*, session: AsyncSession, marz: MarzbanClient, d
     if not device.marzban_username:
         raise ValueError("device_has_no_marzban_username")
     await marz.revoke_subscription(device.marzban_username)
+    await invalidate_connect_bundle(device.id)
+    await invalidate_subscription_proxy(device.marzban_username)
+    prewarm_device_links(device.id)
     # ничего больше не нужно: новые ссылки будут валидны при повторном запросе конфига
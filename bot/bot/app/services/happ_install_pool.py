@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Pool of pre-allocated Happ-Proxy install codes.
+
+An install code is bound to its install_limit when Happ-Proxy creates it, so
+there is one pool per tier (the devices_limit values of the catalog plans):
+
+- `claim_install_code()` takes a free code of the tier in the caller's
+  transaction (UPDATE ... FOR UPDATE SKIP LOCKED), so concurrent claims never
+  get the same code and the claim commits together with the device row;
+- `refill_install_pool()` tops every tier below HAPP_INSTALL_POOL_LOW_WATERMARK
+  up to HAPP_INSTALL_POOL_SIZE; it runs in the background (main.py) and is
+  woken up by claims, so /api/add-install is no longer on the interactive
+  path and a slow provider only delays the refill. Claims also happen in the
+  web processes, so the wake-up goes through the Redis list
+  `happ_install_pool:wake` (BLPOP in the filler); without Redis only claims
+  of the bot process wake it and the rest wait for the periodic check;
+- when a tier is empty the caller falls back to a direct /api/add-install.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import uuid
+from collections import Counter
+
+from loguru import logger
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..cache import get_redis, get_stream_redis
+from ..config import settings
+from ..db import session_scope
+from ..metrics import Counter as MetricCounter, Gauge, register_collector
+from ..models import HappInstallCode
+from .catalog import plan_options
+from .happ_proxy import HappProxyConfig, add_install_code
+from .subscriptions import now_utc
+
+_REFILL_LOCK_KEY = "happ_install_pool:refill"
+_REFILL_LOCK_SECONDS = 300
+_WAKE_KEY = "happ_install_pool:wake"
+
+# Deletes the refill lock only if we still own it (a slow refill may have lost it to another replica)
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+claims = MetricCounter("happ_install_claims_total", "Install code requests by source (pool/direct/failed)")
+refills = MetricCounter("happ_install_refill_total", "Install codes allocated by the pool filler by outcome")
+pool_available = Gauge("happ_install_pool_available", "Free pre-allocated install codes per tier")
+
+_wakeup = asyncio.Event()
+
+
+def happ_proxy_config() -> HappProxyConfig | None:
+    if not (settings.happ_proxy_api_base and settings.happ_proxy_provider_code and settings.happ_proxy_auth_key):
+        return None
+    return HappProxyConfig(
+        api_base=settings.happ_proxy_api_base,
+        provider_code=settings.happ_proxy_provider_code,
+        auth_key=settings.happ_proxy_auth_key,
+    )
+
+
+def install_tiers() -> list[int]:
+    return sorted({opt.devices_limit for opt in plan_options()})
+
+
+def pool_enabled() -> bool:
+    return settings.happ_install_pool_enabled and happ_proxy_config() is not None
+
+
+def wake_install_pool_filler() -> None:
+    _wakeup.set()
+
+
+async def _signal_pool_filler() -> None:
+    """Wake the filler in whichever process runs it."""
+    redis = get_redis()
+    if redis is None:
+        wake_install_pool_filler()
+        return
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(_WAKE_KEY, "1")
+            # nobody pops it while the filler is down; don't let the list pile up
+            pipe.expire(_WAKE_KEY, max(5, int(settings.happ_install_pool_check_seconds)))
+            await pipe.execute()
+    except Exception as exc:
+        logger.warning("Happ install pool wake-up failed: {}", exc)
+        wake_install_pool_filler()
+
+
+async def wait_for_pool_work(timeout: float) -> None:
+    redis = get_stream_redis()
+    if redis is not None:
+        try:
+            if await redis.blpop(_WAKE_KEY, timeout=max(1, int(timeout))):
+                await redis.delete(_WAKE_KEY)  # one refill covers a burst of claims
+            return
+        except Exception as exc:
+            logger.warning("Happ install pool wait failed, falling back to local wake-ups: {}", exc)
+    try:
+        await asyncio.wait_for(_wakeup.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    _wakeup.clear()
+
+
+async def claim_install_code(session: AsyncSession, *, install_limit: int, device_id: int) -> str | None:
+    """Take a free code of the tier (no commit: it is claimed with the caller's transaction)."""
+    if not settings.happ_install_pool_enabled:
+        return None
+    free = (
+        select(HappInstallCode.id)
+        .where(HappInstallCode.install_limit == install_limit, HappInstallCode.claimed_at.is_(None))
+        .order_by(HappInstallCode.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    res = await session.execute(
+        update(HappInstallCode)
+        .where(HappInstallCode.id == free.scalar_subquery())
+        .values(claimed_at=now_utc(), device_id=device_id)
+        .returning(HappInstallCode.code)
+        .execution_options(synchronize_session=False)
+    )
+    code = res.scalar_one_or_none()
+    await _signal_pool_filler()
+    return code
+
+
+async def get_install_code(session: AsyncSession, *, install_limit: int, device_id: int, note: str) -> str:
+    """Install code for a device: from the pool, or from Happ-Proxy directly when the tier is empty."""
+    code = await claim_install_code(session, install_limit=install_limit, device_id=device_id)
+    if code:
+        claims.inc(source="pool")
+        return code
+    cfg = happ_proxy_config()
+    if cfg is None:
+        raise RuntimeError("Happ-Proxy is not configured")
+    try:
+        code = await add_install_code(cfg, install_limit=install_limit, note=note)
+    except Exception:
+        claims.inc(source="failed")
+        raise
+    claims.inc(source="direct")
+    return code
+
+
+async def pool_levels(session: AsyncSession) -> dict[int, int]:
+    res = await session.execute(
+        select(HappInstallCode.install_limit, func.count())
+        .where(HappInstallCode.claimed_at.is_(None))
+        .group_by(HappInstallCode.install_limit)
+    )
+    return {int(limit): int(count) for limit, count in res.all()}
+
+
+async def _allocate(cfg: HappProxyConfig, install_limit: int, count: int) -> list[str]:
+    slots = asyncio.Semaphore(max(1, settings.happ_install_pool_refill_concurrency))
+
+    async def one() -> str | None:
+        async with slots:
+            try:
+                code = await add_install_code(cfg, install_limit=install_limit, note=f"pool tier={install_limit}")
+            except Exception as exc:
+                refills.inc(install_limit=install_limit, result="failed")
+                logger.warning("Happ install pool refill failed tier={}: {}", install_limit, exc)
+                return None
+            refills.inc(install_limit=install_limit, result="ok")
+            return code
+
+    codes = await asyncio.gather(*(one() for _ in range(count)))
+    return [code for code in codes if code]
+
+
+async def refill_install_pool(session: AsyncSession) -> Counter:
+    """Top up the tiers that fell below the low watermark; returns codes added per tier."""
+    stats: Counter = Counter()
+    cfg = happ_proxy_config()
+    if cfg is None or not settings.happ_install_pool_enabled:
+        return stats
+
+    redis = get_redis()
+    token = uuid.uuid4().hex
+    if redis is not None and not await redis.set(_REFILL_LOCK_KEY, token, nx=True, ex=_REFILL_LOCK_SECONDS):
+        return stats  # another replica is refilling
+    try:
+        levels = await pool_levels(session)
+        await session.commit()  # no transaction stays open over the HTTP calls
+        for tier in install_tiers():
+            have = levels.get(tier, 0)
+            pool_available.set(have, install_limit=tier)
+            if have >= settings.happ_install_pool_low_watermark:
+                continue
+            codes = await _allocate(cfg, tier, settings.happ_install_pool_size - have)
+            if not codes:
+                continue
+            session.add_all(HappInstallCode(install_limit=tier, code=code) for code in codes)
+            await session.commit()
+            stats[tier] += len(codes)
+            pool_available.set(have + len(codes), install_limit=tier)
+    finally:
+        if redis is not None:
+            try:
+                await redis.eval(_RELEASE_LUA, 1, _REFILL_LOCK_KEY, token)
+            except Exception as exc:
+                logger.warning("Happ install pool lock release failed: {}", exc)
+    return stats
+
+
+async def collect_pool_metrics() -> None:
+    if not pool_enabled():
+        return
+    async with session_scope() as session:
+        levels = await pool_levels(session)
+    for tier in install_tiers():
+        pool_available.set(levels.get(tier, 0), install_limit=tier)
+
+
+register_collector(collect_pool_metrics)
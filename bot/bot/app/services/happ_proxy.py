@@ -7,7 +7,8 @@ from typing import Any, Optional
 from urllib.parse import urlparse, urlencode, urlunparse, parse_qsl
 
 import hashlib
-import httpx
+
+from ..utils.http import get_http_client
 
 
 class HappProxyError(RuntimeError):
@@ -57,10 +58,10 @@ async def add_install_code(cfg: HappProxyConfig, *, install_limit: int, note: Op
     if note:
         params["note"] = note[:255]
 
-    async with httpx.AsyncClient(base_url=cfg.api_base, timeout=15, follow_redirects=True) as c:
-        r = await c.get("/api/add-install", params=params)
-        r.raise_for_status()
-        data = r.json()
+    c = get_http_client("happ_proxy", cfg.api_base)
+    r = await c.get("/api/add-install", params=params, timeout=15)
+    r.raise_for_status()
+    data = r.json()
 
     # По докам бизнес-статус приходит в rc/msg, при успехе — success+install_code
     # (точные поля могут отличаться, поэтому делаем tolerant parsing).
@@ -88,7 +89,7 @@ async def add_domain_if_needed(cfg: HappProxyConfig, subscription_url: str, doma
     if domain_name:
         params["domain_name"] = domain_name
 
-    async with httpx.AsyncClient(base_url=cfg.api_base, timeout=15, follow_redirects=True) as c:
-        r = await c.get("/api/add-domain", params=params)
-        # даже если домен уже был — это не ошибка для нашего сценария
-        r.raise_for_status()
+    c = get_http_client("happ_proxy", cfg.api_base)
+    r = await c.get("/api/add-domain", params=params, timeout=15)
+    # даже если домен уже был — это не ошибка для нашего сценария
+    r.raise_for_status()
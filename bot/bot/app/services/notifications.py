@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""User notifications from processes without a Bot instance.
+
+The HTTP service (webhooks, /connect) runs apart from the polling bot, so it
+appends notifications to the Redis Stream `bot:notifications` and the bot
+processes deliver them (`NotificationListener`). All bot replicas read through
+one consumer group, so every notification is sent by exactly one of them.
+
+Delivery is at-most-once (XREADGROUP NOACK): a replica that crashes mid-send
+loses that message, which is fine for "payment confirmed" style messages (the
+order state lives in the DB). Notifications older than _MAX_AGE_SECONDS, e.g.
+queued while no bot was running, are dropped instead of sent late.
+
+Message kinds:
+- "message": send `text` (HTML) to `tg_id`;
+- "payment_confirmed": same, and wake the Marzban outbox dispatcher, since
+  the outbox rows were committed in another process.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import socket
+import time
+from datetime import datetime
+from typing import Any
+
+from aiogram import Bot
+from loguru import logger
+from redis.exceptions import ResponseError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..cache import get_redis, get_stream_redis
+from ..metrics import Counter
+from ..models import Order, User
+from ..utils.text import fmt_dt
+from .outbox import wake_outbox_dispatcher
+
+STREAM_KEY = "bot:notifications"
+GROUP = "bot-notifications"
+
+_STREAM_MAXLEN = 10_000
+_READ_BLOCK_MS = 5_000
+_READ_COUNT = 50
+_MAX_AGE_SECONDS = 600
+
+notifications = Counter("bot_notifications_total", "Cross-process user notifications by stage")
+
+
+async def publish_notification(tg_id: int, text: str, *, kind: str = "message", **extra: Any) -> bool:
+    redis = get_redis()
+    if redis is None:
+        return False
+    payload = json.dumps(
+        {"kind": kind, "tg_id": tg_id, "text": text, "published_at": time.time(), **extra},
+        ensure_ascii=False,
+        default=str,
+    )
+    try:
+        await redis.xadd(STREAM_KEY, {"data": payload}, maxlen=_STREAM_MAXLEN, approximate=True)
+    except Exception as exc:
+        logger.warning("Notification publish failed tg_id={}: {}", tg_id, exc)
+        notifications.inc(stage="publish_failed")
+        return False
+    notifications.inc(stage="published")
+    return True
+
+
+async def notify_payment_confirmed(session: AsyncSession, order: Order, expires_at: datetime) -> bool:
+    tg_id = (await session.execute(select(User.tg_id).where(User.id == order.user_id))).scalar_one_or_none()
+    if tg_id is None:
+        return False
+    text = f"✅ Оплата подтверждена!\nПодписка активирована до: {fmt_dt(expires_at)}\nЗаказ #{order.id}"
+    return await publish_notification(tg_id, text, kind="payment_confirmed", order_id=order.id)
+
+
+class NotificationListener:
+    """Consumes STREAM_KEY in the bot process (one consumer of GROUP per process) and delivers messages."""
+
+    def __init__(self, bot: Bot) -> None:
+        self.bot = bot
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if get_redis() is None:
+            logger.warning("REDIS_URL is not set, cross-process notifications are disabled")
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="bot-notifications")
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            try:
+                # NOACK reads leave nothing pending, so the consumer can go with the process
+                await get_redis().xgroup_delconsumer(STREAM_KEY, GROUP, self.consumer)
+            except Exception:
+                pass
+        self._task = None
+
+    async def _ensure_group(self) -> None:
+        try:
+            await get_redis().xgroup_create(STREAM_KEY, GROUP, id="$", mkstream=True)
+        except ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+
+    async def _run(self) -> None:
+        reader = get_stream_redis()  # BLOCK outlasts the shared client's socket timeout
+        while True:
+            try:
+                await self._ensure_group()
+                while True:
+                    resp = await reader.xreadgroup(
+                        GROUP, self.consumer, {STREAM_KEY: ">"}, count=_READ_COUNT, block=_READ_BLOCK_MS, noack=True
+                    )
+                    for _stream, messages in resp or []:
+                        for _msg_id, fields in messages:
+                            await self._deliver((fields or {}).get("data") or "")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Notification listener failed, reconnecting: {}", exc)
+                await asyncio.sleep(1)
+
+    async def _deliver(self, raw: str) -> None:
+        try:
+            data = json.loads(raw)
+            tg_id = int(data["tg_id"])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Malformed notification: {}", raw)
+            return
+        if time.time() - float(data.get("published_at") or 0) > _MAX_AGE_SECONDS:
+            notifications.inc(stage="expired")
+            return
+        if data.get("kind") == "payment_confirmed":
+            wake_outbox_dispatcher()
+        text = data.get("text")
+        if not text:
+            return
+        try:
+            await self.bot.send_message(tg_id, text)
+        except Exception as exc:
+            notifications.inc(stage="send_failed")
+            logger.warning("Notification to tg_id={} not delivered: {}", tg_id, exc)
+            return
+        notifications.inc(stage="delivered")
@@ -4,17 +4,21 @@ from __future__ import annotations
 
 import json
 from datetime import datetime
+from typing import Any
 
 from sqlalchemy import desc, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..marzban.client import MarzbanClient
-from ..models import Order, User
+from ..models import Device, Order, User
 from .catalog import get_plan_option
-from .payments.common import load_order_meta
-from .devices import enforce_device_limit, sync_devices_expire
+from .connect_page import invalidate_connect_bundle
+from .device_links import prewarm_device_links
+from .devices import list_devices
+from .outbox import enqueue_marzban_update, wake_outbox_dispatcher
 from .referrals import maybe_grant_referral_bonus
-from .subscriptions import apply_plan_purchase, get_or_create_subscription, is_active, now_utc
+from .sub_proxy import invalidate_subscription_proxy
+from .snapshots import invalidate_user_snapshot_by_user_id, store_user_snapshot
+from .subscriptions import extend_subscription, get_or_create_subscription, now_utc
 from loguru import logger
 
 
@@ -43,13 +47,10 @@ async def create_subscription_order(
         status='pending',
         created_at=now_utc(),
     )
-    if meta:
-        order.meta_json = json.dumps(meta, ensure_ascii=False)
-    if action:
-        payload = {"action": action}
-        if order.meta_json:
-            payload.update(load_order_meta(order))
-        order.meta_json = json.dumps(payload, ensure_ascii=False)
+    if meta or action:
+        payload = {"action": action} if action else {}
+        payload.update(meta or {})
+        order.meta_json = payload
     session.add(order)
     await session.commit()
     await session.refresh(order)
@@ -69,62 +70,185 @@ async def list_pending_orders(session: AsyncSession, limit: int = 20) -> list[Or
     return list(q.scalars().all())
 
 
+async def accept_provider_payment(
+    session: AsyncSession,
+    order: Order,
+    *,
+    provider: str,
+    provider_id: str | int | None,
+    raw_payload: dict[str, Any] | None = None,
+) -> bool:
+    """Check a provider's "paid" report against a pending order and record it.
+
+    Returns True when the order is ready for mark_order_paid; False when it is
+    not pending or the provider data does not match (logged).
+    """
+    if order.status != "pending":
+        logger.info("Payment: order {} already processed", order.id)
+        return False
+
+    if order.provider and order.provider not in {provider, "manual"}:
+        logger.warning("Payment: provider mismatch for order {}", order.id)
+        return False
+    if provider_id and order.provider_payment_id and str(order.provider_payment_id) != str(provider_id):
+        logger.warning("Payment: provider id mismatch for order {}", order.id)
+        return False
+
+    if provider == "yookassa" and raw_payload:
+        amount = raw_payload.get("amount") or {}
+        if amount.get("currency") and amount.get("currency") != "RUB":
+            logger.warning("Payment: currency mismatch for order {}", order.id)
+            return False
+        if order.amount_rub:
+            expected = f"{order.amount_rub:.2f}"
+            if str(amount.get("value")) != expected:
+                logger.warning("Payment: amount mismatch for order {}", order.id)
+                return False
+        metadata = raw_payload.get("metadata") or {}
+        if metadata.get("order_id") and str(metadata.get("order_id")) != str(order.id):
+            logger.warning("Payment: metadata order mismatch for order {}", order.id)
+            return False
+    if provider == "cryptopay" and raw_payload:
+        if order.currency and raw_payload.get("asset") and raw_payload.get("asset") != order.currency:
+            logger.warning("Payment: asset mismatch for order {}", order.id)
+            return False
+        if order.amount and raw_payload.get("amount") and str(raw_payload.get("amount")) != str(order.amount):
+            logger.warning("Payment: amount mismatch for order {}", order.id)
+            return False
+        payload_raw = raw_payload.get("payload")
+        if payload_raw:
+            try:
+                payload = json.loads(payload_raw)
+                if payload.get("order_id") and str(payload.get("order_id")) != str(order.id):
+                    logger.warning("Payment: payload order mismatch for order {}", order.id)
+                    return False
+            except Exception:
+                logger.warning("Payment: payload parse failed for order {}", order.id)
+
+    order.provider = provider
+    if provider_id:
+        order.provider_payment_id = str(provider_id)
+    if raw_payload:
+        order.raw_provider_payload = raw_payload
+    session.add(order)
+    await session.commit()
+    return True
+
+
+def _queue_device_updates(
+    session: AsyncSession,
+    devices: list[Device],
+    *,
+    user_id: int,
+    expire_ts: int,
+    limit: int | None = None,
+) -> list[Device]:
+    """Queue Marzban expire updates for active devices; disable the ones over `limit`.
+
+    Returns the devices that were disabled (highest slot first).
+    """
+    active = [d for d in devices if d.status == 'active']
+    to_disable: list[Device] = []
+    if limit is not None and len(active) > limit:
+        to_disable = sorted(active, key=lambda d: d.slot, reverse=True)[limit:]
+    now = now_utc()
+    for d in active:
+        if d in to_disable:
+            d.status = 'disabled'
+            d.updated_at = now
+            session.add(d)
+            enqueue_marzban_update(session, user_id=user_id, marzban_username=d.marzban_username, status='disabled')
+        else:
+            enqueue_marzban_update(session, user_id=user_id, marzban_username=d.marzban_username, expire=expire_ts)
+    return to_disable
+
+
 async def mark_order_paid(
     *,
     session: AsyncSession,
-    marz: MarzbanClient,
     order: Order,
 ) -> tuple[datetime, list[str]]:
-    """Mark as paid and apply subscription + referral bonus.
+    """Mark as paid and apply subscription, device limit, referral bonus and promo.
+
+    All DB changes, plus outbox rows for the Marzban updates, are committed in
+    one transaction; the outbox dispatcher applies them to Marzban afterwards.
+    The order row is locked first, so concurrent confirmations (webhook,
+    reconciler, "check" button) apply the purchase once.
 
     Returns:
       (new_expires_at, notes)
     """
+    from .promos import redeem_promo_for_order
+
+    locked = await session.execute(
+        select(Order)
+        .where(Order.id == order.id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    order = locked.scalar_one()
     if order.status == 'paid':
         sub = await get_or_create_subscription(session, order.user_id)
+        await session.commit()
         return sub.expires_at or now_utc(), ['already_paid']
 
     user_q = await session.execute(select(User).where(User.id == order.user_id))
     user = user_q.scalar_one()
 
     opt = get_plan_option(order.plan_code, order.months)
-    sub = await get_or_create_subscription(session, user.id)
-
-    # Apply subscription
-    new_exp = await apply_plan_purchase(session, user, opt)
+    sub, new_exp = await extend_subscription(session, user, opt)
 
-    # Update Marzban users expire
-    expire_ts = int(new_exp.timestamp())
-    await sync_devices_expire(session=session, marz=marz, user_id=user.id, expire_ts=expire_ts)
-
-    # Enforce device limit (disable extras)
-    disabled = await enforce_device_limit(session=session, marz=marz, user_id=user.id, limit=opt.devices_limit)
+    devices = await list_devices(session, user.id)
+    disabled = _queue_device_updates(
+        session, devices, user_id=user.id, expire_ts=int(new_exp.timestamp()), limit=opt.devices_limit
+    )
 
-    # Update order
     order.status = 'paid'
     order.paid_at = now_utc()
     session.add(order)
-    await session.commit()
-    logger.info("Order paid id={} user_id={} plan={} months={}", order.id, user.id, order.plan_code, order.months)
 
     notes: list[str] = []
     if disabled:
         notes.append(f"disabled_{len(disabled)}_devices")
 
-    # Referral bonus for inviter (if any)
-    bonus_applied = await maybe_grant_referral_bonus(session=session, referral_user_id=user.id, order=order)
-    if bonus_applied:
+    # Referral bonus for inviter (if any); the inviter's devices get the new expiry too
+    bonus_applied = await maybe_grant_referral_bonus(
+        session=session, referral_user_id=user.id, order=order, commit=False
+    )
+    inviter_sub = None
+    if bonus_applied and user.inviter_id:
         notes.append(f"ref_bonus={bonus_applied}s")
+        inviter_sub = await get_or_create_subscription(session, user.inviter_id)
+        if inviter_sub.expires_at:
+            _queue_device_updates(
+                session,
+                await list_devices(session, user.inviter_id),
+                user_id=user.inviter_id,
+                expire_ts=int(inviter_sub.expires_at.timestamp()),
+            )
 
     # Promo redemption (if any)
-    from .promos import redeem_promo_for_order
     try:
-        redeemed = await redeem_promo_for_order(session=session, order=order, user_id=user.id)
+        redeemed = await redeem_promo_for_order(session=session, order=order, user_id=user.id, commit=False)
     except Exception:
+        logger.exception("Promo redemption failed for order {}", order.id)
         redeemed = False
     if redeemed:
         notes.append("promo_redeemed")
 
+    await session.commit()
+    logger.info("Order paid id={} user_id={} plan={} months={}", order.id, user.id, order.plan_code, order.months)
+
+    wake_outbox_dispatcher()
+    if disabled:
+        # Same as set_device_status: no cached links for devices that are off now
+        await invalidate_connect_bundle(*(d.id for d in disabled))
+        await invalidate_subscription_proxy(*(d.marzban_username for d in disabled))
+    await store_user_snapshot(user, sub)
+    if inviter_sub is not None:
+        await invalidate_user_snapshot_by_user_id(session, user.inviter_id)
+    # The user usually opens "Connect" right after paying
+    prewarm_device_links(*(d.id for d in devices if d.status == 'active'))
     return new_exp, notes
 
 async def cancel_order(session: AsyncSession, order_id: int) -> Order | None:
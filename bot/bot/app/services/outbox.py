@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Transactional outbox for Marzban side effects.
+
+DB code records the Marzban updates it needs with `enqueue_marzban_update()`
+inside its own transaction; nothing talks to Marzban while a transaction is
+open. The dispatcher then:
+
+- leases due rows (UPDATE ... FOR UPDATE SKIP LOCKED, commit), so several
+  dispatchers can run and no transaction spans an HTTP call;
+- applies a username's rows in order: a row waits while an older row of
+  the same username is in backoff or leased elsewhere, so a retried old
+  update never overwrites a newer one; leasing takes a per-username
+  advisory lock (pg_try_advisory_xact_lock), so a dispatcher never leases
+  a newer row while another one is still leasing an older row of the same
+  username (SKIP LOCKED alone would skip the older row and take the newer);
+- coalesces rows of the same username into one update_user call
+  (later rows override earlier fields);
+- marks rows done, or reschedules them with backoff and gives up after
+  MARZBAN_OUTBOX_MAX_ATTEMPTS.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from collections import Counter
+from datetime import timedelta
+from typing import Any
+
+from loguru import logger
+from sqlalchemy import exists, func, select, update
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..marzban.client import MarzbanClient
+from ..metrics import Counter as MetricCounter
+from ..models import MarzbanOutbox
+from .subscriptions import now_utc
+
+_LEASE_SECONDS = 120
+_BATCH = 200
+
+outbox_events = MetricCounter("marzban_outbox_total", "Marzban outbox rows by outcome")
+
+_wakeup = asyncio.Event()
+
+
+def enqueue_marzban_update(
+    session: AsyncSession,
+    *,
+    user_id: int | None,
+    marzban_username: str,
+    **fields: Any,
+) -> None:
+    """Add an outbox row to the caller's transaction (no flush, no commit)."""
+    if not marzban_username or not fields:
+        return
+    session.add(MarzbanOutbox(user_id=user_id, marzban_username=marzban_username, payload=dict(fields)))
+
+
+def wake_outbox_dispatcher() -> None:
+    """Call after committing outbox rows to have them applied right away."""
+    _wakeup.set()
+
+
+def _backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(3600, 5 * (2 ** max(0, attempts - 1))))
+
+
+async def _lease_due(session: AsyncSession, limit: int) -> list[MarzbanOutbox]:
+    now = now_utc()
+    older = aliased(MarzbanOutbox)
+    # An older pending row that is not due is in backoff or leased by another dispatcher
+    blocked = exists().where(
+        older.marzban_username == MarzbanOutbox.marzban_username,
+        older.id < MarzbanOutbox.id,
+        older.status == "pending",
+        older.next_attempt_at > now,
+    )
+    due = (
+        select(MarzbanOutbox.id)
+        .where(
+            MarzbanOutbox.status == "pending",
+            MarzbanOutbox.next_attempt_at <= now,
+            ~blocked,
+            # Held until our commit; a username another dispatcher is leasing right now is skipped entirely
+            func.pg_try_advisory_xact_lock(func.hashtext(MarzbanOutbox.marzban_username)),
+        )
+        .order_by(MarzbanOutbox.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    res = await session.execute(
+        update(MarzbanOutbox)
+        .where(MarzbanOutbox.id.in_(due.scalar_subquery()))
+        .values(next_attempt_at=now + timedelta(seconds=_LEASE_SECONDS))
+        .returning(MarzbanOutbox)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )
+    rows = sorted(res.scalars().all(), key=lambda r: r.id)
+    await session.commit()
+    return rows
+
+
+async def dispatch_marzban_outbox(session: AsyncSession, marz: MarzbanClient, *, limit: int = _BATCH) -> Counter:
+    stats: Counter = Counter()
+    rows = await _lease_due(session, limit)
+    if not rows:
+        return stats
+
+    grouped: dict[str, list[MarzbanOutbox]] = {}
+    for row in rows:
+        grouped.setdefault(row.marzban_username, []).append(row)
+
+    for username, items in grouped.items():
+        merged: dict[str, Any] = {}
+        for row in items:
+            merged.update(row.payload or {})
+        ids = [row.id for row in items]
+        try:
+            await marz.update_user(username, **merged)
+        except Exception as exc:
+            attempts = max(row.attempts for row in items) + 1
+            dead = attempts >= settings.marzban_outbox_max_attempts
+            await session.execute(
+                update(MarzbanOutbox)
+                .where(MarzbanOutbox.id.in_(ids))
+                .values(
+                    attempts=attempts,
+                    status="dead" if dead else "pending",
+                    next_attempt_at=now_utc() + _backoff(attempts),
+                    last_error=f"{type(exc).__name__}: {exc}"[:1000],
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            result = "dead" if dead else "retry"
+            stats[result] += len(ids)
+            outbox_events.inc(len(ids), result=result)
+            log = logger.error if dead else logger.warning
+            log("Marzban outbox {} for {} (attempt {}): {}", result, username, attempts, exc)
+            continue
+
+        await session.execute(
+            update(MarzbanOutbox)
+            .where(MarzbanOutbox.id.in_(ids))
+            .values(status="done", processed_at=now_utc())
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        stats["done"] += len(ids)
+        stats["calls"] += 1
+        outbox_events.inc(len(ids), result="done")
+    return stats
+
+
+async def wait_for_outbox_work(timeout: float) -> None:
+    try:
+        await asyncio.wait_for(_wakeup.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    _wakeup.clear()
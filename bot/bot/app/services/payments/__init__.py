@@ -1,8 +1,20 @@
 # -*- coding: utf-8 -*-
 
-from .common import load_order_meta, update_order_meta
-from .cryptopay import CryptoPayClient, CryptoPayError, CryptoPayInvoice, is_paid_status as is_cryptopay_paid
-from .yookassa import YooKassaClient, YooKassaError, YooKassaPayment, is_paid_status as is_yookassa_paid
+from .common import load_order_meta, patch_order_meta, update_order_meta
+from .cryptopay import (
+    CryptoPayClient,
+    CryptoPayError,
+    CryptoPayInvoice,
+    get_cryptopay_client,
+    is_paid_status as is_cryptopay_paid,
+)
+from .yookassa import (
+    YooKassaClient,
+    YooKassaError,
+    YooKassaPayment,
+    get_yookassa_client,
+    is_paid_status as is_yookassa_paid,
+)
 
 __all__ = [
     "CryptoPayClient",
@@ -11,8 +23,11 @@ __all__ = [
     "YooKassaClient",
     "YooKassaError",
     "YooKassaPayment",
+    "get_cryptopay_client",
+    "get_yookassa_client",
     "is_cryptopay_paid",
     "is_yookassa_paid",
     "load_order_meta",
+    "patch_order_meta",
     "update_order_meta",
 ]
\ No newline at end of file
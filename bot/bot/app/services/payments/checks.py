@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Provider status lookups for the "check payment" button.
+
+Keeps provider API usage flat no matter how often users press the button:
+
+- the last status per order is cached in Redis for PAYMENT_CHECK_CACHE_SECONDS;
+- concurrent presses for one order share a single in-flight request;
+- a per-user cooldown (PAYMENT_CHECK_COOLDOWN_SECONDS) limits fresh lookups,
+  presses inside it are served from the cache only.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+from dataclasses import dataclass
+from typing import Any
+
+from loguru import logger
+
+from ...cache import get_redis
+from ...config import settings
+from ...metrics import Counter
+from ...models import Order
+from .cryptopay import get_cryptopay_client, is_paid_status as is_cryptopay_paid
+from .yookassa import get_yookassa_client, is_paid_status as is_yookassa_paid
+
+payment_checks = Counter("payment_check_total", "Check-payment lookups by source")
+
+_inflight: dict[int, asyncio.Task] = {}
+
+
+@dataclass(frozen=True, slots=True)
+class ProviderStatus:
+    paid: bool
+    raw: dict[str, Any] | None = None
+
+
+class ProviderCheckError(RuntimeError):
+    pass
+
+
+def _status_key(order_id: int) -> str:
+    return f"paycheck:{order_id}"
+
+
+def _cooldown_key(user_id: int) -> str:
+    return f"paycheck_cd:{user_id}"
+
+
+async def _cached_status(order_id: int) -> ProviderStatus | None:
+    redis = get_redis()
+    if redis is None:
+        return None
+    try:
+        raw = await redis.get(_status_key(order_id))
+    except Exception:
+        return None
+    if not raw:
+        return None
+    try:
+        data = json.loads(raw)
+        return ProviderStatus(paid=bool(data.get("paid")), raw=data.get("raw"))
+    except (ValueError, AttributeError):
+        # Unreadable entry: treat as a miss, the next store overwrites it
+        return None
+
+
+async def _store_status(order_id: int, status: ProviderStatus) -> None:
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.set(
+            _status_key(order_id),
+            json.dumps({"paid": status.paid, "raw": status.raw}, ensure_ascii=False, default=str),
+            ex=settings.payment_check_cache_seconds,
+        )
+    except Exception as exc:
+        logger.warning("Payment check cache write failed order_id={}: {}", order_id, exc)
+
+
+async def start_cooldown(user_id: int) -> int:
+    """Start the user's cooldown; returns the seconds left if one is already running (0 otherwise)."""
+    redis = get_redis()
+    if redis is None or settings.payment_check_cooldown_seconds <= 0:
+        return 0
+    key = _cooldown_key(user_id)
+    try:
+        if await redis.set(key, "1", nx=True, ex=settings.payment_check_cooldown_seconds):
+            return 0
+        return max(1, int(await redis.ttl(key)))
+    except Exception:
+        return 0
+
+
+async def _fetch_status(order: Order) -> ProviderStatus:
+    if order.provider == "cryptopay":
+        client = get_cryptopay_client()
+        if client is None or not order.provider_payment_id:
+            raise ProviderCheckError("cryptopay_not_configured")
+        invoice = await client.get_invoice(int(order.provider_payment_id))
+        if invoice and is_cryptopay_paid(invoice.status):
+            return ProviderStatus(paid=True, raw=invoice.raw)
+        return ProviderStatus(paid=False)
+    if order.provider == "yookassa":
+        client = get_yookassa_client()
+        if client is None or not order.provider_payment_id:
+            raise ProviderCheckError("yookassa_not_configured")
+        payment = await client.get_payment(str(order.provider_payment_id))
+        if is_yookassa_paid(payment.status):
+            return ProviderStatus(paid=True, raw=payment.raw)
+        return ProviderStatus(paid=False)
+    raise ProviderCheckError("provider_not_supported")
+
+
+async def _fetch_and_cache(order: Order) -> ProviderStatus:
+    status = await _fetch_status(order)
+    await _store_status(order.id, status)
+    return status
+
+
+async def check_provider_status(order: Order, *, allow_fetch: bool = True) -> ProviderStatus | None:
+    """Cached/shared provider status of a pending order.
+
+    Returns None when nothing is cached and `allow_fetch` is False.
+    Raises ProviderCheckError / provider errors when the lookup fails.
+    """
+    cached = await _cached_status(order.id)
+    if cached is not None:
+        payment_checks.inc(source="cache")
+        return cached
+    task = _inflight.get(order.id)
+    if task is not None:
+        payment_checks.inc(source="shared")
+        return await asyncio.shield(task)
+    if not allow_fetch:
+        payment_checks.inc(source="cooldown")
+        return None
+    payment_checks.inc(source="provider")
+    task = asyncio.create_task(_fetch_and_cache(order))
+    _inflight[order.id] = task
+    task.add_done_callback(lambda _t, oid=order.id: _inflight.pop(oid, None))
+    return await asyncio.shield(task)
+
+
+async def forget_provider_status(order_id: int) -> None:
+    """Drop the cached status once the order is settled, so no stale "not paid" is served."""
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.delete(_status_key(order_id))
+    except Exception:
+        return
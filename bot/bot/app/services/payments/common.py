@@ -5,22 +5,63 @@ from __future__ import annotations
 import json
 from typing import Any
 
+from sqlalchemy import cast, func, update
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
 from ...models import Order
 
 
 def load_order_meta(order: Order) -> dict[str, Any]:
-    """Load order.meta_json as dict (empty when absent)."""
-    if not order.meta_json:
+    """Return order.meta_json as dict (empty when absent)."""
+    meta = order.meta_json
+    if not meta:
         return {}
+    if isinstance(meta, dict):
+        return dict(meta)
+    # Rows written before the JSONB migration may still hold a JSON string.
     try:
-        return json.loads(order.meta_json)
-    except json.JSONDecodeError:
+        loaded = json.loads(meta)
+    except (TypeError, json.JSONDecodeError):
         return {}
+    return loaded if isinstance(loaded, dict) else {}
 
 
 def update_order_meta(order: Order, updates: dict[str, Any]) -> dict[str, Any]:
-    """Merge updates into order.meta_json and return updated dict."""
+    """Merge updates into order.meta_json in memory and return the updated dict.
+
+    Writes the whole column back, so a concurrent writer's keys can be lost;
+    prefer `patch_order_meta`, which does the merge in SQL.
+    """
     meta = load_order_meta(order)
     meta.update(updates)
-    order.meta_json = json.dumps(meta, ensure_ascii=False)
-    return meta
\ No newline at end of file
+    # Assign a new dict so the ORM sees the column as changed.
+    order.meta_json = meta
+    return meta
+
+
+def merged_meta(updates: dict[str, Any]):
+    """SQL expression `coalesce(meta_json, '{}') || updates` for UPDATE ... SET meta_json."""
+    return func.coalesce(Order.meta_json, cast({}, JSONB)).op("||")(cast(updates, JSONB))
+
+
+async def patch_order_meta(session: AsyncSession, order: Order, updates: dict[str, Any]) -> dict[str, Any]:
+    """Merge keys into orders.meta_json in SQL (`meta_json || updates`) and return the result.
+
+    Keys written concurrently by another transaction are kept. The in-memory
+    order gets the merged value without being marked dirty, so flushing the
+    row's other columns does not write meta_json back. The caller commits.
+    """
+    if not updates:
+        return load_order_meta(order)
+    res = await session.execute(
+        update(Order)
+        .where(Order.id == order.id)
+        .values(meta_json=merged_meta(updates))
+        .returning(Order.meta_json)
+        .execution_options(synchronize_session=False)
+    )
+    meta = res.scalar_one_or_none() or {}
+    set_committed_value(order, "meta_json", meta)
+    return dict(meta)
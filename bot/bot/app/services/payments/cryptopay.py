@@ -11,6 +11,9 @@ from typing import Any
 import httpx
 from loguru import logger
 
+from ...config import settings
+from ...utils.http import get_http_client
+
 API_BASE = "https://pay.crypt.bot/api"
 
 
@@ -49,8 +52,8 @@ class CryptoPayClient:
         last_error: Exception | None = None
         for attempt in range(1, self._max_retries + 1):
             try:
-                async with httpx.AsyncClient(base_url=self._api_base, timeout=self._timeout) as client:
-                    response = await client.post(f"/{method}", json=payload, headers=headers)
+                client = get_http_client("cryptopay", self._api_base)
+                response = await client.post(f"/{method}", json=payload, headers=headers, timeout=self._timeout)
                 response.raise_for_status()
                 data = response.json()
                 if not data.get("ok"):
@@ -117,11 +120,44 @@ class CryptoPayClient:
             raw=invoice,
         )
 
+    async def get_invoices(self, invoice_ids: list[int]) -> list[CryptoPayInvoice]:
+        """Batch lookup; the API accepts a comma-separated id list (kept at <= 100 per call)."""
+        if not invoice_ids:
+            return []
+        result = await self._request(
+            "getInvoices",
+            {"invoice_ids": ",".join(str(int(i)) for i in invoice_ids), "count": len(invoice_ids)},
+        )
+        items = result.get("items") or result.get("invoices") or []
+        return [
+            CryptoPayInvoice(
+                invoice_id=int(item.get("invoice_id")),
+                status=str(item.get("status", "")),
+                pay_url=item.get("pay_url"),
+                raw=item,
+            )
+            for item in items
+        ]
+
     async def get_exchange_rates(self) -> list[dict[str, Any]]:
         result = await self._request("getExchangeRates", {})
         return list(result or [])
 
 
+_client: CryptoPayClient | None = None
+
+
+def get_cryptopay_client() -> CryptoPayClient | None:
+    """Shared client for the configured CRYPTOPAY_TOKEN (None when not configured)."""
+    global _client
+    token = settings.cryptopay_token
+    if not token:
+        return None
+    if _client is None or (_client._token, _client._api_base) != (token, settings.cryptopay_api_base):
+        _client = CryptoPayClient(token, api_base=settings.cryptopay_api_base)
+    return _client
+
+
 def verify_webhook_signature(*, token: str, body: bytes, signature: str | None) -> bool:
     """Verify Crypto Pay webhook signature (HMAC SHA-256)."""
     if not signature:
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""CryptoPay exchange rates cache.
+
+Rates are fetched by a background refresher and kept as a precomputed
+asset -> RUB table (direct pair, or asset -> USD -> RUB). Checkout reads the
+table without waiting on the API:
+
+- fresher than `refresh_seconds`: served as is;
+- older but within `max_age_seconds`: served stale, refresh kicked off;
+- older than that (or never fetched): one caller refreshes, others wait on it;
+  if the API is down, RatesUnavailable is raised.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation, ROUND_UP
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+
+from ...config import settings
+from .cryptopay import get_cryptopay_client
+
+
+class RatesUnavailable(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class RatesSnapshot:
+    to_rub: dict[str, Decimal]
+    fetched_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+def build_rub_rates(rates: list[dict[str, Any]]) -> dict[str, Decimal]:
+    """asset -> RUB for every asset the API reports, via USD when there is no direct pair."""
+    pairs: dict[tuple[str, str], Decimal] = {}
+    for item in rates:
+        if item.get("is_valid") is False:
+            continue
+        source, target = item.get("source"), item.get("target")
+        if not source or not target:
+            continue
+        try:
+            value = Decimal(str(item.get("rate")))
+        except (InvalidOperation, ValueError):
+            continue
+        if value > 0:
+            pairs[(source, target)] = value
+
+    usd_rub = pairs.get(("USD", "RUB"))
+    to_rub: dict[str, Decimal] = {}
+    for (source, target), value in pairs.items():
+        if target == "RUB":
+            to_rub[source] = value
+        elif target == "USD" and usd_rub is not None and source not in to_rub:
+            to_rub[source] = value * usd_rub
+    return to_rub
+
+
+class ExchangeRateCache:
+    def __init__(
+        self,
+        fetch: Callable[[], Awaitable[list[dict[str, Any]]]],
+        *,
+        refresh_seconds: float,
+        max_age_seconds: float,
+    ) -> None:
+        self._fetch = fetch
+        self.refresh_seconds = refresh_seconds
+        self.max_age_seconds = max(max_age_seconds, refresh_seconds)
+        self._snapshot: RatesSnapshot | None = None
+        self._inflight: asyncio.Task | None = None
+        self._loop_task: asyncio.Task | None = None
+
+    @property
+    def snapshot(self) -> RatesSnapshot | None:
+        return self._snapshot
+
+    async def _do_refresh(self) -> RatesSnapshot:
+        rates = await self._fetch()
+        to_rub = build_rub_rates(rates)
+        if not to_rub:
+            raise RatesUnavailable("CryptoPay returned no usable RUB rates")
+        snap = RatesSnapshot(to_rub=to_rub)
+        self._snapshot = snap
+        return snap
+
+    def _refresh_task(self) -> asyncio.Task:
+        # Single-flight: concurrent callers share one upstream request.
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._do_refresh())
+            self._inflight.add_done_callback(self._log_failure)
+        return self._inflight
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("CryptoPay rates refresh failed: {}", task.exception())
+
+    async def refresh(self) -> RatesSnapshot:
+        return await asyncio.shield(self._refresh_task())
+
+    async def get(self) -> RatesSnapshot:
+        snap = self._snapshot
+        if snap is not None and snap.age < self.refresh_seconds:
+            return snap
+        if snap is not None and snap.age < self.max_age_seconds:
+            self._refresh_task()
+            return snap
+        try:
+            return await self.refresh()
+        except Exception as exc:
+            raise RatesUnavailable(str(exc)) from exc
+
+    async def rub_rate(self, asset: str) -> Decimal:
+        snap = await self.get()
+        rate = snap.to_rub.get(asset)
+        if rate is None:
+            raise RatesUnavailable(f"no RUB rate for {asset}")
+        return rate
+
+    def start(self) -> None:
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._refresh_loop(), name="cryptopay-rates")
+
+    async def stop(self) -> None:
+        for task in (self._loop_task, self._inflight):
+            if task and not task.done():
+                task.cancel()
+        self._loop_task = None
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass  # logged by _log_failure; stale data keeps being served
+            await asyncio.sleep(self.refresh_seconds)
+
+
+async def _fetch_rates() -> list[dict[str, Any]]:
+    client = get_cryptopay_client()
+    if client is None:
+        raise RatesUnavailable("CryptoPay is not configured")
+    return await client.get_exchange_rates()
+
+
+_cache: ExchangeRateCache | None = None
+
+
+def get_rates_cache() -> ExchangeRateCache:
+    global _cache
+    if _cache is None:
+        _cache = ExchangeRateCache(
+            _fetch_rates,
+            refresh_seconds=settings.cryptopay_rates_refresh_seconds,
+            max_age_seconds=settings.cryptopay_rates_max_age_seconds,
+        )
+    return _cache
+
+
+async def rub_to_asset_amount(amount_rub: int, asset: str) -> str:
+    """RUB price converted to `asset`, rounded up to 6 decimals, as a plain string."""
+    rate = await get_rates_cache().rub_rate(asset)
+    amount_asset = (Decimal(amount_rub) / rate).quantize(Decimal("0.000001"), rounding=ROUND_UP)
+    if amount_asset <= 0:
+        raise ValueError("crypto_amount_invalid")
+    return format(amount_asset.normalize(), "f")
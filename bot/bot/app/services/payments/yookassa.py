@@ -2,12 +2,17 @@ from __future__ import annotations
 
 import asyncio
 from dataclasses import dataclass
+from datetime import datetime, timezone
 from typing import Any
+from urllib.parse import urlencode
 from uuid import uuid4
 
 import httpx
 from loguru import logger
 
+from ...config import settings
+from ...utils.http import get_http_client
+
 API_BASE = "https://api.yookassa.ru/v3"
 
 
@@ -58,8 +63,10 @@ class YooKassaClient:
         last_error: Exception | None = None
         for attempt in range(1, self._max_retries + 1):
             try:
-                async with httpx.AsyncClient(base_url=self._api_base, timeout=self._timeout, auth=auth) as client:
-                    response = await client.request(method, url, json=payload, headers=headers)
+                client = get_http_client("yookassa", self._api_base)
+                response = await client.request(
+                    method, url, json=payload, headers=headers, auth=auth, timeout=self._timeout
+                )
                 response.raise_for_status()
                 return response.json()
             except httpx.HTTPStatusError as exc:
@@ -117,6 +124,50 @@ class YooKassaClient:
             raw=result,
         )
 
+    async def list_payments(
+        self,
+        *,
+        created_gte: datetime,
+        status: str | None = None,
+        cursor: str | None = None,
+        limit: int = 100,
+    ) -> tuple[list[YooKassaPayment], str | None]:
+        """One page of payments created since `created_gte`; returns (items, next_cursor)."""
+        params = {
+            "created_at.gte": created_gte.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "limit": max(1, min(100, limit)),
+        }
+        if status:
+            params["status"] = status
+        if cursor:
+            params["cursor"] = cursor
+        result = await self._request("GET", f"/payments?{urlencode(params)}")
+        items = [
+            YooKassaPayment(
+                payment_id=str(item["id"]),
+                status=str(item.get("status", "")),
+                confirmation_url=(item.get("confirmation") or {}).get("confirmation_url"),
+                raw=item,
+            )
+            for item in result.get("items") or []
+        ]
+        return items, result.get("next_cursor")
+
+
+_client: YooKassaClient | None = None
+
+
+def get_yookassa_client() -> YooKassaClient | None:
+    """Shared client for the configured shop (None when not configured)."""
+    global _client
+    shop_id, secret_key = settings.yookassa_shop_id, settings.yookassa_secret_key
+    if not (shop_id and secret_key):
+        return None
+    api_base = settings.yookassa_api_base
+    if _client is None or (_client._shop_id, _client._secret_key, _client._api_base) != (shop_id, secret_key, api_base):
+        _client = YooKassaClient(shop_id, secret_key, api_base=api_base)
+    return _client
+
 
 def is_paid_status(status: str) -> bool:
     return status in {"succeeded"}
\ No newline at end of file
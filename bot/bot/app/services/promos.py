@@ -5,11 +5,14 @@ from __future__ import annotations
 from datetime import datetime, timezone
 import re
 
-from sqlalchemy import func, select
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from ..cache import get_redis
 from ..models import Promo, PromoRedemption, User
 from .payments.common import load_order_meta
+from .snapshots import invalidate_user_snapshot
 from loguru import logger
 
 
@@ -66,6 +69,7 @@ async def create_promo(
         )
         session.add(promo)
     await session.refresh(promo)
+    await reset_promo_gate(promo)
     logger.info("Promo created code={} discount={} max_uses={}", promo.code, promo.discount_rub, promo.max_uses)
     return promo
 
@@ -79,6 +83,7 @@ async def toggle_promo(session: AsyncSession, promo_id: int) -> Promo | None:
         promo.active = not promo.active
         session.add(promo)
     await session.refresh(promo)
+    await reset_promo_gate(promo)
     logger.info("Promo toggled code={} active={}", promo.code, promo.active)
     return promo
 
@@ -90,6 +95,7 @@ async def delete_promo(session: AsyncSession, promo_id: int) -> bool:
         if not promo:
             return False
         await session.delete(promo)
+    await reset_promo_gate(promo)
     logger.info("Promo deleted code={}", promo.code)
     return True
 
@@ -100,64 +106,244 @@ async def promo_available_for_user(
     code: str,
     user_id: int,
 ) -> tuple[Promo | None, str | None]:
-    promo = await get_promo_by_code(session, code)
+    """Cheap availability check for UX; redemption itself is authoritative.
+
+    The per-user "already used" lookup is a point read on the unique
+    (promo_id, user_id) index, so the user gets the error up front; the same
+    index still rejects a concurrent second redemption.
+    """
+    normalized = normalize_code(code)
+    if await _is_marked_exhausted(normalized):
+        logger.info("Promo exhausted (cached) code={} user_id={}", normalized, user_id)
+        return None, "Промокод не найден или больше недоступен."
+    promo = await get_promo_by_code(session, normalized)
     if not promo or not promo.active:
         logger.info("Promo unavailable code={} user_id={}", code, user_id)
         return None, "Промокод не найден или больше недоступен."
     if promo.max_uses and promo.used_count >= promo.max_uses:
         logger.info("Promo exhausted code={} user_id={}", code, user_id)
+        await _mark_exhausted(promo)
         return None, "Промокод не найден или больше недоступен."
     q = await session.execute(
-        select(PromoRedemption).where(
-            PromoRedemption.promo_id == promo.id,
-            PromoRedemption.user_id == user_id,
-        )
+        select(PromoRedemption.id)
+        .where(PromoRedemption.promo_id == promo.id, PromoRedemption.user_id == user_id)
+        .limit(1)
     )
-    if q.scalar_one_or_none():
+    if q.first():
         logger.info("Promo already used code={} user_id={}", promo.code, user_id)
         return None, "Промокод не найден или больше недоступен."
     return promo, None
 
 
-async def redeem_promo_for_order(session: AsyncSession, *, order, user_id: int) -> bool:
+class _PromoRejected(Exception):
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _insert_redemption(*, promo_id: int, user_id: int, order_id: int | None):
+    return (
+        pg_insert(PromoRedemption)
+        .values(
+            promo_id=promo_id,
+            user_id=user_id,
+            order_id=order_id,
+            redeemed_at=datetime.now(timezone.utc),
+        )
+        .on_conflict_do_nothing(index_elements=[PromoRedemption.promo_id, PromoRedemption.user_id])
+        .returning(PromoRedemption.id)
+    )
+
+
+async def redeem_promo_for_order(session: AsyncSession, *, order, user_id: int, commit: bool = True) -> bool:
+    """Record the promo attached to a paid order.
+
+    The discount was granted when the order was created, so the use is
+    counted even if the code ran out meanwhile; the increment is still
+    done in SQL so concurrent payments cannot lose updates. With
+    commit=False the caller's transaction is left open.
+    """
     meta = load_order_meta(order)
     promo_id = meta.get("promo_id")
     if not promo_id:
         return False
 
-    q = await session.execute(select(PromoRedemption).where(PromoRedemption.order_id == order.id))
-    if q.scalar_one_or_none():
+    q = await session.execute(select(PromoRedemption.id).where(PromoRedemption.order_id == order.id))
+    if q.first():
         return False
 
-    promo_q = await session.execute(select(Promo).where(Promo.id == int(promo_id)))
-    promo = promo_q.scalar_one_or_none()
-    if not promo:
+    try:
+        async with session.begin_nested():
+            inserted = await session.execute(
+                _insert_redemption(promo_id=int(promo_id), user_id=user_id, order_id=order.id)
+            )
+            if inserted.first() is None:
+                raise _PromoRejected("already_redeemed")
+            updated = await session.execute(
+                update(Promo)
+                .where(Promo.id == int(promo_id))
+                .values(used_count=Promo.used_count + 1)
+                .returning(Promo.id)
+                .execution_options(synchronize_session=False)
+            )
+            if updated.first() is None:
+                raise _PromoRejected("not_found")
+    except _PromoRejected as exc:
+        logger.info("Promo not redeemed for order promo_id={} order_id={} reason={}", promo_id, order.id, exc.reason)
         return False
-
-    redemption = PromoRedemption(
-        promo_id=promo.id,
-        user_id=user_id,
-        order_id=order.id,
-        redeemed_at=datetime.now(timezone.utc),
-    )
-    promo.used_count = (promo.used_count or 0) + 1
-    session.add_all([promo, redemption])
-    await session.commit()
-    logger.info("Promo redeemed for order promo_id={} order_id={}", promo.id, order.id)
+    if commit:
+        await session.commit()
+    logger.info("Promo redeemed for order promo_id={} order_id={}", promo_id, order.id)
     return True
 
 
-async def redeem_promo_to_balance(session: AsyncSession, *, promo: Promo, user: User) -> int:
-    redemption = PromoRedemption(
-        promo_id=promo.id,
-        user_id=user.id,
-        order_id=None,
-        redeemed_at=datetime.now(timezone.utc),
-    )
-    promo.used_count = (promo.used_count or 0) + 1
-    user.balance_rub = (user.balance_rub or 0) + promo.discount_rub
-    session.add_all([promo, redemption, user])
-    await session.commit()
-    await session.refresh(user)
+async def redeem_promo_to_balance(session: AsyncSession, *, promo: Promo, user: User) -> int | None:
+    """Redeem a promo code to the user's balance in one short transaction.
+
+    - a Redis slot counter turns away bursts for an exhausted code without
+      touching Postgres;
+    - the unique (promo_id, user_id) index rejects repeat redemptions;
+    - `UPDATE ... WHERE used_count < max_uses RETURNING` is the
+      authoritative limit check, so balance redemptions never take
+      used_count past max_uses (uses recorded by `redeem_promo_for_order`
+      for already discounted orders are counted regardless).
+
+    Returns the new balance, or None when the code is exhausted/inactive or
+    was already used by this user.
+    """
+    if not await _reserve_slot(promo):
+        logger.info("Promo exhausted (slot gate) promo_id={} user_id={}", promo.id, user.id)
+        return None
+
+    try:
+        async with session.begin_nested():
+            inserted = await session.execute(
+                _insert_redemption(promo_id=promo.id, user_id=user.id, order_id=None)
+            )
+            if inserted.first() is None:
+                raise _PromoRejected("already_redeemed")
+            counted = await session.execute(
+                update(Promo)
+                .where(
+                    Promo.id == promo.id,
+                    Promo.active.is_(True),
+                    or_(Promo.max_uses == 0, Promo.used_count < Promo.max_uses),
+                )
+                .values(used_count=Promo.used_count + 1)
+                .returning(Promo.used_count, Promo.max_uses, Promo.discount_rub)
+                .execution_options(synchronize_session=False)
+            )
+            row = counted.first()
+            if row is None:
+                raise _PromoRejected("exhausted")
+            used_count, max_uses, discount_rub = row
+            balance = await session.execute(
+                update(User)
+                .where(User.id == user.id)
+                .values(balance_rub=User.balance_rub + discount_rub)
+                .returning(User.balance_rub)
+                .execution_options(synchronize_session=False)
+            )
+            new_balance = int(balance.scalar_one())
+        await session.commit()
+    except _PromoRejected as exc:
+        if exc.reason == "exhausted":
+            await _mark_exhausted(promo)
+        else:
+            await _release_slot(promo)
+        logger.info("Promo not redeemed promo_id={} user_id={} reason={}", promo.id, user.id, exc.reason)
+        return None
+    except Exception:
+        await _release_slot(promo)
+        raise
+
+    promo.used_count = int(used_count)
+    user.balance_rub = new_balance
+    if max_uses and used_count >= max_uses:
+        await _mark_exhausted(promo)
+    await invalidate_user_snapshot(user.tg_id)
     logger.info("Promo redeemed to balance promo_id={} user_id={}", promo.id, user.id)
-    return user.balance_rub
\ No newline at end of file
+    return new_balance
+
+
+# --- Redis hot-code gate -------------------------------------------------------
+# promo_slots:<id> holds the remaining uses of a limited code. It is seeded from
+# the DB, decremented on every attempt and given back when the DB rejects the
+# attempt for a per-user reason. Postgres stays the source of truth; the key
+# only sheds load once a code is used up, and expires to heal any drift.
+
+_SLOT_TTL_SECONDS = 300
+_EXHAUSTED_TTL_SECONDS = 300
+
+_RESERVE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+end
+return redis.call('DECR', KEYS[1])
+"""
+
+
+def _slots_key(promo_id: int) -> str:
+    return f"promo_slots:{promo_id}"
+
+
+def _exhausted_key(code: str) -> str:
+    return f"promo_exhausted:{code.lower()}"
+
+
+async def _reserve_slot(promo: Promo) -> bool:
+    if not promo.max_uses:
+        return True
+    redis = get_redis()
+    if redis is None:
+        return True
+    remaining = max(0, int(promo.max_uses) - int(promo.used_count or 0))
+    try:
+        left = await redis.eval(_RESERVE_LUA, 1, _slots_key(promo.id), remaining, _SLOT_TTL_SECONDS)
+    except Exception as exc:
+        logger.warning("Promo slot gate unavailable promo_id={}: {}", promo.id, exc)
+        return True
+    return int(left) >= 0
+
+
+async def _release_slot(promo: Promo) -> None:
+    if not promo.max_uses:
+        return
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.incr(_slots_key(promo.id))
+    except Exception as exc:
+        logger.warning("Promo slot release failed promo_id={}: {}", promo.id, exc)
+
+
+async def _mark_exhausted(promo: Promo) -> None:
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.set(_exhausted_key(promo.code), "1", ex=_EXHAUSTED_TTL_SECONDS)
+    except Exception as exc:
+        logger.warning("Promo exhausted flag failed promo_id={}: {}", promo.id, exc)
+
+
+async def _is_marked_exhausted(code: str) -> bool:
+    redis = get_redis()
+    if redis is None or not code:
+        return False
+    try:
+        return bool(await redis.exists(_exhausted_key(code)))
+    except Exception:
+        return False
+
+
+async def reset_promo_gate(promo: Promo) -> None:
+    """Drop cached slot/exhausted state after an admin change to the promo."""
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.delete(_slots_key(promo.id), _exhausted_key(promo.code))
+    except Exception as exc:
+        logger.warning("Promo gate reset failed promo_id={}: {}", promo.id, exc)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Background reconciliation of pending provider orders.
+
+Catches payments whose webhook was lost and closes abandoned orders:
+
+- CryptoPay: one getInvoices call per 100 pending invoices;
+- YooKassa: pages of succeeded payments since the oldest pending order
+  (created_at cursor), matched by payment id;
+- paid ones go through accept_provider_payment + mark_order_paid, the same
+  path as webhooks, each order reloaded fresh so one failure (and its
+  rollback) does not stop the rest of the pass; pending orders older than
+  PENDING_ORDER_EXPIRE_HOURS (or expired on the provider side) are canceled
+  with a conditional UPDATE, so an order paid meanwhile is left alone.
+"""
+
+from __future__ import annotations
+
+from collections import Counter
+from datetime import timedelta
+from typing import Any
+
+from loguru import logger
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..models import Order
+from .notifications import notify_payment_confirmed
+from .orders import accept_provider_payment, mark_order_paid
+from .payments import (
+    get_cryptopay_client,
+    get_yookassa_client,
+    is_cryptopay_paid,
+    is_yookassa_paid,
+)
+from .payments.common import merged_meta
+from .payments.checks import forget_provider_status
+from .subscriptions import now_utc
+
+_BATCH = 100
+_YOOKASSA_MAX_PAGES = 20
+_CRYPTOPAY_DEAD_STATUSES = {"expired"}
+
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def _pending_orders(session: AsyncSession) -> list[Order]:
+    cutoff = now_utc() - timedelta(seconds=settings.reconcile_min_age_seconds)
+    q = await session.execute(
+        select(Order)
+        .where(
+            Order.status == "pending",
+            Order.provider.in_(("cryptopay", "yookassa")),
+            Order.provider_payment_id.is_not(None),
+            Order.created_at < cutoff,
+        )
+        .order_by(Order.created_at.asc())
+        .limit(settings.reconcile_max_orders)
+    )
+    return list(q.scalars().all())
+
+
+async def _cryptopay_results(orders: list[Order]) -> tuple[dict[int, dict[str, Any]], set[int]]:
+    """(paid order id -> raw invoice, order ids whose invoice expired)."""
+    client = get_cryptopay_client()
+    paid: dict[int, dict[str, Any]] = {}
+    dead: set[int] = set()
+    if client is None:
+        return paid, dead
+    for chunk in _chunks(orders, _BATCH):
+        by_invoice = {int(o.provider_payment_id): o for o in chunk if str(o.provider_payment_id).isdigit()}
+        invoices = await client.get_invoices(list(by_invoice))
+        for invoice in invoices:
+            order = by_invoice.get(invoice.invoice_id)
+            if order is None:
+                continue
+            if is_cryptopay_paid(invoice.status):
+                paid[order.id] = invoice.raw
+            elif invoice.status in _CRYPTOPAY_DEAD_STATUSES:
+                dead.add(order.id)
+    return paid, dead
+
+
+async def _yookassa_results(orders: list[Order]) -> tuple[dict[int, dict[str, Any]], set[int]]:
+    """(paid order id -> raw payment, order ids left unresolved by the page cap)."""
+    client = get_yookassa_client()
+    paid: dict[int, dict[str, Any]] = {}
+    if client is None or not orders:
+        return paid, set()
+    by_payment = {str(o.provider_payment_id): o for o in orders}
+    created_gte = min(o.created_at for o in orders) - timedelta(minutes=5)
+    cursor: str | None = None
+    for _ in range(_YOOKASSA_MAX_PAGES):
+        payments, cursor = await client.list_payments(
+            created_gte=created_gte, status="succeeded", cursor=cursor, limit=_BATCH
+        )
+        for payment in payments:
+            order = by_payment.pop(payment.payment_id, None)
+            if order is not None and is_yookassa_paid(payment.status):
+                paid[order.id] = payment.raw
+        if not cursor or not by_payment:
+            break
+    unresolved = {o.id for o in by_payment.values()} if cursor else set()
+    return paid, unresolved
+
+
+async def _cancel_expired(session: AsyncSession, order_ids: list[int]) -> int:
+    res = await session.execute(
+        update(Order)
+        .where(Order.id.in_(order_ids), Order.status == "pending")
+        .values(status="canceled", meta_json=merged_meta({"cancel_reason": "expired", "canceled_by": "reconciler"}))
+        .returning(Order.id)
+        .execution_options(synchronize_session=False)
+    )
+    canceled = len(res.all())
+    await session.commit()
+    return canceled
+
+
+async def reconcile_pending_orders(session: AsyncSession) -> Counter:
+    stats: Counter = Counter()
+    orders = await _pending_orders(session)
+    if not orders:
+        return stats
+
+    # Orders of an unconfigured provider are neither checked nor expired.
+    crypto_orders = [o for o in orders if o.provider == "cryptopay"] if get_cryptopay_client() else []
+    yk_orders = [o for o in orders if o.provider == "yookassa"] if get_yookassa_client() else []
+
+    paid: dict[int, dict[str, Any]] = {}
+    dead: set[int] = set()
+    try:
+        crypto_paid, dead = await _cryptopay_results(crypto_orders)
+        paid.update(crypto_paid)
+        stats["cryptopay_checked"] = len(crypto_orders)
+    except Exception as exc:
+        logger.warning("Reconcile: CryptoPay lookup failed: {}", exc)
+        crypto_orders = []
+    unresolved: set[int] = set()
+    try:
+        yk_paid, unresolved = await _yookassa_results(yk_orders)
+        paid.update(yk_paid)
+        stats["yookassa_checked"] = len(yk_orders)
+    except Exception as exc:
+        logger.warning("Reconcile: YooKassa lookup failed: {}", exc)
+        yk_orders = []
+
+    # Plain values: a rollback below expires the loaded orders.
+    paid_refs = [(o.id, o.provider) for o in orders if o.id in paid]
+    expire_before = now_utc() - timedelta(hours=settings.pending_order_expire_hours)
+    checked = {o.id for o in crypto_orders} | {o.id for o in yk_orders}
+    expired_ids = [
+        o.id
+        for o in orders
+        if o.id not in paid
+        and o.id in checked
+        and o.id not in unresolved
+        and (o.id in dead or o.created_at < expire_before)
+    ]
+    if expired_ids:
+        # Only orders still pending: one paid by a webhook meanwhile is left alone.
+        stats["expired"] = await _cancel_expired(session, expired_ids)
+
+    for order_id, provider in paid_refs:
+        try:
+            order = await session.get(Order, order_id, populate_existing=True)
+            if order is None or not await accept_provider_payment(
+                session, order, provider=provider, provider_id=order.provider_payment_id, raw_payload=paid[order_id]
+            ):
+                stats["rejected"] += 1
+                continue
+            new_exp, notes = await mark_order_paid(session=session, order=order)
+            await forget_provider_status(order_id)
+            stats["paid"] += 1
+            if "already_paid" not in notes:
+                await notify_payment_confirmed(session, order, new_exp)
+            logger.info("Reconcile: order {} confirmed as paid ({})", order_id, provider)
+        except Exception as exc:
+            await session.rollback()
+            stats["failed"] += 1
+            logger.warning("Reconcile: failed to apply payment for order {}: {}", order_id, exc)
+    return stats
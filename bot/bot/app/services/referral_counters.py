@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+from loguru import logger
+from sqlalchemy import func, literal_column, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..cache import get_redis
+from ..config import settings
+from ..models import ReferralCounter
+
+_RECOMPUTE_LOCK_KEY = "referral_counters:recompute"
+
+
+async def bump_referral_counter(
+    session: AsyncSession,
+    inviter_id: int,
+    *,
+    invited: int = 0,
+    applied_seconds: int = 0,
+) -> None:
+    """Atomically add deltas to the inviter's counters (upsert, no commit).
+
+    Runs inside the caller's transaction so counters change together with
+    the user/event rows they describe.
+    """
+    if not invited and not applied_seconds:
+        return
+    stmt = pg_insert(ReferralCounter).values(
+        inviter_id=inviter_id,
+        invited_count=max(0, invited),
+        lifetime_applied_seconds=max(0, applied_seconds),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ReferralCounter.inviter_id],
+        set_={
+            "invited_count": func.greatest(0, ReferralCounter.invited_count + invited),
+            "lifetime_applied_seconds": func.greatest(
+                0, ReferralCounter.lifetime_applied_seconds + applied_seconds
+            ),
+            "updated_at": func.now(),
+        },
+    )
+    await session.execute(stmt)
+
+
+async def get_referral_counter(session: AsyncSession, inviter_id: int) -> tuple[int, int]:
+    """(invited_count, lifetime_applied_seconds) by primary key."""
+    counter = await session.get(ReferralCounter, inviter_id)
+    if not counter:
+        return 0, 0
+    return int(counter.invited_count or 0), int(counter.lifetime_applied_seconds or 0)
+
+
+_BACKFILL_SQL = """
+INSERT INTO referral_counters (inviter_id, invited_count, lifetime_applied_seconds, updated_at)
+SELECT inviter_id, SUM(invited_count), SUM(applied_seconds), NOW()
+FROM (
+    SELECT inviter_id, COUNT(*) AS invited_count, 0::bigint AS applied_seconds
+    FROM users
+    WHERE inviter_id IS NOT NULL
+    GROUP BY inviter_id
+    UNION ALL
+    SELECT inviter_id, 0 AS invited_count, COALESCE(SUM(applied_seconds), 0)::bigint AS applied_seconds
+    FROM referral_events
+    WHERE inviter_id IS NOT NULL AND reversed_at IS NULL
+    GROUP BY inviter_id
+) AS agg
+WHERE EXISTS (SELECT 1 FROM users u WHERE u.id = agg.inviter_id)
+GROUP BY inviter_id
+ON CONFLICT (inviter_id) DO UPDATE SET
+    invited_count = EXCLUDED.invited_count,
+    lifetime_applied_seconds = EXCLUDED.lifetime_applied_seconds,
+    updated_at = NOW()
+"""
+
+# Inviters left without any invitee or live event (deleted users, manual edits)
+_RESET_ORPHANS_SQL = """
+UPDATE referral_counters rc
+SET invited_count = 0, lifetime_applied_seconds = 0, updated_at = NOW()
+WHERE (rc.invited_count <> 0 OR rc.lifetime_applied_seconds <> 0)
+  AND NOT EXISTS (SELECT 1 FROM users u WHERE u.inviter_id = rc.inviter_id)
+  AND NOT EXISTS (
+      SELECT 1 FROM referral_events e WHERE e.inviter_id = rc.inviter_id AND e.reversed_at IS NULL
+  )
+"""
+
+
+async def backfill_referral_counters(session: AsyncSession) -> int:
+    """Recompute every inviter's counters from users/referral_events.
+
+    Idempotent; safe to re-run at any time to repair drift.
+    Returns the number of inviters written.
+    """
+    result = await session.execute(text(_BACKFILL_SQL))
+    reset = await session.execute(text(_RESET_ORPHANS_SQL))
+    await session.commit()
+    rows = max(result.rowcount or 0, 0) + max(reset.rowcount or 0, 0)
+    logger.info("Referral counters backfilled: {} inviters", rows)
+    return rows
+
+
+async def backfill_referral_counters_if_empty(session: AsyncSession) -> None:
+    """Startup hook: populate counters once after the table is introduced."""
+    q = await session.execute(select(literal_column("1")).select_from(ReferralCounter).limit(1))
+    if q.first() is not None:
+        return
+    await backfill_referral_counters(session)
+
+
+async def recompute_referral_counters(session: AsyncSession) -> int | None:
+    """Periodic drift repair (crash between updates, manual DB edits).
+
+    A bump committed while the recompute runs can be overwritten by its
+    snapshot; the next run repairs that too.
+
+    With Redis only one replica runs it per REFERRAL_COUNTERS_RECOMPUTE_HOURS;
+    returns None when another one already did.
+    """
+    redis = get_redis()
+    ttl = max(3600, settings.referral_counters_recompute_hours * 3600) - 60
+    if redis is not None and not await redis.set(_RECOMPUTE_LOCK_KEY, "1", nx=True, ex=ttl):
+        return None
+    return await backfill_referral_counters(session)
@@ -6,6 +6,8 @@ from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..models import Order, ReferralEvent, ReferralWindow, Subscription, User
+from .referral_counters import bump_referral_counter, get_referral_counter
+from .snapshots import invalidate_user_snapshot_by_user_id
 from .subscriptions import get_or_create_subscription, is_active, now_utc
 
 DAY = 24 * 3600
@@ -47,22 +49,23 @@ def _months_key(plan_code: str, months: int) -> int:
 
 
 async def get_referral_summary(session: AsyncSession, inviter_id: int) -> tuple[int, int, ReferralWindow | None]:
-    q = await session.execute(select(User).where(User.inviter_id == inviter_id))
-    invited_count = len(list(q.scalars().all()))
-
-    q2 = await session.execute(
-        select(ReferralEvent).where(
-            ReferralEvent.inviter_id == inviter_id,
-            ReferralEvent.reversed_at.is_(None),
-        )
-    )
-    total = sum(e.applied_seconds for e in q2.scalars().all())
-
+    invited_count, total = await get_referral_counter(session, inviter_id)
     window = await session.get(ReferralWindow, inviter_id)
     return invited_count, total, window
 
 
-async def maybe_grant_referral_bonus(*, session: AsyncSession, referral_user_id: int, order: Order) -> int:
+async def maybe_grant_referral_bonus(
+    *,
+    session: AsyncSession,
+    referral_user_id: int,
+    order: Order,
+    commit: bool = True,
+) -> int:
+    """Grant the inviter's bonus for a paid order; returns applied seconds.
+
+    With commit=False the changes are only flushed and the caller commits
+    (and invalidates the inviter's snapshot) as part of its own transaction.
+    """
     if order.kind != "subscription":
         return 0
     if order.status != "paid":
@@ -128,8 +131,14 @@ async def maybe_grant_referral_bonus(*, session: AsyncSession, referral_user_id:
         window.applied_seconds = int(window.applied_seconds) + int(applied)
         session.add(sub)
         session.add(window)
+        await bump_referral_counter(session, inviter_id, applied_seconds=int(applied))
 
+    if not commit:
+        await session.flush()
+        return int(applied)
     await session.commit()
+    if applied > 0:
+        await invalidate_user_snapshot_by_user_id(session, inviter_id)
     return int(applied)
 
 
@@ -164,8 +173,12 @@ async def rollback_referral_bonus_for_order(session: AsyncSession, order_id: int
     ev.reversed_at = now
     ev.reversal_reason = reason
     session.add(ev)
+    if inviter_id:
+        await bump_referral_counter(session, inviter_id, applied_seconds=-applied)
 
     await session.commit()
+    if inviter_id:
+        await invalidate_user_snapshot_by_user_id(session, inviter_id)
     return applied
 
 
@@ -176,9 +189,7 @@ async def get_referral_stats(session: AsyncSession, inviter_id: int) -> dict:
     """
     now = now_utc()
 
-    q = await session.execute(select(User.id).where(User.inviter_id == inviter_id))
-    invited = q.scalars().all()
-    invited_count = len(invited)
+    invited_count, _ = await get_referral_counter(session, inviter_id)
 
     window = await session.get(ReferralWindow, inviter_id)
     if not window or not window.window_end_at or window.window_end_at < now:
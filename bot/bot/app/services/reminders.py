@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Scheduled subscription expiry reminders.
+
+Every REMINDERS_INTERVAL_SECONDS the bot finds the subscriptions due for a
+reminder in one query over the subscriptions(expires_at) index and puts them
+into buckets:
+
+- "3d": expires in 1-3 days, only for periods longer than that window (a
+  48h trial would otherwise be told "a few days left" right after it starts);
+- "1d": expires within a day;
+- "expired": expired during the last day (older expiries are left alone,
+  so enabling reminders does not message every lapsed user at once).
+
+A reminder is claimed in `subscription_reminders` (unique per user, bucket
+and expiry date) before it is sent, so replicas and restarts never send it
+twice; a renewal moves expires_at and the next period gets new reminders.
+Messages go through the shared broadcast token bucket in pages of
+REMINDERS_BATCH_SIZE.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from datetime import timedelta
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import and_, case, exists, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..metrics import Counter
+from ..models import Subscription, SubscriptionReminder, User
+from ..utils.text import fmt_dt, h
+from .broadcasts import TokenBucket, send_limited
+from .catalog import list_paid_plans, plan_title
+from .subscriptions import now_utc
+
+reminder_messages = Counter("expiry_reminders_total", "Expiry reminders by bucket and outcome")
+
+
+def _due_reminders(limit: int, after_sub_id: int):
+    now = now_utc()
+    kind = case(
+        (Subscription.expires_at <= now, "expired"),
+        (Subscription.expires_at <= now + timedelta(days=1), "1d"),
+        else_="3d",
+    )
+    already_sent = exists().where(
+        SubscriptionReminder.user_id == Subscription.user_id,
+        SubscriptionReminder.kind == kind,
+        SubscriptionReminder.expires_at == Subscription.expires_at,
+    )
+    return (
+        select(Subscription.id, Subscription.user_id, User.tg_id, Subscription.plan_code, Subscription.expires_at, kind)
+        .join(User, User.id == Subscription.user_id)
+        .where(
+            and_(
+                Subscription.expires_at > now - timedelta(days=1),
+                Subscription.expires_at <= now + timedelta(days=3),
+            ),
+            or_(
+                Subscription.expires_at <= now + timedelta(days=1),
+                Subscription.started_at.is_(None),
+                Subscription.started_at < Subscription.expires_at - timedelta(days=3),
+            ),
+            Subscription.id > after_sub_id,
+            User.is_banned.is_(False),
+            ~already_sent,
+        )
+        .order_by(Subscription.id)
+        .limit(limit)
+    )
+
+
+def _reminder_text(kind: str, plan_code: str, expires_at) -> str:
+    if kind == "expired":
+        head = "⛔️ Срок вашей подписки истёк."
+        tail = "Продлите подписку, чтобы снова подключиться."
+    else:
+        head = "⚠️ Ваша подписка закончится " + ("в течение суток." if kind == "1d" else "через несколько дней.")
+        tail = "Продлите подписку заранее, чтобы не потерять доступ."
+    until = "Истекла" if kind == "expired" else "Действует до"
+    return f"{head}\nТариф: {h(plan_title(plan_code))}\n{until}: {fmt_dt(expires_at)}\n\n{tail}"
+
+
+def _reminder_kb(plan_code: str) -> InlineKeyboardMarkup:
+    if plan_code in list_paid_plans():
+        button = InlineKeyboardButton(text='🔄 Продлить', callback_data='sub:renew')
+    else:
+        button = InlineKeyboardButton(text='💳 Выбрать тариф', callback_data='buy:plans')
+    return InlineKeyboardMarkup(inline_keyboard=[[button]])
+
+
+async def _claim(session: AsyncSession, rows: list) -> set[tuple[int, str]]:
+    res = await session.execute(
+        pg_insert(SubscriptionReminder)
+        .values([{"user_id": user_id, "kind": kind, "expires_at": expires_at} for _, user_id, _, _, expires_at, kind in rows])
+        .on_conflict_do_nothing(
+            index_elements=[SubscriptionReminder.user_id, SubscriptionReminder.kind, SubscriptionReminder.expires_at]
+        )
+        .returning(SubscriptionReminder.user_id, SubscriptionReminder.kind)
+    )
+    claimed = {(int(user_id), kind) for user_id, kind in res.all()}
+    await session.commit()
+    return claimed
+
+
+async def send_expiry_reminders(session: AsyncSession, bot: Bot, bucket: TokenBucket) -> dict[str, int]:
+    """One pass over the due reminders; returns counts by outcome."""
+    batch = max(1, settings.reminders_batch_size)
+    in_flight = asyncio.Semaphore(max(1, settings.broadcast_concurrency))
+    stats: dict[str, int] = {}
+
+    async def one(kind: str, tg_id: int, plan_code: str, expires_at) -> None:
+        async with in_flight:
+            result = await send_limited(bot, bucket, tg_id, _reminder_text(kind, plan_code, expires_at), _reminder_kb(plan_code))
+        reminder_messages.inc(kind=kind, result=result)
+        stats[result] = stats.get(result, 0) + 1
+
+    cursor = 0
+    while True:
+        rows = (await session.execute(_due_reminders(batch, cursor))).all()
+        if not rows:
+            break
+        cursor = rows[-1][0]
+        # Claimed by another replica in the meantime -> not ours to send
+        claimed = await _claim(session, rows)
+        if len(claimed) < len(rows):
+            stats["skipped"] = stats.get("skipped", 0) + len(rows) - len(claimed)
+        await asyncio.gather(
+            *(
+                one(kind, tg_id, plan_code, expires_at)
+                for _, user_id, tg_id, plan_code, expires_at, kind in rows
+                if (user_id, kind) in claimed
+            )
+        )
+    return stats
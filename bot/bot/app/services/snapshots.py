@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..cache import get_redis
+from ..config import settings
+from ..models import Subscription, User
+from .users import profile_fields
+
+_KEY_PREFIX = "user_snap:"
+
+
+def _key(tg_id: int) -> str:
+    return f"{_KEY_PREFIX}{tg_id}"
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Small read-only projection of User + Subscription for menu screens."""
+
+    tg_id: int
+    user_id: int
+    username: str | None
+    first_name: str | None
+    locale: str | None
+    is_banned: bool
+    is_admin: bool
+    onboarding_done: bool
+    balance_rub: int
+    plan_code: str
+    devices_limit: int
+    trial_used: bool
+    expires_at: datetime | None
+
+    @property
+    def has_active_subscription(self) -> bool:
+        return bool(self.expires_at and self.expires_at > datetime.now(timezone.utc))
+
+    def matches_profile(self, tg_user) -> bool:
+        return (self.username, self.first_name, self.locale) == profile_fields(tg_user) and self.is_admin == (
+            tg_user.id in settings.admin_id_list
+        )
+
+    @classmethod
+    def from_models(cls, user: User, sub: Subscription) -> "UserSnapshot":
+        return cls(
+            tg_id=int(user.tg_id),
+            user_id=int(user.id),
+            username=user.username,
+            first_name=user.first_name,
+            locale=user.locale,
+            is_banned=bool(user.is_banned),
+            is_admin=bool(user.is_admin),
+            onboarding_done=bool(user.onboarding_done),
+            balance_rub=int(user.balance_rub or 0),
+            plan_code=sub.plan_code,
+            devices_limit=int(sub.devices_limit),
+            trial_used=bool(sub.trial_used),
+            expires_at=sub.expires_at,
+        )
+
+    def to_hash(self) -> dict[str, str]:
+        return {
+            "tg_id": str(self.tg_id),
+            "user_id": str(self.user_id),
+            # "\0" marks NULL so that it is distinguishable from an empty username
+            "username": self.username if self.username is not None else "\0",
+            "first_name": self.first_name if self.first_name is not None else "\0",
+            "locale": self.locale if self.locale is not None else "\0",
+            "is_banned": "1" if self.is_banned else "0",
+            "is_admin": "1" if self.is_admin else "0",
+            "onboarding_done": "1" if self.onboarding_done else "0",
+            "balance_rub": str(self.balance_rub),
+            "plan_code": self.plan_code,
+            "devices_limit": str(self.devices_limit),
+            "trial_used": "1" if self.trial_used else "0",
+            "expires_at": str(self.expires_at.timestamp()) if self.expires_at else "",
+        }
+
+    @classmethod
+    def from_hash(cls, data: dict[str, str]) -> "UserSnapshot | None":
+        if not data:
+            return None
+
+        def _opt(name: str) -> str | None:
+            value = data.get(name)
+            return None if value == "\0" else value
+
+        try:
+            expires_raw = data.get("expires_at") or ""
+            return cls(
+                tg_id=int(data["tg_id"]),
+                user_id=int(data["user_id"]),
+                username=_opt("username"),
+                first_name=_opt("first_name"),
+                locale=_opt("locale"),
+                is_banned=data.get("is_banned") == "1",
+                is_admin=data.get("is_admin") == "1",
+                onboarding_done=data.get("onboarding_done") == "1",
+                balance_rub=int(data.get("balance_rub") or 0),
+                plan_code=data.get("plan_code") or "trial",
+                devices_limit=int(data.get("devices_limit") or 1),
+                trial_used=data.get("trial_used") == "1",
+                expires_at=datetime.fromtimestamp(float(expires_raw), tz=timezone.utc) if expires_raw else None,
+            )
+        except (KeyError, ValueError):
+            return None
+
+
+async def get_user_snapshot(tg_id: int) -> UserSnapshot | None:
+    redis = get_redis()
+    if redis is None:
+        return None
+    try:
+        data = await redis.hgetall(_key(tg_id))
+    except Exception as exc:
+        logger.warning("User snapshot read failed tg_id={}: {}", tg_id, exc)
+        return None
+    return UserSnapshot.from_hash(data)
+
+
+async def store_user_snapshot(user: User, sub: Subscription) -> UserSnapshot:
+    """Write-through: call after the commit that changed user/subscription fields."""
+    snap = UserSnapshot.from_models(user, sub)
+    redis = get_redis()
+    if redis is None:
+        return snap
+    key = _key(snap.tg_id)
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping=snap.to_hash())
+            pipe.expire(key, settings.user_snapshot_ttl_seconds)
+            await pipe.execute()
+    except Exception as exc:
+        logger.warning("User snapshot write failed tg_id={}: {}", snap.tg_id, exc)
+    return snap
+
+
+async def invalidate_user_snapshot(*tg_ids: int) -> None:
+    redis = get_redis()
+    if redis is None or not tg_ids:
+        return
+    try:
+        await redis.delete(*(_key(tg_id) for tg_id in tg_ids))
+    except Exception as exc:
+        logger.warning("User snapshot invalidation failed tg_ids={}: {}", tg_ids, exc)
+
+
+async def invalidate_user_snapshot_by_user_id(session: AsyncSession, user_id: int) -> None:
+    # Usually an identity-map hit: the caller has just worked with this user.
+    user = await session.get(User, user_id)
+    if user is not None:
+        await invalidate_user_snapshot(int(user.tg_id))
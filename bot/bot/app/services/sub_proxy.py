@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""Caching proxy for Marzban subscription URLs (`/sub/{token}`).
+
+VPN clients re-fetch their subscription every few minutes; with
+SUB_PROXY_ENABLED the links we hand out point here instead of at the panel:
+
+- the token is the Marzban username with its own HMAC plus an HMAC of the
+  current upstream subscription URL, so a revoke (new upstream URL) kills
+  old links; a token with a bad username MAC is rejected before any Redis
+  or Marzban work, and a signature Marzban did not confirm is remembered
+  for SUB_PROXY_CACHE_SECONDS instead of asking the panel again;
+- responses are cached per device and client variant (User-Agent and the
+  optional client type decide the format Marzban returns) in a Redis hash
+  `subproxy:{username}` for SUB_PROXY_CACHE_SECONDS; concurrent misses share
+  one upstream fetch; if the panel is down a stale copy (up to
+  SUB_PROXY_STALE_SECONDS old) is served instead of an error;
+- responses carry an ETag and answer If-None-Match with 304;
+- each device may make SUB_PROXY_RATE_LIMIT verified requests per
+  SUB_PROXY_RATE_WINDOW_SECONDS (needs Redis);
+- `invalidate_subscription_proxy()` drops a device's entries on revoke and
+  status changes.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import json
+import time
+from dataclasses import dataclass
+
+from loguru import logger
+
+from ..cache import get_redis
+from ..config import settings
+from ..metrics import Counter
+from ..utils.connect import create_subscription_token, subscription_token_matches
+from ..utils.http import get_http_client
+from ..utils.urls import build_public_url, make_absolute_url
+
+sub_requests = Counter("sub_proxy_requests_total", "Subscription proxy requests by outcome")
+
+CLIENT_TYPES = frozenset({"sing-box", "clash-meta", "clash", "outline", "v2ray", "v2ray-json"})
+
+# Upstream headers the clients use (traffic/expiry info, update interval, profile title...)
+_PASS_HEADERS = (
+    "content-type",
+    "content-disposition",
+    "subscription-userinfo",
+    "profile-update-interval",
+    "profile-title",
+    "profile-web-page-url",
+    "support-url",
+    "announce",
+    "announce-url",
+    "routing",
+)
+_SRC_FIELD = "src"
+_LOCAL_MAX = 10_000
+
+
+class SubscriptionRateLimited(RuntimeError):
+    pass
+
+
+class SubscriptionUnavailable(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class SubscriptionContent:
+    status: int
+    body: bytes
+    headers: dict[str, str]
+    etag: str
+    fetched_at: float
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "status": self.status,
+                "body": base64.b64encode(self.body).decode("ascii"),
+                "headers": self.headers,
+                "etag": self.etag,
+                "ts": self.fetched_at,
+            }
+        )
+
+    @classmethod
+    def from_json(cls, raw: str) -> "SubscriptionContent":
+        data = json.loads(raw)
+        return cls(int(data["status"]), base64.b64decode(data["body"]), dict(data["headers"]), data["etag"], float(data["ts"]))
+
+
+# ---- storage: Redis hash per device, process-local dict without Redis ----
+
+_local: dict[str, dict[str, str]] = {}
+_inflight: dict[tuple[str, str], asyncio.Task] = {}
+
+
+def _key(username: str) -> str:
+    return f"subproxy:{username}"
+
+
+async def _hget(username: str, field: str) -> str | None:
+    redis = get_redis()
+    if redis is None:
+        return _local.get(username, {}).get(field)
+    try:
+        return await redis.hget(_key(username), field)
+    except Exception as exc:
+        logger.warning("Subscription proxy cache read failed: {}", exc)
+        return None
+
+
+async def _hset(username: str, field: str, value: str) -> None:
+    redis = get_redis()
+    if redis is None:
+        if username not in _local and len(_local) >= _LOCAL_MAX:
+            _local.pop(next(iter(_local)), None)
+        _local.setdefault(username, {})[field] = value
+        return
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.hset(_key(username), field, value)
+            pipe.expire(_key(username), max(settings.sub_proxy_stale_seconds, settings.sub_proxy_cache_seconds))
+            await pipe.execute()
+    except Exception as exc:
+        logger.warning("Subscription proxy cache write failed: {}", exc)
+
+
+async def invalidate_subscription_proxy(*usernames: str) -> None:
+    usernames = tuple(u for u in usernames if u)
+    for username in usernames:
+        _local.pop(username, None)
+    redis = get_redis()
+    if redis is None or not usernames:
+        return
+    try:
+        await redis.delete(*(_key(username) for username in usernames))
+    except Exception as exc:
+        logger.warning("Subscription proxy invalidation failed: {}", exc)
+
+
+# ---- links ----
+
+
+async def proxied_subscription_url(marzban_username: str, upstream_url: str | None) -> str | None:
+    """Our /sub link for the device, or `upstream_url` when the proxy is off or has no public URL."""
+    if not (settings.sub_proxy_enabled and settings.public_base_url and upstream_url):
+        return upstream_url
+    token = create_subscription_token(marzban_username=marzban_username, upstream_url=upstream_url)
+    url = build_public_url(f"/sub/{token}")
+    if not url:
+        return upstream_url
+    if await _hget(marzban_username, _SRC_FIELD) != upstream_url:
+        await _hset(marzban_username, _SRC_FIELD, upstream_url)
+    return url
+
+
+async def _lookup_upstream(username: str) -> str | None:
+    from .device_links import marzban_client
+
+    try:
+        user = await marzban_client().get_user(username)
+    except Exception as exc:
+        logger.warning("Subscription proxy: Marzban lookup failed for {}: {}", username, exc)
+        return None
+    upstream = make_absolute_url((user or {}).get("subscription_url"))
+    if upstream:
+        await _hset(username, _SRC_FIELD, upstream)
+    return upstream
+
+
+async def _verified_upstream(username: str, signature: str) -> str | None:
+    upstream = await _hget(username, _SRC_FIELD)
+    if upstream and subscription_token_matches(signature, upstream):
+        return upstream
+    # Revoked links keep polling: remember the miss instead of asking Marzban every time
+    rejected_field = f"x:{signature[:32]}"
+    rejected_at = await _hget(username, rejected_field)
+    if rejected_at and time.time() - float(rejected_at) < settings.sub_proxy_cache_seconds:
+        return None
+    # Unknown device here or the URL changed (revoked from the panel): ask Marzban once
+    upstream = await _lookup_upstream(username)
+    if upstream and subscription_token_matches(signature, upstream):
+        return upstream
+    await _hset(username, rejected_field, repr(time.time()))
+    return None
+
+
+# ---- requests ----
+
+
+async def _rate_limited(username: str) -> bool:
+    redis = get_redis()
+    if redis is None or settings.sub_proxy_rate_limit <= 0:
+        return False
+    window = max(1, settings.sub_proxy_rate_window_seconds)
+    key = f"subproxy:rl:{username}:{int(time.time() // window)}"
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.incr(key)
+            pipe.expire(key, window)
+            count, _ = await pipe.execute()
+    except Exception:
+        return False
+    return int(count) > settings.sub_proxy_rate_limit
+
+
+async def _fetch(upstream: str, *, client_type: str, user_agent: str, query: str) -> SubscriptionContent:
+    url = upstream.rstrip("/") + (f"/{client_type}" if client_type else "")
+    if query:
+        url += f"?{query}"
+    client = get_http_client("marzban_sub", verify=settings.marzban_verify_ssl)
+    resp = await client.get(url, headers={"User-Agent": user_agent, "Accept": "*/*"})
+    headers = {name: resp.headers[name] for name in _PASS_HEADERS if name in resp.headers}
+    body = resp.content
+    etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+    return SubscriptionContent(resp.status_code, body, headers, etag, time.time())
+
+
+async def _refresh(username: str, variant: str, upstream: str, stale: SubscriptionContent | None, **request) -> SubscriptionContent:
+    try:
+        content = await _fetch(upstream, **request)
+    except Exception as exc:
+        content, error = None, exc
+    else:
+        error = None
+        if content.status == 200:
+            await _hset(username, variant, content.to_json())
+            sub_requests.inc(result="miss")
+            return content
+        if content.status < 500:
+            sub_requests.inc(result="upstream_status")
+            return content  # e.g. 404 after a revoke: pass through, do not cache
+    if stale is not None and time.time() - stale.fetched_at <= settings.sub_proxy_stale_seconds:
+        sub_requests.inc(result="stale")
+        logger.warning("Subscription proxy serving stale copy for {}: {}", username, error or content.status)
+        return stale
+    sub_requests.inc(result="upstream_error")
+    raise SubscriptionUnavailable(str(error or f"upstream status {content.status}"))
+
+
+async def get_subscription(
+    username: str,
+    signature: str,
+    *,
+    client_type: str = "",
+    user_agent: str = "",
+    query: str = "",
+) -> SubscriptionContent | None:
+    """Subscription content for a /sub request; None when the token is not valid (anymore).
+
+    `username` must come from `parse_subscription_token`, which checked its MAC.
+    """
+    if client_type and client_type not in CLIENT_TYPES:
+        sub_requests.inc(result="invalid")
+        return None
+    upstream = await _verified_upstream(username, signature)
+    if upstream is None:
+        sub_requests.inc(result="invalid")
+        return None
+    if await _rate_limited(username):
+        sub_requests.inc(result="limited")
+        raise SubscriptionRateLimited(username)
+
+    variant = "c:" + hashlib.sha1(f"{client_type}|{user_agent}|{query}".encode("utf-8")).hexdigest()[:16]
+    raw = await _hget(username, variant)
+    cached = SubscriptionContent.from_json(raw) if raw else None
+    if cached is not None and time.time() - cached.fetched_at < settings.sub_proxy_cache_seconds:
+        sub_requests.inc(result="hit")
+        return cached
+
+    key = (username, variant)
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(
+            _refresh(username, variant, upstream, cached, client_type=client_type, user_agent=user_agent, query=query)
+        )
+        _inflight[key] = task
+        task.add_done_callback(lambda _t: _inflight.pop(key, None))
+    return await asyncio.shield(task)
@@ -9,6 +9,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..models import Subscription, User
 from .catalog import PlanOption, TRIAL_HOURS, get_plan_option
+from .snapshots import store_user_snapshot
 
 from loguru import logger
 
@@ -82,16 +83,15 @@ async def activate_trial(session: AsyncSession, user: User) -> tuple[bool, str]:
     session.add(sub)
     await session.commit()
     await session.refresh(sub)
+    await store_user_snapshot(user, sub)
     logger.info("Trial activated user_id={} expires_at={}", user.id, sub.expires_at)
     return True, "Бесплатный доступ активирован."
 
 
-async def apply_plan_purchase(session: AsyncSession, user: User, opt: PlanOption) -> datetime:
-    """Apply a paid plan purchase/renewal.
+async def extend_subscription(session: AsyncSession, user: User, opt: PlanOption) -> tuple[Subscription, datetime]:
+    """Apply a plan to the user's subscription in the current transaction (no commit).
 
     Extends existing subscription if it is active, otherwise starts from now.
-
-    Returns the new expires_at value (UTC datetime).
     """
     sub = await get_or_create_subscription(session, user.id)
 
@@ -105,8 +105,18 @@ async def apply_plan_purchase(session: AsyncSession, user: User, opt: PlanOption
     sub.expires_at = new_expires
 
     session.add(sub)
+    return sub, new_expires
+
+
+async def apply_plan_purchase(session: AsyncSession, user: User, opt: PlanOption) -> datetime:
+    """Apply a paid plan purchase/renewal and commit.
+
+    Returns the new expires_at value (UTC datetime).
+    """
+    sub, new_expires = await extend_subscription(session, user, opt)
     await session.commit()
     await session.refresh(sub)
+    await store_user_snapshot(user, sub)
     logger.info("Subscription updated user_id={} plan={} expires_at={}", user.id, opt.code, sub.expires_at)
     return new_expires
 
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""Telegram updates in webhook mode: sharded Redis Streams, one owner per shard.
+
+TELEGRAM_MODE=webhook replaces long polling. The HTTP endpoint only checks
+the secret token and `enqueue_update()`s the raw update, so Telegram gets
+its 200 in a few milliseconds. Bot replicas then process the updates:
+
+- an update goes to shard `user_id % TELEGRAM_UPDATE_SHARDS` (chat id when
+  there is no user), one Redis Stream per shard;
+- each shard is owned by one replica at a time (a Redis lease renewed every
+  few seconds) and its updates are handled one after another, so the updates
+  of one user are always processed in order; replicas split the shards
+  evenly and a dead replica's shards are taken over when its lease expires;
+- handlers of all owned shards share TELEGRAM_UPDATE_WORKERS slots;
+- an entry is XACKed after its handler returned or failed (as in polling,
+  a failing handler is logged, not retried); entries left pending by a dead
+  owner are handled by the next owner first (at-least-once).
+
+FSM state lives in Redis (RedisStorage), so any replica can continue a
+conversation.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import socket
+import time
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from loguru import logger
+from redis.exceptions import ResponseError
+
+from ..cache import get_redis, get_stream_redis
+from ..config import settings
+from ..metrics import Counter, Gauge, Histogram
+
+STREAM_PREFIX = "tg:updates:"
+GROUP = "bot"
+REPLICAS_KEY = "tg:updates:replicas"
+
+_STREAM_MAXLEN = 100_000
+_READ_BLOCK_MS = 2_000
+_READ_COUNT = 50
+_LEASE_MS = 30_000
+_RENEW_EVERY_SECONDS = 5.0
+_DRAIN_SECONDS = 10.0
+
+tg_updates = Counter("tg_updates_total", "Telegram updates by outcome")
+tg_update_latency = Histogram("tg_update_latency_seconds", "Time from webhook to handled update")
+tg_shards_owned = Gauge("tg_update_shards_owned", "Update shards owned by this process")
+
+# Renew or release the lease only while we still hold it.
+_RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class UpdateQueueUnavailable(RuntimeError):
+    pass
+
+
+def webhook_secret() -> str:
+    """Secret token Telegram sends back in X-Telegram-Bot-Api-Secret-Token."""
+    if settings.telegram_webhook_secret:
+        return settings.telegram_webhook_secret
+    # Same value in every process and replica without extra configuration
+    return hashlib.sha256(f"tg-webhook:{settings.bot_token}".encode("utf-8")).hexdigest()[:48]
+
+
+def _stream(shard: int) -> str:
+    return f"{STREAM_PREFIX}{shard}"
+
+
+def _lease(shard: int) -> str:
+    return f"{STREAM_PREFIX}lease:{shard}"
+
+
+def shard_of(update: dict[str, Any]) -> int:
+    shards = max(1, settings.telegram_update_shards)
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if isinstance(user, dict) and user.get("id"):
+            return int(user["id"]) % shards
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and chat.get("id"):
+            return abs(int(chat["id"])) % shards
+    return int(update.get("update_id") or 0) % shards
+
+
+async def enqueue_update(update: dict[str, Any]) -> None:
+    """Raises UpdateQueueUnavailable; answer Telegram with a 5xx then so it redelivers."""
+    redis = get_redis()
+    if redis is None:
+        raise UpdateQueueUnavailable("REDIS_URL is not configured")
+    fields = {
+        "update": json.dumps(update, ensure_ascii=False, separators=(",", ":")),
+        "enqueued_at": repr(time.time()),
+    }
+    try:
+        await redis.xadd(_stream(shard_of(update)), fields, maxlen=_STREAM_MAXLEN, approximate=True)
+    except Exception as exc:
+        raise UpdateQueueUnavailable(str(exc)) from exc
+    tg_updates.inc(result="enqueued")
+
+
+class UpdateShardPool:
+    def __init__(self, bot: Bot, dp: Dispatcher) -> None:
+        self.bot = bot
+        self.dp = dp
+        self.shards = max(1, settings.telegram_update_shards)
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self._slots = asyncio.Semaphore(max(1, settings.telegram_update_workers))
+        self._owned: dict[int, tuple[asyncio.Task, asyncio.Event]] = {}
+        self._lease_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        redis = get_redis()
+        if redis is None:
+            raise UpdateQueueUnavailable("REDIS_URL is not configured")
+        for shard in range(self.shards):
+            try:
+                await redis.xgroup_create(_stream(shard), GROUP, id="0", mkstream=True)
+            except ResponseError as exc:
+                if "BUSYGROUP" not in str(exc):
+                    raise
+        self._lease_task = asyncio.create_task(self._lease_loop(), name="tg-update-leases")
+        logger.info("Telegram update consumers started consumer={} shards={}", self.consumer, self.shards)
+
+    async def stop(self) -> None:
+        if self._lease_task:
+            self._lease_task.cancel()
+            await asyncio.gather(self._lease_task, return_exceptions=True)
+        await asyncio.gather(*(self._release(shard) for shard in list(self._owned)))
+        redis = get_redis()
+        if redis is not None:
+            try:
+                await redis.zrem(REPLICAS_KEY, self.consumer)
+            except Exception:
+                pass
+        logger.info("Telegram update consumers stopped consumer={}", self.consumer)
+
+    # ---- shard ownership ----
+
+    async def _fair_share(self) -> int:
+        redis = get_redis()
+        now = time.time()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(REPLICAS_KEY, {self.consumer: now})
+            pipe.zremrangebyscore(REPLICAS_KEY, "-inf", now - _LEASE_MS / 1000)
+            pipe.zcard(REPLICAS_KEY)
+            _, _, alive = await pipe.execute()
+        return math.ceil(self.shards / max(1, int(alive)))
+
+    async def _lease_loop(self) -> None:
+        redis = get_redis()
+        while True:
+            try:
+                share = await self._fair_share()
+                for shard, (task, _) in list(self._owned.items()):
+                    renewed = await redis.eval(_RENEW_LUA, 1, _lease(shard), self.consumer, _LEASE_MS)
+                    if not renewed or task.done():
+                        logger.warning("Telegram update shard {} lost", shard)
+                        await self._release(shard, drain=False)
+                # Hand back shards above our share so a new replica can pick them up
+                extra = sorted(self._owned)[share:]
+                if extra:
+                    await asyncio.gather(*(self._release(shard) for shard in extra))
+                for shard in range(self.shards):
+                    if len(self._owned) >= share:
+                        break
+                    if shard in self._owned:
+                        continue
+                    if await redis.set(_lease(shard), self.consumer, nx=True, px=_LEASE_MS):
+                        stop = asyncio.Event()
+                        task = asyncio.create_task(self._consume(shard, stop), name=f"tg-updates-{shard}")
+                        self._owned[shard] = (task, stop)
+                tg_shards_owned.set(len(self._owned))
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Telegram update lease loop error: {}", exc)
+            await asyncio.sleep(_RENEW_EVERY_SECONDS)
+
+    async def _release(self, shard: int, *, drain: bool = True) -> None:
+        """Stop consuming the shard; with `drain` the update in progress is finished first."""
+        owned = self._owned.pop(shard, None)
+        if owned is not None:
+            task, stop = owned
+            stop.set()
+            if drain:
+                await asyncio.wait({task}, timeout=_DRAIN_SECONDS)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        try:
+            await get_redis().eval(_RELEASE_LUA, 1, _lease(shard), self.consumer)
+        except Exception:
+            pass
+
+    # ---- processing ----
+
+    async def _consume(self, shard: int, stop: asyncio.Event) -> None:
+        redis = get_redis()
+        reader = get_stream_redis()  # BLOCK outlasts the shared client's socket timeout
+        stream = _stream(shard)
+        # Entries the previous owner read but did not ack come first, in stream order.
+        claimed = False
+        while not stop.is_set() and not claimed:
+            try:
+                start = "0-0"
+                while not stop.is_set():
+                    start, messages, *_ = await redis.xautoclaim(
+                        stream, GROUP, self.consumer, min_idle_time=0, start_id=start, count=_READ_COUNT
+                    )
+                    for msg_id, fields in messages:
+                        if stop.is_set():
+                            return
+                        await self._handle(stream, msg_id, fields)
+                    if start == "0-0" or not messages:
+                        break
+                claimed = True
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Telegram update reclaim error shard={}: {}", shard, exc)
+                await asyncio.sleep(1.0)
+        while not stop.is_set():
+            try:
+                resp = await reader.xreadgroup(GROUP, self.consumer, {stream: ">"}, count=_READ_COUNT, block=_READ_BLOCK_MS)
+                for _name, messages in resp or []:
+                    for msg_id, fields in messages:
+                        if stop.is_set():
+                            return  # unacked entries stay pending for the next owner
+                        await self._handle(stream, msg_id, fields)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Telegram update reader error shard={}: {}", shard, exc)
+                await asyncio.sleep(1.0)
+
+    async def _handle(self, stream: str, msg_id: str, fields: dict[str, str] | None) -> None:
+        if fields:
+            async with self._slots:
+                try:
+                    update = Update.model_validate(json.loads(fields["update"]), context={"bot": self.bot})
+                    await self.dp.feed_update(self.bot, update)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    tg_updates.inc(result="failed")
+                    logger.exception("Telegram update {} failed: {}", msg_id, exc)
+                else:
+                    tg_updates.inc(result="ok")
+                    tg_update_latency.observe(max(0.0, time.time() - float(fields.get("enqueued_at") or time.time())))
+        await get_redis().xack(stream, GROUP, msg_id)
@@ -5,11 +5,17 @@ from __future__ import annotations
 import secrets
 from datetime import datetime, timezone
 
-from sqlalchemy import select
+from sqlalchemy import literal_column, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..config import settings
 from ..models import User
+from .referral_counters import bump_referral_counter
+
+
+_REF_CODE_ATTEMPTS = 5
 
 
 def _new_ref_code() -> str:
@@ -27,6 +33,91 @@ async def get_user_by_ref_code(session: AsyncSession, code: str) -> User | None:
     return q.scalar_one_or_none()
 
 
+def profile_fields(tg_user) -> tuple[str | None, str | None, str | None]:
+    """(username, first_name, locale) of a Telegram user as they are stored in `users`."""
+    return (
+        getattr(tg_user, "username", None),
+        getattr(tg_user, "first_name", None) or "",
+        getattr(tg_user, "language_code", None) or "ru",
+    )
+
+
+def _profile_changed(
+    user: User,
+    *,
+    username: str | None,
+    first_name: str | None,
+    locale: str | None,
+    is_admin: bool,
+) -> bool:
+    return (user.username, user.first_name, user.locale, bool(user.is_admin)) != (
+        username,
+        first_name,
+        locale,
+        is_admin,
+    )
+
+
+async def _upsert_user(
+    session: AsyncSession,
+    *,
+    tg_id: int,
+    username: str | None,
+    first_name: str | None,
+    locale: str | None,
+    is_admin: bool,
+    inviter_id: int | None,
+) -> tuple[User | None, bool]:
+    """INSERT ... ON CONFLICT (tg_id) DO UPDATE only when profile fields differ.
+
+    Returns (user, created). `user` is None when the row already existed with
+    the same values (the conditional update matched nothing).
+    A collision on referral_code is retried with a fresh code.
+    """
+    last_exc: IntegrityError | None = None
+    for _ in range(_REF_CODE_ATTEMPTS):
+        stmt = pg_insert(User).values(
+            tg_id=tg_id,
+            username=username,
+            first_name=first_name,
+            locale=locale,
+            is_admin=is_admin,
+            is_banned=False,
+            inviter_id=inviter_id,
+            referral_code=_new_ref_code(),
+            created_at=datetime.now(timezone.utc),
+        )
+        excluded = stmt.excluded
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.tg_id],
+            set_={
+                "username": excluded.username,
+                "first_name": excluded.first_name,
+                "locale": excluded.locale,
+                "is_admin": excluded.is_admin,
+            },
+            where=or_(
+                User.username.is_distinct_from(excluded.username),
+                User.first_name.is_distinct_from(excluded.first_name),
+                User.locale.is_distinct_from(excluded.locale),
+                User.is_admin.is_distinct_from(excluded.is_admin),
+            ),
+        ).returning(User, literal_column("(xmax = 0)").label("inserted"))
+        try:
+            async with session.begin_nested():
+                res = await session.execute(stmt, execution_options={"populate_existing": True})
+                row = res.first()
+        except IntegrityError as exc:
+            # referral_code unique violation: try another code
+            last_exc = exc
+            continue
+        if row is None:
+            return None, False
+        return row[0], bool(row[1])
+    assert last_exc is not None
+    raise last_exc
+
+
 async def get_or_create_user(
     *,
     session: AsyncSession,
@@ -36,47 +127,37 @@ async def get_or_create_user(
     ref_code: str | None,
     locale: str | None,
 ) -> User:
+    is_admin = tg_id in settings.admin_id_list
+
+    # Steady state: the user exists and nothing changed -> a single SELECT, no write.
     user = await get_user_by_tg_id(session, tg_id)
-    if user:
-        # update profile fields
-        user.username = username
-        user.first_name = first_name
-        user.locale = locale
-        user.is_admin = tg_id in settings.admin_id_list
-        session.add(user)
-        await session.commit()
+    if user and not _profile_changed(
+        user, username=username, first_name=first_name, locale=locale, is_admin=is_admin
+    ):
         return user
 
     inviter_id = None
-    if ref_code:
+    if user is None and ref_code:
         inviter = await get_user_by_ref_code(session, ref_code)
         if inviter:
             inviter_id = inviter.id
 
-    # ensure unique referral code
-    ref = _new_ref_code()
-    # try a few times
-    for _ in range(5):
-        existing = await get_user_by_ref_code(session, ref)
-        if not existing:
-            break
-        ref = _new_ref_code()
-
-    user = User(
+    upserted, created = await _upsert_user(
+        session,
         tg_id=tg_id,
         username=username,
         first_name=first_name,
-        created_at=datetime.now(timezone.utc),
-        is_admin=(tg_id in settings.admin_id_list),
-        is_banned=False,
-        inviter_id=inviter_id,
-        referral_code=ref,
         locale=locale,
+        is_admin=is_admin,
+        inviter_id=inviter_id,
     )
-    session.add(user)
+    if created and inviter_id:
+        await bump_referral_counter(session, inviter_id, invited=1)
     await session.commit()
-    await session.refresh(user)
-    return user
+    if upserted is None:
+        # Raced with another update that already wrote the same values.
+        upserted = await get_user_by_tg_id(session, tg_id)
+    return upserted
 
 async def ensure_user(
     *,
@@ -85,11 +166,12 @@ async def ensure_user(
     ref_code: str | None = None,
 ) -> User:
     """Wrapper to ensure required fields are always provided."""
+    username, first_name, locale = profile_fields(tg_user)
     return await get_or_create_user(
         session=session,
         tg_id=tg_user.id,
-        username=getattr(tg_user, "username", None),
-        first_name=getattr(tg_user, "first_name", None) or "",
+        username=username,
+        first_name=first_name,
         ref_code=ref_code,
-        locale=getattr(tg_user, "language_code", None) or "ru",
+        locale=locale,
     )
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Idempotency for provider webhooks.
+
+Two layers, both keyed by (provider, event id):
+
+- ingress: Redis SET NX with TTL drops redeliveries before anything is
+  enqueued, fetched from the provider or read from the DB;
+- worker: a unique row in `webhook_events` survives Redis flushes/TTL and
+  marks an event as processed once its order was handled.
+"""
+
+from __future__ import annotations
+
+from loguru import logger
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..cache import get_redis
+from ..config import settings
+from ..metrics import Counter
+from ..models import WebhookEvent
+from .subscriptions import now_utc
+
+webhook_dedup = Counter("webhook_dedup_total", "Webhook idempotency checks by layer and result")
+
+
+def _key(provider: str, event_id: str) -> str:
+    return f"webhook_seen:{provider}:{event_id}"
+
+
+async def seen_recently(provider: str, event_id: str) -> bool:
+    """True if this event was already accepted within the TTL (duplicate)."""
+    redis = get_redis()
+    if redis is None:
+        return False
+    try:
+        fresh = await redis.set(_key(provider, event_id), "1", nx=True, ex=settings.webhook_dedup_ttl_seconds)
+    except Exception as exc:
+        logger.warning("Webhook dedup check failed {}:{}: {}", provider, event_id, exc)
+        return False
+    webhook_dedup.inc(provider=provider, layer="redis", result="miss" if fresh else "hit")
+    return not fresh
+
+
+async def forget_seen(provider: str, event_id: str) -> None:
+    """Let the next delivery of this event through (enqueue failed / not final yet)."""
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.delete(_key(provider, event_id))
+    except Exception as exc:
+        logger.warning("Webhook dedup release failed {}:{}: {}", provider, event_id, exc)
+
+
+async def claim_webhook_event(session: AsyncSession, provider: str, event_id: str) -> bool:
+    """Register the event; False if it was already processed."""
+    inserted = await session.execute(
+        pg_insert(WebhookEvent)
+        .values(provider=provider, event_id=event_id)
+        .on_conflict_do_nothing(index_elements=[WebhookEvent.provider, WebhookEvent.event_id])
+        .returning(WebhookEvent.id)
+    )
+    if inserted.first() is not None:
+        await session.commit()
+        webhook_dedup.inc(provider=provider, layer="db", result="miss")
+        return True
+    q = await session.execute(
+        select(WebhookEvent.status).where(
+            WebhookEvent.provider == provider,
+            WebhookEvent.event_id == event_id,
+        )
+    )
+    await session.commit()
+    if q.scalar_one_or_none() == "processed":
+        webhook_dedup.inc(provider=provider, layer="db", result="hit")
+        return False
+    # Received earlier but not finished (retry after a failure).
+    webhook_dedup.inc(provider=provider, layer="db", result="miss")
+    return True
+
+
+async def mark_webhook_processed(session: AsyncSession, provider: str, event_id: str) -> None:
+    await session.execute(
+        update(WebhookEvent)
+        .where(WebhookEvent.provider == provider, WebhookEvent.event_id == event_id)
+        .values(status="processed", processed_at=now_utc())
+    )
+    await session.commit()
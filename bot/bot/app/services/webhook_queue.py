@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""Durable queue for payment webhooks on top of a Redis Stream.
+
+HTTP handlers only validate the request and `enqueue_webhook()`; a
+`WebhookWorkerPool` consumes the stream through a consumer group with bounded
+concurrency. Delivery is at-least-once:
+
+- a message is XACKed only after it was handled, rescheduled or dead-lettered,
+  so a crash leaves it pending and it is reclaimed (XAUTOCLAIM) on restart;
+- while a handler runs its worker re-claims the entry (XCLAIM JUSTID) every
+  _HEARTBEAT_SECONDS, so only entries of a dead worker go idle for
+  _RECLAIM_IDLE_MS and a slow handler is not started a second time;
+- failures are retried with exponential backoff via a ZSET scored by due time;
+- after `webhook_max_attempts` the envelope goes to a capped dead-letter list.
+
+Handlers must still be idempotent: a worker stalled past the idle threshold
+(or one that died after the work but before XACK) gets its entry run again.
+For payment events that is safe step by step: the provider lookup is
+read-only, claim_webhook_event / mark_webhook_processed are upserts, and
+mark_order_paid locks the order row and returns "already_paid" without
+applying the payment or notifying the user a second time.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import socket
+import time
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+from redis.exceptions import ResponseError
+
+from ..cache import get_redis, get_stream_redis
+from ..config import settings
+from ..metrics import Counter, Gauge, Histogram, register_collector
+
+STREAM_KEY = "webhooks:stream"
+GROUP = "webhook-workers"
+RETRY_KEY = "webhooks:retry"
+DEAD_KEY = "webhooks:dead"
+
+_STREAM_MAXLEN = 100_000
+_DEAD_MAXLEN = 1_000
+_READ_BLOCK_MS = 5_000
+_RECLAIM_IDLE_MS = 60_000
+_RECLAIM_EVERY_SECONDS = 30.0
+_HEARTBEAT_SECONDS = 15.0
+_RETRY_POLL_SECONDS = 1.0
+
+WebhookHandler = Callable[[dict[str, Any]], Awaitable[None]]
+
+webhook_events = Counter("webhook_events_total", "Webhook events by kind and outcome")
+webhook_latency = Histogram(
+    "webhook_event_latency_seconds", "Time from enqueue to successful processing"
+)
+webhook_handler_time = Histogram("webhook_handler_seconds", "Handler run time per attempt")
+webhook_in_flight = Gauge("webhook_in_flight", "Events being processed by this process")
+webhook_queue_depth = Gauge("webhook_queue_depth", "Webhook queue depth by state")
+
+# Moves due retries back to the stream atomically, so two workers cannot requeue the same entry.
+_REQUEUE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(due) do
+  redis.call('ZREM', KEYS[1], item)
+  local env = cjson.decode(item)
+  redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*',
+    'kind', env.kind, 'payload', env.payload, 'attempt', env.attempt, 'enqueued_at', env.enqueued_at)
+end
+return #due
+"""
+
+
+class WebhookQueueUnavailable(RuntimeError):
+    pass
+
+
+def _envelope(kind: str, payload: dict[str, Any]) -> dict[str, str]:
+    return {
+        "kind": kind,
+        "payload": json.dumps(payload, ensure_ascii=False, separators=(",", ":")),
+        "attempt": "0",
+        "enqueued_at": repr(time.time()),
+    }
+
+
+async def enqueue_webhook(kind: str, payload: dict[str, Any]) -> str:
+    """Persist a webhook event. Raises WebhookQueueUnavailable if Redis is down.
+
+    The caller should answer the provider with a 5xx in that case so the
+    provider redelivers instead of the event being lost.
+    """
+    redis = get_redis()
+    if redis is None:
+        raise WebhookQueueUnavailable("REDIS_URL is not configured")
+    try:
+        msg_id = await redis.xadd(
+            STREAM_KEY, _envelope(kind, payload), maxlen=_STREAM_MAXLEN, approximate=True
+        )
+    except Exception as exc:
+        raise WebhookQueueUnavailable(str(exc)) from exc
+    webhook_events.inc(kind=kind, result="enqueued")
+    return msg_id
+
+
+def _retry_delay(attempt: int) -> float:
+    base = max(1, settings.webhook_retry_base_seconds)
+    delay = min(settings.webhook_retry_max_seconds, base * (2 ** max(0, attempt - 1)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class WebhookWorkerPool:
+    def __init__(self, handlers: dict[str, WebhookHandler], *, concurrency: int | None = None) -> None:
+        self.handlers = handlers
+        self.concurrency = max(1, concurrency or settings.webhook_workers)
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._tasks: set[asyncio.Task] = set()
+        self._loops: list[asyncio.Task] = []
+        self._stopping = asyncio.Event()
+        self._starter: asyncio.Task | None = None
+        self.running = False
+
+    async def start(self) -> None:
+        redis = get_redis()
+        if redis is None:
+            raise WebhookQueueUnavailable("REDIS_URL is not configured")
+        try:
+            await redis.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+        except ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+        register_collector(collect_queue_metrics)
+        self._loops = [
+            asyncio.create_task(self._read_loop(), name="webhook-reader"),
+            asyncio.create_task(self._retry_loop(), name="webhook-retry"),
+        ]
+        self.running = True
+        logger.info("Webhook workers started consumer={} concurrency={}", self.consumer, self.concurrency)
+
+    def start_in_background(self) -> None:
+        """Keep retrying `start()` with backoff, e.g. when Redis was down at boot."""
+        if self._starter is None or self._starter.done():
+            self._starter = asyncio.create_task(self._start_with_retry(), name="webhook-start")
+
+    async def _start_with_retry(self) -> None:
+        delay = 1.0
+        while not self._stopping.is_set():
+            await asyncio.sleep(delay)
+            try:
+                await self.start()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                delay = min(60.0, delay * 2)
+                logger.warning("Webhook workers still not started, retry in {:.0f}s: {}", delay, exc)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        self._stopping.set()
+        self.running = False
+        if self._starter is not None:
+            self._starter.cancel()
+            await asyncio.gather(self._starter, return_exceptions=True)
+        for task in self._loops:
+            task.cancel()
+        await asyncio.gather(*self._loops, return_exceptions=True)
+        if self._tasks:
+            # In-flight events left unacked are reclaimed by the next consumer.
+            _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        logger.info("Webhook workers stopped consumer={}", self.consumer)
+
+    async def _read_loop(self) -> None:
+        redis = get_stream_redis()  # BLOCK outlasts the shared client's socket timeout
+        last_reclaim = 0.0
+        while not self._stopping.is_set():
+            try:
+                if time.monotonic() - last_reclaim >= _RECLAIM_EVERY_SECONDS:
+                    await self._reclaim_stale()
+                    last_reclaim = time.monotonic()
+
+                await self._slots.acquire()
+                self._slots.release()
+                free = max(1, self._free_slots())
+                resp = await redis.xreadgroup(
+                    GROUP, self.consumer, {STREAM_KEY: ">"}, count=free, block=_READ_BLOCK_MS
+                )
+                for _stream, messages in resp or []:
+                    for msg_id, fields in messages:
+                        await self._dispatch(msg_id, fields)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Webhook reader error: {}", exc)
+                await asyncio.sleep(1.0)
+
+    def _free_slots(self) -> int:
+        return self.concurrency - len(self._tasks)
+
+    async def _reclaim_stale(self) -> None:
+        redis = get_redis()
+        start = "0-0"
+        while True:
+            res = await redis.xautoclaim(
+                STREAM_KEY, GROUP, self.consumer, min_idle_time=_RECLAIM_IDLE_MS, start_id=start, count=50
+            )
+            start, messages = res[0], res[1]
+            for msg_id, fields in messages:
+                if fields:
+                    webhook_events.inc(kind=fields.get("kind", "?"), result="reclaimed")
+                    await self._dispatch(msg_id, fields)
+                else:
+                    # Entry was trimmed from the stream; nothing left to process.
+                    await redis.xack(STREAM_KEY, GROUP, msg_id)
+            if start == "0-0" or not messages:
+                break
+
+    async def _dispatch(self, msg_id: str, fields: dict[str, str]) -> None:
+        await self._slots.acquire()
+        task = asyncio.create_task(self._run(msg_id, fields))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, msg_id: str, fields: dict[str, str]) -> None:
+        redis = get_redis()
+        kind = fields.get("kind", "")
+        attempt = int(fields.get("attempt") or 0) + 1
+        enqueued_at = float(fields.get("enqueued_at") or time.time())
+        webhook_in_flight.inc()
+        started = time.perf_counter()
+        heartbeat = asyncio.create_task(self._heartbeat(msg_id))
+        try:
+            handler = self.handlers.get(kind)
+            if handler is None:
+                raise LookupError(f"no handler for webhook kind {kind!r}")
+            payload = json.loads(fields.get("payload") or "{}")
+            await handler(payload)
+        except Exception as exc:
+            webhook_handler_time.observe(time.perf_counter() - started, kind=kind)
+            await self._fail(msg_id, fields, kind=kind, attempt=attempt, enqueued_at=enqueued_at, exc=exc)
+        else:
+            webhook_handler_time.observe(time.perf_counter() - started, kind=kind)
+            webhook_latency.observe(max(0.0, time.time() - enqueued_at), kind=kind)
+            webhook_events.inc(kind=kind, result="ok")
+            await redis.xack(STREAM_KEY, GROUP, msg_id)
+        finally:
+            heartbeat.cancel()
+            webhook_in_flight.dec()
+            self._slots.release()
+
+    async def _heartbeat(self, msg_id: str) -> None:
+        """Reset the entry's idle time while its handler runs, so XAUTOCLAIM leaves it alone."""
+        redis = get_redis()
+        while True:
+            await asyncio.sleep(_HEARTBEAT_SECONDS)
+            try:
+                await redis.xclaim(STREAM_KEY, GROUP, self.consumer, 0, [msg_id], justid=True)
+            except Exception as exc:
+                logger.warning("Webhook heartbeat failed msg={}: {}", msg_id, exc)
+
+    async def _fail(
+        self,
+        msg_id: str,
+        fields: dict[str, str],
+        *,
+        kind: str,
+        attempt: int,
+        enqueued_at: float,
+        exc: Exception,
+    ) -> None:
+        redis = get_redis()
+        envelope = {
+            "kind": kind,
+            "payload": fields.get("payload") or "{}",
+            "attempt": str(attempt),
+            "enqueued_at": repr(enqueued_at),
+        }
+        try:
+            if isinstance(exc, (LookupError, ValueError)) or attempt >= settings.webhook_max_attempts:
+                envelope["error"] = f"{type(exc).__name__}: {exc}"[:500]
+                envelope["failed_at"] = repr(time.time())
+                async with redis.pipeline(transaction=True) as pipe:
+                    pipe.lpush(DEAD_KEY, json.dumps(envelope, ensure_ascii=False))
+                    pipe.ltrim(DEAD_KEY, 0, _DEAD_MAXLEN - 1)
+                    pipe.xack(STREAM_KEY, GROUP, msg_id)
+                    await pipe.execute()
+                webhook_events.inc(kind=kind, result="dead")
+                logger.error("Webhook dead-lettered kind={} msg={} attempts={}: {}", kind, msg_id, attempt, exc)
+                return
+            due = time.time() + _retry_delay(attempt)
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.zadd(RETRY_KEY, {json.dumps(envelope, ensure_ascii=False): due})
+                pipe.xack(STREAM_KEY, GROUP, msg_id)
+                await pipe.execute()
+            webhook_events.inc(kind=kind, result="retry")
+            logger.warning("Webhook failed kind={} msg={} attempt={}, retry in {:.0f}s: {}", kind, msg_id, attempt, due - time.time(), exc)
+        except Exception as redis_exc:
+            # Leave it pending; XAUTOCLAIM will hand it out again.
+            logger.warning("Webhook reschedule failed kind={} msg={}: {}", kind, msg_id, redis_exc)
+
+    async def _retry_loop(self) -> None:
+        redis = get_redis()
+        while not self._stopping.is_set():
+            try:
+                moved = await redis.eval(_REQUEUE_LUA, 2, RETRY_KEY, STREAM_KEY, repr(time.time()), 100, _STREAM_MAXLEN)
+                if moved:
+                    logger.info("Webhook retries requeued: {}", moved)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Webhook retry mover error: {}", exc)
+            await asyncio.sleep(_RETRY_POLL_SECONDS)
+
+
+async def collect_queue_metrics() -> None:
+    redis = get_redis()
+    if redis is None:
+        return
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.xinfo_groups(STREAM_KEY)
+        pipe.zcard(RETRY_KEY)
+        pipe.llen(DEAD_KEY)
+        groups, retry, dead = await pipe.execute(raise_on_error=False)
+    pending = lag = 0
+    if isinstance(groups, list):
+        for group in groups:
+            if group.get("name") == GROUP:
+                pending = int(group.get("pending") or 0)
+                lag = int(group.get("lag") or 0)
+    webhook_queue_depth.set(lag, state="ready")
+    webhook_queue_depth.set(pending, state="pending")
+    webhook_queue_depth.set(retry if isinstance(retry, int) else 0, state="retry")
+    webhook_queue_depth.set(dead if isinstance(dead, int) else 0, state="dead")
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Telegram file_id registry for bot assets (start photo and other images).
+
+A file is uploaded to Telegram once; the `file_id` Telegram returns is kept
+in process and in Redis (`tg_file:{bot_id}:{sha256}`, no TTL) and sent
+instead of the bytes afterwards:
+
+- the key is the content hash, so editing the file on disk re-uploads it on
+  the next send (the hash is recomputed only when mtime/size change);
+- file_ids are per bot, hence the bot id in the key;
+- a file_id Telegram rejects is forgotten and the file is uploaded again.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Any
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+from loguru import logger
+
+from ..cache import get_redis
+from ..metrics import Counter
+
+asset_sends = Counter("tg_asset_sends_total", "Asset photos sent by file_id or by upload")
+
+# path -> (mtime_ns, size, sha256)
+_digests: dict[str, tuple[int, int, str]] = {}
+_file_ids: dict[str, str] = {}
+
+
+def _digest(path: Path) -> str:
+    key = str(path)
+    st = os.stat(key)
+    cached = _digests.get(key)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    h = hashlib.sha256()
+    with open(key, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _digests[key] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def _key(bot_id: int, digest: str) -> str:
+    return f"tg_file:{bot_id}:{digest}"
+
+
+async def _lookup(key: str) -> str | None:
+    file_id = _file_ids.get(key)
+    if file_id:
+        return file_id
+    redis = get_redis()
+    if redis is None:
+        return None
+    try:
+        file_id = await redis.get(key)
+    except Exception as exc:
+        logger.warning("Asset file_id lookup failed: {}", exc)
+        return None
+    if file_id:
+        _file_ids[key] = file_id
+    return file_id or None
+
+
+async def _remember(key: str, file_id: str) -> None:
+    _file_ids[key] = file_id
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.set(key, file_id)
+    except Exception as exc:
+        logger.warning("Asset file_id store failed: {}", exc)
+
+
+async def _forget(key: str) -> None:
+    _file_ids.pop(key, None)
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.delete(key)
+    except Exception:
+        pass
+
+
+async def answer_photo_asset(message: Message, path: Path, **kwargs: Any) -> Message:
+    """`message.answer_photo` for a local file, uploading it only the first time."""
+    key = _key(message.bot.id, _digest(path))
+    file_id = await _lookup(key)
+    if file_id:
+        try:
+            sent = await message.answer_photo(photo=file_id, **kwargs)
+            asset_sends.inc(source="file_id")
+            return sent
+        except TelegramBadRequest as exc:
+            if "file" not in str(exc).lower():
+                raise
+            logger.warning("Cached file_id rejected for {}, uploading again: {}", path.name, exc)
+            await _forget(key)
+
+    sent = await message.answer_photo(photo=FSInputFile(str(path)), **kwargs)
+    asset_sends.inc(source="upload")
+    if sent.photo:
+        # Telegram stores several sizes; resending the largest one keeps the quality.
+        await _remember(key, sent.photo[-1].file_id)
+    return sent
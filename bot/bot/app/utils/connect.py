@@ -48,4 +48,41 @@ def verify_connect_token(token: str) -> ConnectToken | None:
         return None
     if int(time.time()) > expires_at:
         return None
-    return ConnectToken(device_id=int(device_id_s), user_id=int(user_id_s), expires_at=expires_at)
\ No newline at end of file
+    return ConnectToken(device_id=int(device_id_s), user_id=int(user_id_s), expires_at=expires_at)
+
+
+def _subscription_signature(upstream_url: str) -> str:
+    return hmac.new(_secret(), f"sub:{upstream_url}".encode("utf-8"), sha256).hexdigest()[:32]
+
+
+def _subscription_user_mac(marzban_username: str) -> str:
+    return hmac.new(_secret(), f"subuser:{marzban_username}".encode("utf-8"), sha256).hexdigest()[:16]
+
+
+def create_subscription_token(*, marzban_username: str, upstream_url: str) -> str:
+    """Token of /sub/{token}: bound to the current Marzban subscription URL, so a revoke invalidates it."""
+    name = base64.urlsafe_b64encode(marzban_username.encode("utf-8")).decode("utf-8").rstrip("=")
+    return f"{name}.{_subscription_user_mac(marzban_username)}.{_subscription_signature(upstream_url)}"
+
+
+def parse_subscription_token(token: str) -> tuple[str, str] | None:
+    """(marzban_username, signature) when the username MAC is valid, else None.
+
+    Forged tokens stop here, before any cache or Marzban work; check the
+    signature against the upstream URL with `subscription_token_matches`.
+    """
+    if not token or token.count(".") != 2:
+        return None
+    encoded, user_mac, signature = token.split(".")
+    try:
+        padded = encoded + "=" * (-len(encoded) % 4)
+        username = base64.urlsafe_b64decode(padded.encode("utf-8")).decode("utf-8")
+    except Exception:
+        return None
+    if not username or not hmac.compare_digest(user_mac, _subscription_user_mac(username)):
+        return None
+    return username, signature
+
+
+def subscription_token_matches(signature: str, upstream_url: str) -> bool:
+    return hmac.compare_digest(signature, _subscription_signature(upstream_url))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Shared outbound HTTP clients.
+
+One long-lived `httpx.AsyncClient` per upstream (CryptoPay, YooKassa, Happ...)
+so requests reuse keep-alive connections instead of paying DNS + TCP + TLS on
+every call. Clients are created lazily, opened in `start_http_clients()` for
+the known upstreams and closed in `close_http_clients()` on shutdown.
+"""
+
+from __future__ import annotations
+
+import importlib.util
+
+import httpx
+from loguru import logger
+
+from ..config import settings
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def _http2_available() -> bool:
+    if not settings.http2_enabled:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        logger.warning("HTTP_HTTP2_ENABLED is set but the 'h2' package is not installed; using HTTP/1.1")
+        return False
+    return True
+
+
+def _build_client(base_url: str | None, verify: bool = True) -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=settings.http_max_connections,
+        max_keepalive_connections=settings.http_max_keepalive_connections,
+        keepalive_expiry=settings.http_keepalive_expiry_seconds,
+    )
+    timeout = httpx.Timeout(settings.http_timeout_seconds, connect=settings.http_connect_timeout_seconds)
+    kwargs: dict = {
+        "limits": limits,
+        "timeout": timeout,
+        "follow_redirects": True,
+        "http2": _http2_available(),
+        "verify": verify,
+    }
+    if base_url:
+        kwargs["base_url"] = base_url
+    return httpx.AsyncClient(**kwargs)
+
+
+def get_http_client(name: str, base_url: str | None = None, *, verify: bool = True) -> httpx.AsyncClient:
+    """Pooled client for an upstream, one per (name, base_url).
+
+    `verify=False` skips TLS certificate checks (self-signed panels); it only
+    applies when the pool is created, so pass it the same way on every call.
+    """
+    key = f"{name}:{base_url.rstrip('/')}" if base_url else name
+    client = _clients.get(key)
+    if client is None or client.is_closed:
+        client = _build_client(base_url, verify)
+        _clients[key] = client
+    return client
+
+
+def start_http_clients() -> None:
+    """Create pools for configured upstreams up front (connections open lazily)."""
+    from ..services.payments.cryptopay import API_BASE as CRYPTOPAY_API
+    from ..services.payments.yookassa import API_BASE as YOOKASSA_API
+
+    if settings.cryptopay_token:
+        get_http_client("cryptopay", CRYPTOPAY_API)
+    if settings.yookassa_shop_id and settings.yookassa_secret_key:
+        get_http_client("yookassa", YOOKASSA_API)
+    get_http_client("happ_crypto")
+    if settings.happ_proxy_api_base:
+        get_http_client("happ_proxy", settings.happ_proxy_api_base)
+    logger.info("HTTP client pools ready: {}", ", ".join(sorted(_clients)))
+
+
+async def close_http_clients() -> None:
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception as exc:
+            logger.warning("HTTP client close failed: {}", exc)
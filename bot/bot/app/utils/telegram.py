@@ -3,7 +3,9 @@ from __future__ import annotations
 from typing import Any
 from aiogram.exceptions import TelegramBadRequest
 
-from aiogram.types import CallbackQuery, FSInputFile, Message
+from aiogram.types import CallbackQuery, Message
+
+from .assets import answer_photo_asset
 
 def _markup_payload(markup: Any | None) -> dict | None:
     if not markup:
@@ -99,9 +101,9 @@ async def send_html_with_photo(
     """Send a photo with HTML caption fallbacking to a plain HTML message."""
     if photo_path:
         try:
-            photo = FSInputFile(str(photo_path))
-            await message.answer_photo(
-                photo=photo,
+            await answer_photo_asset(
+                message,
+                photo_path,
                 caption=text,
                 reply_markup=reply_markup,
                 parse_mode="HTML",
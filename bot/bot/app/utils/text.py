@@ -47,4 +47,14 @@ def months_title(n: int, *, short: bool = False) -> str:
         return "месяц"
     if n_abs % 10 in (2, 3, 4):
         return "месяца"
-    return "месяцев"
\ No newline at end of file
+    return "месяцев"
+
+
+def parse_start_ref(text: str | None) -> str | None:
+    """Extract referral code from `/start ref_<code>` deep link payload."""
+    if not text or not text.startswith("/start") or " " not in text:
+        return None
+    _, arg = text.split(" ", 1)
+    if arg.startswith("ref_"):
+        return arg.replace("ref_", "", 1)
+    return None
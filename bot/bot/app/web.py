@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Standalone HTTP service: payment webhooks, /connect pages and /metrics.
+
+Run with `python -m bot.app.web` next to the bot started with
+WEBHOOK_EMBEDDED=false. WEB_PROCESSES workers (spawned, one event loop each,
+uvloop when installed) bind WEBHOOK_PORT with SO_REUSEPORT and the kernel
+spreads connections between them. Every worker also runs its own share of the
+webhook queue consumers and its own DB pool, so the default is a small fixed
+count rather than one per core. With several workers, worker N serves its
+/metrics on METRICS_PORT + N instead of the shared port. User notifications go to the bot processes through
+a Redis Stream (see services/notifications.py).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+from multiprocessing.connection import wait
+
+from loguru import logger
+
+from .cache import InvalidationListener, close_redis
+from .config import settings
+from .utils.http import close_http_clients, start_http_clients
+from .webhooks import (
+    start_metrics_server,
+    start_webhook_server,
+    start_webhook_workers,
+    stop_webhook_server,
+    stop_webhook_workers,
+)
+
+
+def _install_uvloop() -> None:
+    try:
+        import uvloop
+    except ImportError:
+        return
+    uvloop.install()
+
+
+async def serve(index: int = 0, processes: int = 1) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    start_http_clients()
+    invalidation_listener = InvalidationListener()
+    invalidation_listener.start()
+    workers = await start_webhook_workers()
+    runner = await start_webhook_server(reuse_port=True, metrics=processes == 1)
+    metrics_runner = None
+    if processes > 1:
+        metrics_runner = await start_metrics_server(settings.metrics_port + index)
+    logger.info("HTTP worker {} pid={} ready", index, os.getpid())
+    try:
+        await stop.wait()
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await stop_webhook_server(runner)
+        await stop_webhook_workers(workers)
+        await invalidation_listener.stop()
+        await close_http_clients()
+        await close_redis()
+
+
+def _run_worker(index: int = 0, processes: int = 1) -> None:
+    _install_uvloop()
+    asyncio.run(serve(index, processes))
+
+
+def main() -> None:
+    processes = settings.web_processes or os.cpu_count() or 1
+    if processes == 1:
+        _run_worker()
+        return
+
+    ctx = multiprocessing.get_context("spawn")
+    children = [ctx.Process(target=_run_worker, args=(i, processes), name=f"web-{i}") for i in range(processes)]
+    for child in children:
+        child.start()
+    logger.info("HTTP service started with {} worker processes on {}:{}", processes, settings.webhook_host, settings.webhook_port)
+
+    def _terminate(*_: object) -> None:
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+
+    signal.signal(signal.SIGTERM, _terminate)
+    signal.signal(signal.SIGINT, _terminate)
+
+    # A worker that dies takes the whole service down, so the supervisor restarts it clean.
+    wait([child.sentinel for child in children])
+    _terminate()
+    for child in children:
+        child.join()
+    failed = [child for child in children if child.exitcode not in (0, -signal.SIGTERM)]
+    for child in failed:
+        logger.error("HTTP worker {} exited with code {}", child.name, child.exitcode)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
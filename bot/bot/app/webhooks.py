@@ -1,9 +1,8 @@
 from __future__ import annotations
 
-import asyncio
+import hmac
 import json
-import html
-from typing import Any
+from typing import Any, Awaitable, Callable
 
 from aiohttp import web
 from loguru import logger
@@ -11,31 +10,24 @@ from sqlalchemy import select
 
 from .config import settings
 from .db import session_scope
-from .marzban.client import MarzbanClient
-from .models import Device, Order
-from .services.orders import get_order, mark_order_paid
-from .services.happ_connect import build_happ_links
+from .metrics import render_metrics
+from .models import Order
+from .services.connect_page import close_connect_page, get_connect_bundle, render_connect_page
+from .services.orders import accept_provider_payment, get_order, mark_order_paid
+from .services.notifications import notify_payment_confirmed
 from .services.payments import (
-    CryptoPayClient,
-    YooKassaClient,
+    get_cryptopay_client,
+    get_yookassa_client,
     is_cryptopay_paid,
     is_yookassa_paid,
 )
+from .services.payments.checks import forget_provider_status
 from .services.payments.cryptopay import verify_webhook_signature
-from .utils.connect import verify_connect_token
-from .utils.urls import make_absolute_url
-
-def _marzban_client() -> MarzbanClient:
-    return MarzbanClient(
-        base_url=str(settings.marzban_base_url),
-        username=settings.marzban_username,
-        password=settings.marzban_password,
-        verify_ssl=settings.marzban_verify_ssl,
-        api_prefix=settings.marzban_api_prefix,
-        default_inbounds={settings.marzban_proxy_type: [settings.marzban_inbound_tag]},
-        default_proxies={settings.marzban_proxy_type: {"flow": settings.reality_flow}},
-    )
-
+from .services.sub_proxy import SubscriptionRateLimited, SubscriptionUnavailable, get_subscription, sub_requests
+from .services.tg_updates import UpdateQueueUnavailable, enqueue_update, webhook_secret
+from .services.webhook_dedup import claim_webhook_event, forget_seen, mark_webhook_processed, seen_recently
+from .services.webhook_queue import WebhookQueueUnavailable, WebhookWorkerPool, enqueue_webhook
+from .utils.connect import parse_subscription_token, verify_connect_token
 
 async def _process_paid_order(
     order_id: int | None,
@@ -56,67 +48,22 @@ async def _process_paid_order(
         if not order:
             logger.warning("Webhook: order %s not found for %s", order_id, provider)
             return
-        if order.status != "pending":
-            logger.info("Webhook: order %s already processed", order_id)
+        if not await accept_provider_payment(
+            session, order, provider=provider, provider_id=provider_id, raw_payload=raw_payload
+        ):
             return
 
-        if order.provider and order.provider not in {provider, "manual"}:
-            logger.warning("Webhook: provider mismatch for order %s", order_id)
-            return
-        if provider_id and order.provider_payment_id and str(order.provider_payment_id) != str(provider_id):
-            logger.warning("Webhook: provider id mismatch for order %s", order_id)
-            return
-        
-        if provider == "yookassa" and raw_payload:
-            amount = raw_payload.get("amount") or {}
-            if amount.get("currency") and amount.get("currency") != "RUB":
-                logger.warning("Webhook: currency mismatch for order %s", order_id)
-                return
-            if order.amount_rub:
-                expected = f"{order.amount_rub:.2f}"
-                if str(amount.get("value")) != expected:
-                    logger.warning("Webhook: amount mismatch for order %s", order_id)
-                    return
-            metadata = raw_payload.get("metadata") or {}
-            if metadata.get("order_id") and str(metadata.get("order_id")) != str(order.id):
-                logger.warning("Webhook: metadata order mismatch for order %s", order_id)
-                return
-        if provider == "cryptopay" and raw_payload:
-            if order.currency and raw_payload.get("asset") and raw_payload.get("asset") != order.currency:
-                logger.warning("Webhook: asset mismatch for order %s", order_id)
-                return
-            if order.amount and raw_payload.get("amount") and str(raw_payload.get("amount")) != str(order.amount):
-                logger.warning("Webhook: amount mismatch for order %s", order_id)
-                return
-            payload_raw = raw_payload.get("payload")
-            if payload_raw:
-                try:
-                    payload = json.loads(payload_raw)
-                    if payload.get("order_id") and str(payload.get("order_id")) != str(order.id):
-                        logger.warning("Webhook: payload order mismatch for order %s", order_id)
-                        return
-                except Exception:
-                    logger.warning("Webhook: payload parse failed for order %s", order_id)
-
-        order.provider = provider
-        if provider_id:
-            order.provider_payment_id = str(provider_id)
-        if raw_payload:
-            order.raw_provider_payload = json.dumps(raw_payload, ensure_ascii=False)
-        session.add(order)
-        await session.commit()
-
-        marz = _marzban_client()
-        try:
-            await mark_order_paid(session=session, marz=marz, order=order)
-        finally:
-            await marz.close()
+        new_exp, notes = await mark_order_paid(session=session, order=order)
+        await forget_provider_status(order.id)
+        if "already_paid" not in notes:
+            await notify_payment_confirmed(session, order, new_exp)
 
 
-async def _handle_cryptopay(invoice_id: int | None, payload_raw: str | None) -> None:
+async def _handle_cryptopay(invoice_id: int | None, payload_raw: str | None) -> bool:
+    """Returns True once the event reached a final outcome for its order."""
     cryptopay_token = getattr(settings, "cryptopay_token", None)
     if not cryptopay_token or not invoice_id:
-        return
+        return False
 
     order_id = None
     if payload_raw:
@@ -126,14 +73,15 @@ async def _handle_cryptopay(invoice_id: int | None, payload_raw: str | None) ->
         except Exception:
             order_id = None
 
-    client = CryptoPayClient(cryptopay_token)
+    client = get_cryptopay_client()
     try:
         invoice = await client.get_invoice(int(invoice_id))
     except Exception as exc:
-        logger.exception("CryptoPay webhook: failed to fetch invoice %s: %s", invoice_id, exc)
-        return
+        # Re-raised so the queue retries the event with backoff.
+        logger.warning("CryptoPay webhook: failed to fetch invoice {}: {}", invoice_id, exc)
+        raise
     if not invoice or not is_cryptopay_paid(invoice.status):
-        return
+        return False
 
     await _process_paid_order(
         order_id,
@@ -141,12 +89,13 @@ async def _handle_cryptopay(invoice_id: int | None, payload_raw: str | None) ->
         provider_id=invoice_id,
         raw_payload=invoice.raw,
     )
+    return True
 
-async def _handle_yookassa(payment_id: str | None, metadata: dict[str, Any] | None) -> None:
+async def _handle_yookassa(payment_id: str | None, metadata: dict[str, Any] | None) -> bool:
     shop_id = getattr(settings, "yookassa_shop_id", None)
     secret_key = getattr(settings, "yookassa_secret_key", None)
     if not (shop_id and secret_key and payment_id):
-        return
+        return False
 
     order_id = None
     if metadata:
@@ -155,14 +104,14 @@ async def _handle_yookassa(payment_id: str | None, metadata: dict[str, Any] | No
         except Exception:
             order_id = None
 
-    client = YooKassaClient(shop_id, secret_key)
+    client = get_yookassa_client()
     try:
         payment = await client.get_payment(payment_id)
     except Exception as exc:
-        logger.exception("YooKassa webhook: failed to fetch payment %s: %s", payment_id, exc)
-        return
+        logger.warning("YooKassa webhook: failed to fetch payment {}: {}", payment_id, exc)
+        raise
     if not is_yookassa_paid(payment.status):
-        return
+        return False
 
     await _process_paid_order(
         order_id,
@@ -170,6 +119,67 @@ async def _handle_yookassa(payment_id: str | None, metadata: dict[str, Any] | No
         provider_id=payment_id,
         raw_payload=payment.raw,
     )
+    return True
+
+
+async def _run_once(provider: str, event_id: str, handle: Callable[[], Awaitable[bool]]) -> None:
+    async with session_scope() as session:
+        if not await claim_webhook_event(session, provider, event_id):
+            logger.info("Webhook {}:{} already processed, skipped", provider, event_id)
+            return
+    if await handle():
+        async with session_scope() as session:
+            await mark_webhook_processed(session, provider, event_id)
+    else:
+        # Not final yet (e.g. provider still reports unpaid): accept the next delivery.
+        await forget_seen(provider, event_id)
+
+
+async def _run_cryptopay_event(payload: dict[str, Any]) -> None:
+    invoice_id = payload.get("invoice_id")
+    await _run_once(
+        "cryptopay",
+        str(invoice_id),
+        lambda: _handle_cryptopay(invoice_id, payload.get("payload")),
+    )
+
+
+async def _run_yookassa_event(payload: dict[str, Any]) -> None:
+    payment_id = payload.get("payment_id")
+    await _run_once(
+        "yookassa",
+        str(payment_id),
+        lambda: _handle_yookassa(payment_id, payload.get("metadata")),
+    )
+
+
+_workers: WebhookWorkerPool | None = None
+
+WEBHOOK_HANDLERS = {
+    "cryptopay": _run_cryptopay_event,
+    "yookassa": _run_yookassa_event,
+}
+
+
+async def _accept_event(kind: str, event_id: str, payload: dict[str, Any]) -> web.Response:
+    """Persist the event and answer 200, or 503 so the provider redelivers.
+
+    Redeliveries seen within the dedup TTL are acknowledged without any I/O.
+    """
+    if await seen_recently(kind, event_id):
+        logger.info("Webhook {}:{} duplicate dropped", kind, event_id)
+        return web.Response(text="ok")
+    if _workers is None or not _workers.running:
+        # Nobody in this process would consume it; let the provider redeliver later
+        logger.error("Webhook workers not running, asking {} to redeliver {}", kind, event_id)
+        return web.Response(status=503, text="retry")
+    try:
+        await enqueue_webhook(kind, payload)
+    except WebhookQueueUnavailable as exc:
+        await forget_seen(kind, event_id)
+        logger.error("Webhook queue unavailable, asking {} to redeliver: {}", kind, exc)
+        return web.Response(status=503, text="retry")
+    return web.Response(text="ok")
 
 
 async def cryptopay_webhook(request: web.Request) -> web.Response:
@@ -197,7 +207,7 @@ async def cryptopay_webhook(request: web.Request) -> web.Response:
     invoice_payload = payload.get("payload")
 
     if invoice_id:
-        asyncio.create_task(_handle_cryptopay(int(invoice_id), invoice_payload))
+        return await _accept_event("cryptopay", str(invoice_id), {"invoice_id": int(invoice_id), "payload": invoice_payload})
 
     return web.Response(text="ok")
 
@@ -223,149 +233,155 @@ async def yookassa_webhook(request: web.Request) -> web.Response:
     metadata = payment.get("metadata") or {}
 
     if payment_id:
-        asyncio.create_task(_handle_yookassa(str(payment_id), metadata))
+        return await _accept_event("yookassa", str(payment_id), {"payment_id": str(payment_id), "metadata": metadata})
 
     return web.Response(text="ok")
 
-def _platform_instructions_html(code: str) -> str:
-    base = (
-        "<ol>"
-        "<li>Откройте приложение для подключения.</li>"
-        "<li>Импортируйте ссылку или вставьте конфиг вручную.</li>"
-        "<li>Выберите профиль и нажмите «Подключить».</li>"
-        "</ol>"
-    )
-    if code == "ios":
-        return (
-            "<h3>Инструкция для iOS</h3>"
-            "<p>Установите Happ или совместимый клиент и импортируйте ссылку.</p>"
-            + base
-        )
-    if code == "android":
-        return (
-            "<h3>Инструкция для Android</h3>"
-            "<p>Установите Happ или другой VLESS-клиент и импортируйте ссылку.</p>"
-            + base
-        )
-    if code == "windows":
-        return (
-            "<h3>Инструкция для Windows</h3>"
-            "<p>Установите клиент и импортируйте ссылку или конфиг.</p>"
-            + base
-        )
-    if code == "macos":
-        return (
-            "<h3>Инструкция для macOS</h3>"
-            "<p>Установите клиент и импортируйте ссылку или конфиг.</p>"
-            + base
-        )
-    if code == "linux":
-        return (
-            "<h3>Инструкция для Linux</h3>"
-            "<p>Установите клиент и добавьте конфиг.</p>"
-            + base
-        )
-    return "<h3>Инструкция</h3>" + base
-
-
 async def connect_page(request: web.Request) -> web.Response:
-    token = request.match_info.get("token")
-    platform = request.match_info.get("platform")
-    parsed = verify_connect_token(token or "")
+    parsed = verify_connect_token(request.match_info.get("token") or "")
     if not parsed:
         return web.Response(status=404, text="Invalid token")
-    async with session_scope() as session:
-        device = await session.get(Device, parsed.device_id)
-        if not device or device.user_id != parsed.user_id:
-            return web.Response(status=404, text="Device not found")
-    marz = _marzban_client()
+    bundle = await get_connect_bundle(parsed.device_id, parsed.user_id)
+    if bundle is None:
+        return web.Response(status=404, text="Device not found")
+
+    body, etag = render_connect_page(bundle, request.match_info.get("platform") or "")
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={settings.connect_cache_seconds}",
+    }
+    if etag in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="text/html", charset="utf-8", headers=headers)
+
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    given = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(given.encode(), webhook_secret().encode()):
+        return web.Response(status=401)
     try:
-        link = None
-        subscription_url = None
-        if device.marzban_username:
-            user_data = await marz.get_user(device.marzban_username)
-            if isinstance(user_data, dict):
-                links = user_data.get("links") or []
-                link = links[0] if links else None
-                subscription_url = make_absolute_url(user_data.get("subscription_url"))
-    finally:
-        await marz.close()
-
-    plain_url = subscription_url
-    crypt_url = None
-    if plain_url:
-        _, crypt_url = await build_happ_links(plain_url)
-
-    vless_block = f"<pre><code>{html.escape(link or '')}</code></pre>" if link else "<p>—</p>"
-    happ_block = (
-        f'<a class="btn" href="{html.escape(crypt_url)}">Добавить в Happ</a>'
-        if crypt_url
-        else ""
-    )
-    sub_block = (
-        f'<a class="btn" href="{html.escape(plain_url)}">Открыть подписку</a>'
-        if plain_url
-        else ""
-    )
-    instructions = _platform_instructions_html(platform or "")
-    html_body = f"""
-    <html>
-      <head>
-        <meta charset="utf-8"/>
-        <title>Qdenzo Connect</title>
-        <style>
-          body {{ font-family: Arial, sans-serif; padding: 24px; max-width: 720px; margin: 0 auto; }}
-          .btn {{ display: inline-block; margin: 6px 6px 6px 0; padding: 10px 14px; background: #1f6feb; color: #fff; text-decoration: none; border-radius: 6px; }}
-          .section {{ margin-top: 18px; }}
-          code {{ word-break: break-all; white-space: pre-wrap; }}
-        </style>
-      </head>
-      <body>
-        <h2>Подключение устройства</h2>
-        <p>Выберите платформу:</p>
-        <div>
-          <a class="btn" href="./android">Android</a>
-          <a class="btn" href="./ios">iOS</a>
-          <a class="btn" href="./windows">Windows</a>
-          <a class="btn" href="./macos">macOS</a>
-          <a class="btn" href="./linux">Linux</a>
-        </div>
-        <div class="section">{instructions}</div>
-        <div class="section">
-          <h3>Ссылка подписки</h3>
-          {sub_block or "<p>Подписка пока недоступна.</p>"}
-        </div>
-        <div class="section">
-          <h3>VLESS конфиг</h3>
-          {vless_block}
-        </div>
-        <div class="section">
-          <h3>Happ</h3>
-          {happ_block or "<p>Импорт в Happ временно недоступен.</p>"}
-        </div>
-      </body>
-    </html>
-    """
-    return web.Response(text=html_body, content_type="text/html")
+        update = await request.json()
+    except Exception:
+        logger.warning("Telegram webhook: invalid JSON")
+        return web.Response(text="ok")
+    if not isinstance(update, dict):
+        return web.Response(text="ok")
+    try:
+        await enqueue_update(update)
+    except UpdateQueueUnavailable as exc:
+        # Telegram redelivers on non-2xx
+        logger.error("Telegram update not queued: {}", exc)
+        return web.Response(status=503)
+    return web.Response(text="ok")
+
+
+async def subscription_proxy(request: web.Request) -> web.Response:
+    parsed = parse_subscription_token(request.match_info.get("token") or "")
+    if not parsed:
+        sub_requests.inc(result="forged")
+        return web.Response(status=404)
+    username, signature = parsed
+    try:
+        content = await get_subscription(
+            username,
+            signature,
+            client_type=request.match_info.get("client_type") or "",
+            user_agent=request.headers.get("User-Agent", ""),
+            query=request.query_string,
+        )
+    except SubscriptionRateLimited:
+        return web.Response(status=429, headers={"Retry-After": str(settings.sub_proxy_rate_window_seconds)})
+    except SubscriptionUnavailable:
+        return web.Response(status=502)
+    if content is None:
+        return web.Response(status=404)
+
+    headers = dict(content.headers)
+    if content.status != 200:
+        return web.Response(status=content.status, body=content.body, headers=headers)
+    headers["ETag"] = content.etag
+    if content.etag in request.headers.get("If-None-Match", ""):
+        headers.pop("content-type", None)
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=content.body, headers=headers)
 
 
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    token = settings.metrics_token
+    if token:
+        auth = request.headers.get("Authorization", "")
+        given = auth[7:] if auth.startswith("Bearer ") else request.query.get("token", "")
+        if not hmac.compare_digest(given.encode(), token.encode()):
+            return web.Response(status=401)
+    body = await render_metrics()
+    return web.Response(text=body, content_type="text/plain", charset="utf-8")
 
-async def start_webhook_server() -> web.AppRunner:
+
+async def start_webhook_server(*, reuse_port: bool = False, metrics: bool = True) -> web.AppRunner:
+    """Start the HTTP server; `reuse_port` lets several processes bind the same port.
+
+    Pass `metrics=False` when several processes share the port: a scrape would
+    get the counters of whichever process accepted it.
+    """
     app = web.Application()
     app.router.add_post("/webhook/cryptopay/{secret}", cryptopay_webhook)
     app.router.add_post("/webhook/yookassa/{secret}", yookassa_webhook)
     app.router.add_get("/connect/{token}", connect_page)
     app.router.add_get("/connect/{token}/{platform}", connect_page)
+    if settings.telegram_mode == "webhook":
+        app.router.add_post(settings.telegram_webhook_path, telegram_webhook)
+    if settings.sub_proxy_enabled:
+        app.router.add_get("/sub/{token}", subscription_proxy)
+        app.router.add_get("/sub/{token}/{client_type}", subscription_proxy)
+    if settings.metrics_enabled and metrics:
+        app.router.add_get("/metrics", metrics_endpoint)
 
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, settings.webhook_host, settings.webhook_port)
+    site = web.TCPSite(runner, settings.webhook_host, settings.webhook_port, reuse_port=reuse_port or None)
     await site.start()
     logger.info("Webhook server started on %s:%s", settings.webhook_host, settings.webhook_port)
     return runner
 
 
+async def start_metrics_server(port: int) -> web.AppRunner | None:
+    """/metrics of this process alone on its own port (one scrape target per process)."""
+    if not settings.metrics_enabled:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, settings.webhook_host, port)
+    await site.start()
+    logger.info("Metrics server started on {}:{}", settings.webhook_host, port)
+    return runner
+
+
 async def stop_webhook_server(runner: web.AppRunner | None) -> None:
     if not runner:
         return
-    await runner.cleanup()
\ No newline at end of file
+    await runner.cleanup()
+    await close_connect_page()
+
+
+async def start_webhook_workers() -> WebhookWorkerPool:
+    """Start the consumers; if that fails they keep retrying and webhooks get 503 until then."""
+    global _workers
+    pool = WebhookWorkerPool(WEBHOOK_HANDLERS)
+    try:
+        await pool.start()
+    except Exception as exc:
+        logger.error("Webhook workers not started, answering payment webhooks with 503 until they are: {}", exc)
+        pool.start_in_background()
+    _workers = pool
+    return pool
+
+
+async def stop_webhook_workers(pool: WebhookWorkerPool | None) -> None:
+    global _workers
+    if not pool:
+        return
+    if _workers is pool:
+        _workers = None
+    await pool.stop()